@@ -4,7 +4,7 @@ import _pickle as pickle
 import myTorch
 import time
 import numpy as np
-from myTorch.utils import create_folder
+from myTorch.utils import create_folder, ArtifactCache
 from myTorch.environment.BlocksworldMatrix import Tower
 
 class WorldBuilder(object):
@@ -104,8 +104,14 @@ class WorldBuilder(object):
 		if not os.path.exists(loc):
 			self.create_games(game_level)
 		print("Loading game json files at {}".format(loc))
-		with open(os.path.join(loc, "{}.json".format(mode)), "r") as f:
-			games =  json.load(f)
+		file_name = os.path.join(loc, "{}.json".format(mode))
+
+		def _build():
+			with open(file_name, "r") as f:
+				return {"games": json.load(f)}
+
+		# the parsed games are cached as a pickle, which loads much faster than the json.
+		games = ArtifactCache().get_arrays("blocksworld_games", [file_name], _build)["games"]
 		return games
 
 
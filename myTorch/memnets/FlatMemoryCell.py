@@ -1,13 +1,31 @@
+from typing import Dict, Final, NamedTuple, Tuple
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 import math
 
+from myTorch.memory.jacobians import diag_mm, layer_norm_jacobian
+from myTorch.memory.packing import project_inputs
+
+
+class FlatMemoryState(NamedTuple):
+    h: torch.Tensor
+    memory: torch.Tensor
 
 
 class FlatMemoryCell(nn.Module):
 
+    input_size: Final[int]
+    hidden_size: Final[int]
+    memory_size: Final[int]
+    k: Final[int]
+    _sqrt_memk: Final[int]
+    _factored: Final[bool]
+    _use_relu: Final[bool]
+    _layer_norm: Final[bool]
+
     def __init__(self, device, input_size, hidden_size, memory_size=64, k=4, activation="tanh", use_relu=False, layer_norm=False): 
         super(FlatMemoryCell, self).__init__()
 
@@ -26,11 +44,13 @@ class FlatMemoryCell(nn.Module):
         self._layer_norm = layer_norm
 
         assert math.sqrt(self.memory_size*self.k).is_integer()
-        sqrt_memk = int(math.sqrt(self.memory_size*self.k))
-        self.hm2v_alpha = nn.Linear(self.memory_size + hidden_size, 2 * sqrt_memk)
-        self.hm2v_beta = nn.Linear(self.memory_size + hidden_size, 2 * sqrt_memk)
-        self.hm2alpha = nn.Linear(self.memory_size + hidden_size, self.k)
-        self.hm2beta = nn.Linear(self.memory_size + hidden_size, self.k)
+        self._sqrt_memk = int(math.sqrt(self.memory_size*self.k))
+        # the memory update has a factored form when every memory slot covers whole rows of
+        # the [sqrt_memk, sqrt_memk] outer products.
+        self._factored = self._sqrt_memk % self.k == 0
+        # alpha, beta, v_alpha and v_beta heads in one matmul.
+        self.hm2heads = nn.Linear(self.memory_size + hidden_size, 2 * self.k + 4 * self._sqrt_memk)
+        self._register_load_state_dict_pre_hook(self._convert_state_dict)
 
         if self._layer_norm:
             self._ln_h = nn.LayerNorm(hidden_size)
@@ -51,40 +71,146 @@ class FlatMemoryCell(nn.Module):
         else:
             return x
 
-    def forward(self, input, last_hidden):
-        hidden = {}
-        c_input = torch.cat((input, last_hidden["h"], last_hidden["memory"]), 1)
+    def forward(self, input, last_hidden: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        state = self.step(input, FlatMemoryState(last_hidden["h"], last_hidden["memory"]))
+        return {"h": state.h, "memory": state.memory}
+
+    @torch.jit.export
+    def forward_sequence(self, inputs,
+                         last_hidden: Dict[str, torch.Tensor]) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        """Implements forward computation over a whole sequence.
+
+        Args:
+            inputs: [seq_len, batch_size, input_size] input sequence.
+            last_hidden: hidden state dictionary before the first time step.
+
+        Returns:
+            [seq_len, batch_size, hidden_size] hidden outputs and the last hidden state dictionary.
+        """
+
+        outputs, state = self.step_sequence(inputs, FlatMemoryState(last_hidden["h"], last_hidden["memory"]))
+        return outputs, {"h": state.h, "memory": state.memory}
+
+    @torch.jit.export
+    def step(self, input, last_state: FlatMemoryState) -> FlatMemoryState:
+        c_input = torch.cat((input, last_state.h, last_state.memory), 1)
         #r_t = self.hmi2r(c_input)
         #c_input = torch.cat((input, last_hidden["h"], r_t), 1)
         
         #h, hidden["lstm_cell_h"] = self.hmi2h(c_input.unsqueeze(0), last_hidden["lstm_cell_h"])
         #h = h.squeeze(0)
         h = F.relu(self._opt_layernorm(self.hmi2h(c_input)))
+        return self._update_memory(h, last_state)
+
+    @torch.jit.export
+    def step_sequence(self, inputs, state: FlatMemoryState) -> Tuple[torch.Tensor, FlatMemoryState]:
+        """Computes a whole sequence on a typed hidden state.
+
+        The input part of `hmi2h` is computed for all time steps with one matmul, only the
+        (h, memory) part runs in the time loop.
+        """
+
+        x_proj = project_inputs(inputs, self.hmi2h.weight[:, :self.input_size].t().contiguous(),
+                                self.hmi2h.bias)
+        W_hm = self.hmi2h.weight[:, self.input_size:]
+
+        outputs = []
+        for x_t in x_proj.unbind(0):
+            hm = torch.cat((state.h, state.memory), 1)
+            h = F.relu(self._opt_layernorm(x_t + F.linear(hm, W_hm)))
+            state = self._update_memory(h, state)
+            outputs.append(state.h)
+        return torch.stack(outputs), state
+
+    def _update_memory(self, h, last_state: FlatMemoryState) -> FlatMemoryState:
+        # keeps the state in its dtype when the linear layers run under autocast.
+        h = h.to(last_state.h.dtype)
 
         # Flat memory equations
-        alpha = self._opt_relu(self.hm2alpha(torch.cat((h,last_hidden["memory"]),1))).clone()
-        beta = self._opt_relu(self.hm2beta(torch.cat((h,last_hidden["memory"]),1))).clone()
-
-        u_alpha = self.hm2v_alpha(torch.cat((h,last_hidden["memory"]),1)).chunk(2,dim=1)
-        v_alpha = torch.bmm(u_alpha[0].unsqueeze(2), u_alpha[1].unsqueeze(1)).view(-1, self.k, self.memory_size)
-        v_alpha = self._opt_relu(v_alpha)
-        v_alpha = torch.nn.functional.normalize(v_alpha, p=5, dim=2, eps=1e-12)
-        add_memory = alpha.unsqueeze(2)*v_alpha
-
-        u_beta = self.hm2v_beta(torch.cat((h,last_hidden["memory"]),1)).chunk(2, dim=1)
-        v_beta = torch.bmm(u_beta[0].unsqueeze(2), u_beta[1].unsqueeze(1)).view(-1, self.k, self.memory_size)
-        v_beta = self._opt_relu(v_beta)
-        v_beta = torch.nn.functional.normalize(v_beta, p=5, dim=2, eps=1e-12)
-        forget_memory = beta.unsqueeze(2)*v_beta
-
-        hidden["memory"] = last_hidden["memory"] + torch.mean(add_memory-forget_memory, dim=1)
-        hidden["h"] = h
-        return hidden
-
-    def reset_hidden(self, batch_size):
-        hidden = {}
-        hidden["h"] = torch.Tensor(np.zeros((batch_size, self.hidden_size))).to(self._device)
-        hidden["memory"] = torch.Tensor(np.zeros((batch_size, self.memory_size))).to(self._device)
+        heads = self.hm2heads(torch.cat((h, last_state.memory), 1)).to(last_state.memory.dtype)
+        alpha, beta, u_alpha, u_beta = heads.split(
+            [self.k, self.k, 2 * self._sqrt_memk, 2 * self._sqrt_memk], 1)
+        alpha = self._opt_relu(alpha)
+        beta = self._opt_relu(beta)
+
+        memory = last_state.memory + self._write(alpha, u_alpha) - self._write(beta, u_beta)
+        return FlatMemoryState(h, memory)
+
+    def _write(self, weight, u):
+        """Computes mean_k(weight * normalize(opt_relu(outer(u0, u1)).view(-1, k, memory_size), p=5)).
+
+        The row of memory slot r and column j of the outer product is a_(r, p) * b_j, with
+        a = u0.view(-1, k, sqrt_memk // k) and j = m % sqrt_memk. Its 5-norm factors into the
+        norms of a_r and b (of their positive and negative parts with relu), and the mean over
+        the slots into a weighted sum of the rows of a, so no [batch_size, k, memory_size]
+        tensor is built.
+        """
+
+        a, b = u.chunk(2, dim=1)
+        if not self._factored:
+            v = torch.bmm(a.unsqueeze(2), b.unsqueeze(1)).view(-1, self.k, self.memory_size)
+            v = F.normalize(self._opt_relu(v), p=5., dim=2, eps=1e-12)
+            return torch.mean(weight.unsqueeze(2)*v, dim=1)
+
+        a = a.reshape(-1, self.k, self._sqrt_memk // self.k)
+        if self._use_relu:
+            a_pos, a_neg = F.relu(a), F.relu(-a)
+            b_pos, b_neg = F.relu(b), F.relu(-b)
+            norms = torch.stack((torch.linalg.vector_norm(a_pos, 5., dim=2) *
+                                 torch.linalg.vector_norm(b_pos, 5., dim=1, keepdim=True),
+                                 torch.linalg.vector_norm(a_neg, 5., dim=2) *
+                                 torch.linalg.vector_norm(b_neg, 5., dim=1, keepdim=True)), 2)
+            w = (weight / torch.linalg.vector_norm(norms, 5., dim=2).clamp_min(1e-12)).unsqueeze(2) / self.k
+            v = (w*a_pos).sum(1).unsqueeze(2)*b_pos.unsqueeze(1) + (w*a_neg).sum(1).unsqueeze(2)*b_neg.unsqueeze(1)
+        else:
+            norms = torch.linalg.vector_norm(a, 5., dim=2) * torch.linalg.vector_norm(b, 5., dim=1, keepdim=True)
+            w = (weight / norms.clamp_min(1e-12)).unsqueeze(2) / self.k
+            v = (w*a).sum(1).unsqueeze(2)*b.unsqueeze(1)
+        return v.view(-1, self.memory_size)
+
+    def _convert_state_dict(self, state_dict, prefix, *args):
+        """Loads checkpoints saved with the separate alpha, beta, v_alpha and v_beta heads."""
+
+        names = ["hm2alpha", "hm2beta", "hm2v_alpha", "hm2v_beta"]
+        if prefix + "hm2alpha.weight" not in state_dict:
+            return
+        for param in ["weight", "bias"]:
+            state_dict[prefix + "hm2heads." + param] = torch.cat(
+                [state_dict.pop(prefix + name + "." + param) for name in names], 0)
+
+    @torch.jit.export
+    def step_jacobian(self, input, last_hidden: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """Computes the Jacobian dh_t/dh_(t-1) of one time step in closed form.
+
+        The memory is held fixed.
+
+        Args:
+            input: [batch_size, input_size] current input vector.
+            last_hidden: previous hidden state dictionary.
+
+        Returns:
+            [batch_size, hidden_size, hidden_size] Jacobian, entry [b, i, j] is the derivative
+            of h_t[b, i] w.r.t. h_(t-1)[b, j].
+        """
+
+        h = last_hidden["h"]
+        pre_h = self.hmi2h(torch.cat((input, h, last_hidden["memory"]), 1)).to(h.dtype)
+        W_h = self.hmi2h.weight[:, self.input_size:self.input_size + self.hidden_size]
+        J = W_h.unsqueeze(0).expand(h.shape[0], -1, -1)
+
+        if self._layer_norm:
+            J = layer_norm_jacobian(pre_h, J, self._ln_h.weight, self._ln_h.eps)
+            pre_h = self._ln_h(pre_h)
+        return diag_mm((pre_h > 0).to(pre_h.dtype), J)
+
+    @torch.jit.export
+    def init_state(self, batch_size: int) -> FlatMemoryState:
+        return FlatMemoryState(torch.zeros(batch_size, self.hidden_size, device=self._device),
+                               torch.zeros(batch_size, self.memory_size, device=self._device))
+
+    @torch.jit.export
+    def reset_hidden(self, batch_size: int) -> Dict[str, torch.Tensor]:
+        state = self.init_state(batch_size)
         #hidden["lstm_cell_h"] = (torch.Tensor(np.zeros((1, batch_size, self.hidden_size))).to(self._device), 
         #                        torch.Tensor(np.zeros((1, batch_size, self.hidden_size))).to(self._device))
-        return hidden
+        return {"h": state.h, "memory": state.memory}
@@ -1,3 +1,5 @@
+from typing import Dict, Final, NamedTuple, Tuple
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -5,10 +7,37 @@ import torch.nn.init as init
 import numpy as np
 import math
 
+from myTorch.memory.jacobians import diag_mm
+from myTorch.memory.packing import project_inputs
+
+class SRUState(NamedTuple):
+    h: torch.Tensor
+    mu: torch.Tensor
+
+
 class SRUCell(nn.Module):
 
+    _input_size: Final[int]
+    _hidden_size: Final[int]
+    _phi_size: Final[int]
+    _n_alpha: Final[int]
+    _mu_size: Final[int]
+    _feedback_lag: Final[int]
+    _SCAN_CHUNK: Final[int] = 16
+    # hidden state entry that carries the recurrence, h only reads it out, see state_jacobian.
+    recurrent_state: Final[str] = "mu"
+
     def __init__(self, device, input_size, hidden_size, phi_size=256, r_size=64, activation="tanh",
-                 A=[0, 0.5, 0.9, 0.99, 0.999]): 
+                 A=[0, 0.5, 0.9, 0.99, 0.999], feedback_lag=1): 
+        """Initializes a SRU cell.
+
+        With feedback_lag > 1, step_sequence computes the feedback r only at the first step
+        of every block of feedback_lag steps, from the mu before the block. phi is then known
+        for the whole block, so mu comes from a prefix scan, see _scan, and the feedback and
+        output matmuls run once per block. Blocks start anew at every call, single steps
+        always use the current mu.
+        """
+
         super(SRUCell, self).__init__()
 
         self._device = device
@@ -20,33 +49,232 @@ class SRUCell(nn.Module):
         self._A = A
         self._n_alpha = len(A)
         self._mu_size = self._phi_size * self._n_alpha
+        self._feedback_lag = feedback_lag
 
         self._mu2r   = nn.Linear(self._mu_size, self._r_size)
         self._xr2phi = nn.Linear(self._input_size + self._r_size, self._phi_size)
         self._mu2o   = nn.Linear(self._mu_size, self._hidden_size)
 
-        self._A_mask = torch.Tensor([x for x in(A) for i in range(phi_size)]).view(1, -1).to(self._device)
+        # [n_alpha, 1] decays, broadcast over mu viewed as [batch_size, n_alpha, phi_size]. The
+        # buffer is persistent, as scripted cells always save their buffers.
+        self.register_buffer("_A_decay", torch.Tensor(A).view(-1, 1).to(self._device))
+        self._register_load_state_dict_pre_hook(self._convert_state_dict)
         self._init_weight()
         
 
-    def forward(self, input, last_hidden):
-        r = F.relu(self._mu2r(last_hidden["mu"]))
+    def forward(self, input, last_hidden: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        state = self.step(input, SRUState(last_hidden["h"], last_hidden["mu"]))
+        return {"h": state.h, "mu": state.mu}
+
+    @torch.jit.export
+    def forward_sequence(self, inputs,
+                         last_hidden: Dict[str, torch.Tensor]) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        """Implements forward computation over a whole sequence.
+
+        Args:
+            inputs: [seq_len, batch_size, input_size] input sequence.
+            last_hidden: hidden state dictionary before the first time step.
+
+        Returns:
+            [seq_len, batch_size, hidden_size] hidden outputs and the last hidden state dictionary.
+        """
+
+        outputs, state = self.step_sequence(inputs, SRUState(last_hidden["h"], last_hidden["mu"]))
+        return outputs, {"h": state.h, "mu": state.mu}
+
+    @torch.jit.export
+    def step(self, input, last_state: SRUState) -> SRUState:
+        r = F.relu(self._mu2r(last_state.mu))
         phi = F.relu(self._xr2phi(torch.cat((input, r), 1)))
-        mu_next = self._muphi2mu(last_hidden["mu"], phi)
-        hidden = {}
-        hidden["h"] = F.relu(self._mu2o(mu_next))
-        hidden["mu"] = mu_next
-        return hidden
+        return self._phi2state(phi, last_state)
+
+    @torch.jit.export
+    def step_sequence(self, inputs, state: SRUState) -> Tuple[torch.Tensor, SRUState]:
+        """Computes a whole sequence on a typed hidden state.
+
+        The input part of `_xr2phi` is computed for all time steps with one matmul, only the
+        feedback part runs in the time loop. With a feedback lag, the time loop runs over
+        blocks of steps instead.
+        """
+
+        x_proj = project_inputs(inputs, self._xr2phi.weight[:, :self._input_size].t().contiguous(),
+                                self._xr2phi.bias)
+        W_r = self._xr2phi.weight[:, self._input_size:]
+
+        if self._feedback_lag > 1:
+            blocks = []
+            for x_block in x_proj.split(self._feedback_lag, 0):
+                r = F.relu(self._mu2r(state.mu))
+                h, state = self._phi2states(F.relu(x_block + F.linear(r, W_r)), state)
+                blocks.append(h)
+            return torch.cat(blocks, 0), state
+
+        outputs = []
+        for x_t in x_proj.unbind(0):
+            r = F.relu(self._mu2r(state.mu))
+            phi = F.relu(x_t + F.linear(r, W_r))
+            state = self._phi2state(phi, state)
+            outputs.append(state.h)
+        return torch.stack(outputs), state
+
+    @torch.jit.export
+    def scan_sequence(self, inputs, r, state: SRUState) -> Tuple[torch.Tensor, SRUState]:
+        """Computes a whole sequence with an external feedback signal.
+
+        Args:
+            inputs: [seq_len, batch_size, input_size] input sequence.
+            r: [seq_len, batch_size, r_size] feedback used in place of relu(_mu2r(mu)).
+            state: hidden state before the first time step.
+
+        Returns:
+            [seq_len, batch_size, hidden_size] hidden outputs and the last hidden state.
+        """
+
+        return self._phi2states(F.relu(self._xr2phi(torch.cat((inputs, r), 2))), state)
+
+    def _phi2state(self, phi, last_state: SRUState) -> SRUState:
+        mu_next = self._muphi2mu(last_state.mu, phi)
+        return SRUState(F.relu(self._mu2o(mu_next)).to(mu_next.dtype), mu_next)
+
+    def _phi2states(self, phi, last_state: SRUState) -> Tuple[torch.Tensor, SRUState]:
+        """Computes the states of all time steps of phi, with one matmul for the outputs."""
+
+        mus = self._scan(phi, last_state.mu)
+        h = F.relu(self._mu2o(mus)).to(mus.dtype)
+        return h, SRUState(h[-1], mus[-1])
 
     def _muphi2mu(self, mu, phi):
-        phi_tile = phi.repeat(1, self._n_alpha)
-        mu = torch.mul(self._A_mask, mu) + torch.mul((1-self._A_mask), phi_tile)
-        return mu
-
-    def reset_hidden(self, batch_size):
-        hidden = {}
-        hidden["mu"] = torch.Tensor(np.zeros((batch_size, self._mu_size))).to(self._device)
-        return hidden
+        mu = self._A_decay * mu.reshape(-1, self._n_alpha, self._phi_size) + \
+            (1 - self._A_decay) * phi.unsqueeze(1)
+        return mu.reshape(-1, self._mu_size)
+
+    def _scan(self, phi, mu):
+        """Computes mu_t = A*mu_(t-1) + (1-A)*phi_t for all time steps of phi.
+
+        On CPUs the elementwise recurrence touches every mu once and is faster than any
+        scan, the other devices run _parallel_scan.
+
+        Args:
+            phi: [seq_len, batch_size, phi_size] phi of every time step.
+            mu: [batch_size, mu_size] mu before the first time step.
+
+        Returns:
+            [seq_len, batch_size, mu_size] mu after every time step.
+        """
+
+        if phi.device.type != "cpu":
+            return self._parallel_scan(phi, mu)
+
+        mus = []
+        for phi_t in phi.unbind(0):
+            mu = self._muphi2mu(mu, phi_t)
+            mus.append(mu)
+        return torch.stack(mus)
+
+    def _parallel_scan(self, phi, mu):
+        """Parallel prefix scan version of _scan.
+
+        Within chunks of _SCAN_CHUNK steps, mu is one matmul of phi with the lower triangular
+        [chunk, chunk] matrices of A^(i-j) * (1-A). The mu before every chunk then follows
+        from the chunk ends with a Hillis-Steele scan of log2(num_chunks) passes: after the
+        pass with offset d, every chunk end holds the decayed sum of its last 2*d chunks.
+        """
+
+        seq_len, batch_size = phi.shape[0], phi.shape[1]
+        chunk = self._SCAN_CHUNK
+        num_chunks = (seq_len + chunk - 1) // chunk
+        A = self._A_decay
+
+        phi = torch.cat((phi, phi.new_zeros(num_chunks * chunk - seq_len, batch_size, self._phi_size)), 0)
+        phi = phi.reshape(num_chunks, chunk, batch_size * self._phi_size)
+
+        # powers[a, i] = A_a^(i+1), L[a, i, j] = A_a^(i-j) * (1-A_a) for j <= i.
+        steps = torch.arange(chunk, device=phi.device, dtype=A.dtype)
+        powers = A.pow(steps + 1)
+        L = A.unsqueeze(2).pow((steps.view(-1, 1) - steps.view(1, -1)).clamp(min=0))
+        L = (L * (1 - A).unsqueeze(2)).tril()
+        # [n_alpha, num_chunks, chunk, batch_size * phi_size] contributions of each chunk.
+        local = torch.matmul(L.unsqueeze(1), phi.unsqueeze(0))
+
+        ends = local[:, :, -1]
+        decay = powers[:, -1].view(-1, 1, 1)
+        d = 1
+        while d < num_chunks:
+            ends = torch.cat((ends[:, :d], ends[:, d:] + decay * ends[:, :-d]), 1)
+            decay = decay * decay
+            d *= 2
+
+        mu = mu.reshape(batch_size, self._n_alpha, self._phi_size).permute(1, 0, 2)
+        mu = mu.reshape(self._n_alpha, 1, batch_size * self._phi_size)
+        chunks = torch.arange(1, num_chunks + 1, device=phi.device, dtype=A.dtype).view(1, -1, 1)
+        ends = ends + powers[:, -1].view(-1, 1, 1).pow(chunks) * mu
+        before = torch.cat((mu, ends[:, :-1]), 1)
+
+        mus = local + powers.view(self._n_alpha, 1, chunk, 1) * before.unsqueeze(2)
+        mus = mus.reshape(self._n_alpha, num_chunks * chunk, batch_size, self._phi_size)[:, :seq_len]
+        return mus.permute(1, 2, 0, 3).reshape(seq_len, batch_size, self._mu_size)
+
+    @torch.jit.export
+    def step_jacobian(self, input, last_hidden: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """Computes the Jacobian dh_t/dh_(t-1) of one time step.
+
+        h_t only depends on the past through mu_(t-1), which is held fixed, so the Jacobian
+        is zero. The dynamics of the cell are those of mu, see state_jacobian.
+
+        Args:
+            input: [batch_size, input_size] current input vector.
+            last_hidden: previous hidden state dictionary.
+
+        Returns:
+            [batch_size, hidden_size, hidden_size] zero Jacobian.
+        """
+
+        h = last_hidden["h"]
+        return h.new_zeros(h.shape[0], self._hidden_size, self._hidden_size)
+
+    @torch.jit.export
+    def state_jacobian(self, input, last_hidden: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """Computes the Jacobian dmu_t/dmu_(t-1) of one time step in closed form.
+
+        dmu_t/dmu_(t-1) = diag(A) + diag(1-A) relu'(phi) W_r relu'(r) W_mu2r, where the
+        second term is shared by the n_alpha blocks of mu.
+
+        Args:
+            input: [batch_size, input_size] current input vector.
+            last_hidden: previous hidden state dictionary.
+
+        Returns:
+            [batch_size, mu_size, mu_size] Jacobian, entry [b, i, j] is the derivative of
+            mu_t[b, i] w.r.t. mu_(t-1)[b, j].
+        """
+
+        mu = last_hidden["mu"]
+        pre_r = self._mu2r(mu)
+        pre_phi = self._xr2phi(torch.cat((input, F.relu(pre_r)), 1))
+        W_r = self._xr2phi.weight[:, self._input_size:]
+
+        # [batch_size, phi_size, mu_size] Jacobian of phi.
+        J_r = diag_mm((pre_r > 0).to(mu.dtype), self._mu2r.weight.unsqueeze(0).expand(mu.shape[0], -1, -1))
+        J_phi = diag_mm((pre_phi > 0).to(mu.dtype), torch.matmul(W_r, J_r))
+
+        J = ((1 - self._A_decay).view(1, -1, 1, 1) * J_phi.unsqueeze(1)).reshape(-1, self._mu_size, self._mu_size)
+        decay = self._A_decay.expand(self._n_alpha, self._phi_size).reshape(-1)
+        return J + torch.diag_embed(decay).to(J.dtype)
+
+    @torch.jit.export
+    def init_state(self, batch_size: int) -> SRUState:
+        return SRUState(torch.zeros(batch_size, self._hidden_size, device=self._device),
+                        torch.zeros(batch_size, self._mu_size, device=self._device))
+
+    @torch.jit.export
+    def reset_hidden(self, batch_size: int) -> Dict[str, torch.Tensor]:
+        state = self.init_state(batch_size)
+        return {"h": state.h, "mu": state.mu}
+
+    def _convert_state_dict(self, state_dict, prefix, *args):
+        """Loads checkpoints saved without the decays, which are fixed by A."""
+
+        state_dict.setdefault(prefix + "_A_decay", self._A_decay)
 
     def _init_weight(self):
         for name, params in self.named_parameters():
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Compares the per step time of eager and scripted recurrent cells."""
+import argparse
+import time
+
+import torch
+
+from myTorch.memnets.recurrent_net import Recurrent
+
+parser = argparse.ArgumentParser(description="Recurrent cell benchmark")
+parser.add_argument("--cell", type=str, default="LSTM", help="RNN, GRU, LSTM, JANET, FlatMemory or SRU.")
+parser.add_argument("--hidden_size", type=int, default=128, help="hidden layer dimension.")
+parser.add_argument("--input_size", type=int, default=8, help="size of the input vector.")
+parser.add_argument("--batch_size", type=int, default=16, help="batch size.")
+parser.add_argument("--seq_len", type=int, default=100, help="number of time steps per sequence.")
+parser.add_argument("--num_iters", type=int, default=20, help="number of timed iterations.")
+parser.add_argument("--packed", action="store_true", help="uses packed gate weights.")
+parser.add_argument("--no_peephole", action="store_true", help="fixes the LSTM peephole weights to zero.")
+parser.add_argument("--backend", type=str, default="python", help="python or native.")
+parser.add_argument("--schedule", type=str, default="layer", help="layer or time.")
+parser.add_argument("--precision", type=str, default="fp32", help="fp32 or bf16.")
+parser.add_argument("--backward", action="store_true", help="also times the backward pass.")
+args = parser.parse_args()
+
+
+def time_model(model, x, num_iters, backward):
+    """Returns the average time per time step in milliseconds."""
+
+    def run():
+        model.reset_hidden(x.shape[1])
+        output = model.forward_sequence(x)
+        if backward:
+            model.zero_grad()
+            output.sum().backward()
+
+    # warm up, the scripted cells are optimized during the first calls.
+    for _ in range(3):
+        run()
+
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        run()
+    return (time.perf_counter() - start) / (num_iters * x.shape[0]) * 1000
+
+
+def main():
+    device = torch.device("cpu")
+    torch.manual_seed(5)
+    x = torch.randn(args.seq_len, args.batch_size, args.input_size)
+
+    results = {}
+    for jit in [False, True]:
+        model = Recurrent(device, args.input_size, args.input_size, layer_size=[args.hidden_size],
+                          cell_name=args.cell, packed=args.packed, jit=jit,
+                          peephole=not args.no_peephole, backend=args.backend,
+                          precision=args.precision, schedule=args.schedule)
+        with torch.set_grad_enabled(args.backward):
+            results[jit] = time_model(model, x, args.num_iters, args.backward)
+
+    print("{} hidden {} batch {} : eager {:.4f} ms/step, script {:.4f} ms/step, speedup {:.2f}x".format(
+        args.cell, args.hidden_size, args.batch_size, results[False], results[True],
+        results[False] / results[True]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Adaptive softmax output layer for large vocabularies (Grave et al., 2017).
+
+The words are sorted by decreasing frequency and split into a head, holding the frequent
+words and one entry per tail cluster, and tail clusters of rarer words with smaller
+projections. Most tokens are then scored against the head only, instead of the whole
+vocabulary.
+"""
+import torch
+import torch.nn as nn
+
+
+def frequency_cutoffs(token_counts, mass=(0.8, 0.95)):
+    """Returns cluster cutoffs covering increasing fractions of the tokens.
+
+    Args:
+        token_counts: [vocab_size] list of occurrences of every token id.
+        mass: increasing fractions of the tokens covered by the head and the first tail
+            clusters, the last cluster holds the remaining words.
+
+    Returns:
+        list of increasing cutoffs in [1, vocab_size), in frequency rank order.
+    """
+
+    counts = torch.as_tensor(token_counts, dtype=torch.float64).sort(descending=True)[0]
+    covered = counts.cumsum(0) / counts.sum()
+    cutoffs = []
+    for fraction in mass:
+        cutoff = int(torch.searchsorted(covered, fraction)) + 1
+        if (not cutoffs or cutoff > cutoffs[-1]) and cutoff < len(counts):
+            cutoffs.append(cutoff)
+    return cutoffs
+
+
+class AdaptiveSoftmax(nn.Module):
+    """Adaptive softmax over token ids in dictionary order."""
+
+    def __init__(self, hidden_size, token_counts, cutoffs=None, div_value=4.0):
+        """Initializes the output layer.
+
+        Args:
+            hidden_size: int, size of the hidden states.
+            token_counts: [vocab_size] list of occurrences of every token id, e.g. from the
+                Dictionary.counter of the training corpus.
+            cutoffs: list of increasing cluster cutoffs in frequency rank order, from
+                frequency_cutoffs by default.
+            div_value: float, factor dividing the projection size of every next cluster.
+        """
+
+        super(AdaptiveSoftmax, self).__init__()
+
+        counts = torch.as_tensor(token_counts, dtype=torch.float64)
+        if cutoffs is None:
+            cutoffs = frequency_cutoffs(counts)
+
+        # rank of every token id in decreasing frequency order, ties keep the id order.
+        order = torch.sort(-counts, stable=True)[1]
+        rank = torch.empty_like(order)
+        rank[order] = torch.arange(len(order))
+        self.register_buffer("_rank", rank)
+
+        self._layer = nn.AdaptiveLogSoftmaxWithLoss(hidden_size, len(counts), list(cutoffs),
+                                                    div_value=div_value)
+
+    def forward(self, h, target):
+        """Returns the mean negative log-likelihood of the targets.
+
+        Args:
+            h: [num_tokens, hidden_size] hidden states.
+            target: [num_tokens] target token ids.
+        """
+
+        return self._layer(h, self._rank[target]).loss
+
+    def log_prob(self, h):
+        """Returns the exact [num_tokens, vocab_size] log-probabilities of all token ids."""
+
+        return self._layer.log_prob(h)[:, self._rank]
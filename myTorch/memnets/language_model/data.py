@@ -1,8 +1,13 @@
 import os
+import _pickle as pickle
+import numpy as np
 import torch
 
 from collections import Counter
 
+# version of the token files, to bump whenever the tokenization changes.
+TOKENIZER_VERSION = 1
+
 
 class Dictionary(object):
     def __init__(self):
@@ -20,37 +25,177 @@ class Dictionary(object):
         self.total += 1
         return self.word2idx[word]
 
+    def add_words(self, words):
+        """Adds a list of words, returns their ids as an int64 numpy array.
+
+        New words get ids in the order of their first occurrence, as with add_word.
+        """
+
+        for word in dict.fromkeys(words):
+            if word not in self.word2idx:
+                self.word2idx[word] = len(self.idx2word)
+                self.idx2word.append(word)
+        ids = np.fromiter(map(self.word2idx.__getitem__, words), dtype=np.int64, count=len(words))
+        self.count_ids(ids)
+        return ids
+
+    def count_ids(self, ids):
+        """Adds the occurrences of a numpy array of token ids to the counter."""
+
+        counts = np.bincount(ids, minlength=len(self))
+        self.counter.update({token_id: count for token_id, count in enumerate(counts.tolist()) if count})
+        self.total += len(ids)
+
     def __len__(self):
         return len(self.idx2word)
 
 
+def source_files(path):
+    """Returns the files a Corpus of path is tokenized from."""
+
+    files = []
+    for split in ('train', 'valid', 'test'):
+        file_name = os.path.join(path, split + '.txt')
+        files.append(file_name + '.raw' if os.path.exists(file_name + '.raw') else file_name)
+    return files
+
+
+def _token_dtype(vocab_size):
+    """Returns the smallest numpy dtype for the token ids of a vocabulary."""
+
+    if vocab_size <= 2 ** 8:
+        return np.uint8
+    elif vocab_size <= 2 ** 15:
+        return np.int16
+    return np.int32
+
+
+def load_tokens(file_name, dtype, num_tokens):
+    """Memory-maps a binary token file as a 1-D tensor, without reading it.
+
+    The mapping is copy-on-write, the file is never modified.
+    """
+
+    if num_tokens == 0:
+        return torch.from_numpy(np.zeros(0, dtype=dtype))
+    return torch.from_numpy(np.memmap(file_name, dtype=dtype, mode='c', shape=(num_tokens,)))
+
+
 class Corpus(object):
-    def __init__(self, path):
-        self.dictionary = Dictionary()
-        self.train = self.tokenize(os.path.join(path, 'train.txt'))
-        self.valid = self.tokenize(os.path.join(path, 'valid.txt'))
-        self.test = self.tokenize(os.path.join(path, 'test.txt'))
-
-    def tokenize(self, path):
-        """Tokenizes a text file."""
+    """Tokenized train, valid and test splits of a text corpus.
+
+    The token ids of every split live in a binary file of store_dir, with the smallest
+    integer dtype that holds the vocabulary, and are memory-mapped as 1-D tensors. The
+    dictionary and the file layout are pickled in store_dir/corpus.p, and a corpus whose
+    store exists is loaded from it instead of being tokenized again.
+    """
+
+    _BLOCK_SIZE = 1 << 24
+
+    def __init__(self, path, store_dir=None):
+        """Initializes a corpus.
+
+        Args:
+            path: str, folder with train.txt, valid.txt and test.txt.
+            store_dir: str, folder of the token files, path by default.
+        """
+
+        self._store_dir = store_dir or path
+        meta_file = os.path.join(self._store_dir, 'corpus.p')
+        if os.path.exists(meta_file):
+            with open(meta_file, 'rb') as f:
+                meta = pickle.load(f)
+        else:
+            if not os.path.exists(self._store_dir):
+                os.makedirs(self._store_dir)
+            meta = {'dictionary': Dictionary(), 'splits': {}}
+            for split in ('train', 'valid', 'test'):
+                meta['splits'][split] = self.tokenize(os.path.join(path, split + '.txt'),
+                                                      meta['dictionary'], split)
+            with open(meta_file + '.tmp', 'wb') as f:
+                pickle.dump(meta, f, 2)
+            os.replace(meta_file + '.tmp', meta_file)
+
+        self.dictionary = meta['dictionary']
+        for split, (dtype, num_tokens) in meta['splits'].items():
+            setattr(self, split, load_tokens(self._split_file(split), np.dtype(dtype), num_tokens))
+
+    def _split_file(self, split):
+        return os.path.join(self._store_dir, split + '.bin')
+
+    def tokenize(self, path, dictionary, split):
+        """Tokenizes a text file into the binary token file of a split.
+
+        Every line is split on whitespace and ends with an '<eos>' token. The file is read
+        once, in blocks of lines, and the ids of a block are written as soon as it is
+        tokenized. If a path.raw file exists, as prepared for enwik8, its bytes are the
+        tokens, see tokenize_bytes.
+
+        Returns:
+            the dtype name and the number of tokens of the split.
+        """
+
         assert os.path.exists(path)
-        # Add words to the dictionary
-        with open(path, 'r') as f:
-            tokens = 0
-            for line in f:
-                words = line.split() + ['<eos>']
-                tokens += len(words)
-                for word in words:
-                    self.dictionary.add_word(word)
-
-        # Tokenize file content
-        with open(path, 'r') as f:
-            ids = torch.LongTensor(tokens)
-            token = 0
-            for line in f:
-                words = line.split() + ['<eos>']
-                for word in words:
-                    ids[token] = self.dictionary.word2idx[word]
-                    token += 1
+        if os.path.exists(path + '.raw'):
+            return self.tokenize_bytes(path + '.raw', dictionary, split)
 
-        return ids
+        file_name = self._split_file(split)
+        num_tokens = 0
+        with open(path, 'r') as f, open(file_name + '.tmp', 'wb') as out:
+            while True:
+                lines = f.readlines(self._BLOCK_SIZE)
+                if not lines:
+                    break
+                words = ''.join(lines).replace('\n', ' <eos> ').split()
+                if not lines[-1].endswith('\n'):
+                    words.append('<eos>')
+                ids = dictionary.add_words(words)
+                out.write(ids.astype(np.int32).tobytes())
+                num_tokens += len(ids)
+
+        # the ids of a split only refer to the words seen so far, narrows them to fit.
+        dtype = _token_dtype(len(dictionary))
+        ids = np.memmap(file_name + '.tmp', dtype=np.int32, mode='r', shape=(num_tokens,)) \
+            if num_tokens else np.zeros(0, dtype=np.int32)
+        ids.astype(dtype).tofile(file_name)
+        del ids
+        os.remove(file_name + '.tmp')
+        return np.dtype(dtype).name, num_tokens
+
+    def tokenize_bytes(self, path, dictionary, split):
+        """Tokenizes a binary file whose bytes are the tokens.
+
+        The words and the ids are the same as those of the text file where every byte is
+        written as its decimal value and every newline byte starts a new line.
+
+        Returns:
+            the dtype name and the number of tokens of the split.
+        """
+
+        with open(path, 'rb') as f:
+            data = np.frombuffer(f.read(), dtype=np.uint8)
+        if len(data) and data[-1] != ord('\n'):
+            data = np.append(data, np.uint8(ord('\n')))
+
+        # adds the new bytes in the order of their first occurrence, the first blocks
+        # usually contain all of them.
+        values = np.flatnonzero(np.bincount(data, minlength=256)).tolist()
+        words = {value: '<eos>' if value == ord('\n') else str(value) for value in values}
+        seen = set()
+        for start in range(0, len(data), self._BLOCK_SIZE):
+            block_values, first = np.unique(data[start:start + self._BLOCK_SIZE], return_index=True)
+            for value in block_values[np.argsort(first)].tolist():
+                if value not in seen and words[value] not in dictionary.word2idx:
+                    dictionary.word2idx[words[value]] = len(dictionary.idx2word)
+                    dictionary.idx2word.append(words[value])
+                seen.add(value)
+            if len(seen) == len(values):
+                break
+
+        dtype = _token_dtype(len(dictionary))
+        lookup = np.zeros(256, dtype=dtype)
+        lookup[values] = [dictionary.word2idx[words[value]] for value in values]
+        ids = lookup[data]
+        dictionary.count_ids(ids)
+        ids.tofile(self._split_file(split))
+        return np.dtype(dtype).name, len(ids)
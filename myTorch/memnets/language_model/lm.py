@@ -5,7 +5,13 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from myTorch.memory import RNNCell, GRUCell, LSTMCell, JANETCell
+from myTorch.memory.native import native_incompatibility, native_sequence
+from myTorch.memory.precision import autocast, check_precision
+from myTorch.memory.quantized import QuantizedCell, quantized_linear
+from myTorch.memory.scripting import script_cell
+from myTorch.memory.wavefront import wavefront_sequence
 from myTorch.memnets.FlatMemoryCell import FlatMemoryCell
+from myTorch.memnets.language_model.adaptive_softmax import AdaptiveSoftmax
 
 
 class LanguageModel(nn.Module):
@@ -14,8 +20,17 @@ class LanguageModel(nn.Module):
     def __init__(self, device, vocab_size, input_emb_size, num_layers=1, layer_size=[10],
                  cell_name="LSTM", activation="tanh", output_activation="linear",
                  layer_norm=False, identity_init=False, chrono_init=False, t_max=10,
-                 memory_size=64, k=4, use_relu=True):
-        """Initializes a recurrent network."""
+                 memory_size=64, k=4, use_relu=True, packed=False, jit=False,
+                 peephole=True, backend="python", memory_efficient=False, precision="fp32",
+                 schedule="layer", wavefront_chunk=16, output_layer="softmax", token_counts=None,
+                 adaptive_cutoffs=None):
+        """Initializes a recurrent network.
+
+        With output_layer "adaptive", the dense output layer is replaced by an adaptive
+        softmax whose clusters are built from token_counts, the occurrences of every token
+        id, see AdaptiveSoftmax. The model then only computes losses with output_loss, and
+        exact log-probabilities with log_prob.
+        """
         
         super(LanguageModel, self).__init__()
 
@@ -34,6 +49,19 @@ class LanguageModel(nn.Module):
         self._memory_size = memory_size
         self._k = k
         self._use_relu = use_relu
+        self._packed = packed
+        self._jit = jit
+        self._peephole = peephole
+        self._memory_efficient = memory_efficient
+        self._precision = check_precision(precision)
+        self._schedule = schedule or "layer"
+        self._wavefront_chunk = wavefront_chunk or 16
+        self._output_layer_name = output_layer or "softmax"
+        assert self._output_layer_name in ("softmax", "adaptive"), "output_layer must be softmax or adaptive"
+        assert self._schedule in ("layer", "time", "wavefront"), "schedule must be layer, time or wavefront"
+        assert not (self._schedule != "layer" and backend == "native"), "the native backend is layer-major"
+        self._backend = backend
+        self.backend = None
 
         self._Cells = []
 
@@ -52,19 +80,163 @@ class LanguageModel(nn.Module):
         elif self._output_activation == "LogSoftmax":
             self._output_activation_fn = F.LogSoftmax
 
-        self._W_h2o = nn.Parameter(torch.Tensor(layer_size[-1], vocab_size))
-        self._b_o = nn.Parameter(torch.Tensor(vocab_size))
+        self._adaptive_softmax = None
+        if self._output_layer_name == "adaptive":
+            assert token_counts is not None, "the adaptive softmax needs the token counts"
+            self._adaptive_softmax = AdaptiveSoftmax(layer_size[-1], token_counts, adaptive_cutoffs)
+        else:
+            self._W_h2o = nn.Parameter(torch.Tensor(layer_size[-1], vocab_size))
+            self._b_o = nn.Parameter(torch.Tensor(vocab_size))
+        self._quantized_h2o = None
 
         self._reset_parameters()
         self.print_num_parameters()
 
     def forward(self, input):
+        """Implements step by step forward computation of the model over a sequence.
+
+        The hidden outputs of all time steps are collected, and the output layer runs once
+        on all of them.
+
+        Args:
+            input: [seq_len, batch_size] input token ids.
+
+        Returns:
+            [seq_len, batch_size, vocab_size] output logits for all time steps.
+        """
+
         input_emb = self.emb(input)
-        output = []
-        for t in range(input_emb.shape[0]):
-            output.append(self._forward_util(input_emb[t]))
+        h = []
+        with autocast(self._precision, self._device):
+            for t in range(input_emb.shape[0]):
+                h.append(self._forward_util(input_emb[t]))
+        return self._output_layer(torch.stack(h).to(self.emb.weight.dtype))
+
+    def forward_sequence(self, input):
+        """Implements forward computation of the model over a whole sequence.
+
+        The output layer runs once on the hidden outputs of all time steps, see
+        forward_hidden. With the adaptive softmax, the outputs are exact log-probabilities.
+
+        Args:
+            input: [seq_len, batch_size] input token ids.
+
+        Returns:
+            [seq_len, batch_size, vocab_size] output logits for all time steps.
+        """
+
+        return self._output_layer(self.forward_hidden(input))
+
+    def forward_hidden(self, input):
+        """Computes the hidden outputs of the last layer over a whole sequence.
+
+        With the default layer-major schedule, each layer consumes the full output sequence
+        of the layer below, so that its input projections are computed with one matmul for
+        all time steps. The time-major schedule runs every time step through all layers
+        first, and the wavefront schedule runs the layers concurrently on a thread pool,
+        see wavefront_sequence. All schedules run the same operations per time step, so
+        their outputs agree to the last bit unless the BLAS picks different kernels for
+        different row counts. With the native backend, plain LSTM stacks run in a single
+        fused torch.lstm call. With bf16 precision the matmuls run under autocast, while the
+        hidden states stay in the dtype of the parameters.
+
+        Args:
+            input: [seq_len, batch_size] input token ids.
+
+        Returns:
+            [seq_len, batch_size, hidden_size] hidden outputs of the last layer.
+        """
+
+        h = self.emb(input)
+        with autocast(self._precision, self._device):
+            if self._select_backend() == "native":
+                h, hidden = native_sequence(self._Cells, h, self._h_prev)
+                self._h_prev = [{key: value.to(self.emb.weight.dtype) for key, value in layer.items()}
+                                for layer in hidden]
+            elif self._schedule == "time":
+                h, self._h_prev = self._run_time_major(h, self._h_prev)
+            elif self._schedule == "wavefront" and len(self._Cells) > 1:
+                h, self._h_prev = wavefront_sequence(self._Cells, h, self._h_prev, self._wavefront_chunk)
+            else:
+                for i, cell in enumerate(self._Cells):
+                    h, self._h_prev[i] = cell.forward_sequence(h, self._h_prev[i])
+        return h.to(self.emb.weight.dtype)
+
+    def _run_time_major(self, input, hidden):
+        """Runs the stack of cells with the time-major schedule.
+
+        Every time step passes through all layers before the next time step starts. Each
+        step runs as a one step sequence of every cell, so the arithmetic is the same as in
+        the layer-major schedule.
+
+        Args:
+            input: [seq_len, batch_size, input_size] input sequence.
+            hidden: list of hidden state dictionaries, one per layer.
+
+        Returns:
+            [seq_len, batch_size, hidden_size] outputs of the last layer and the list of
+            last hidden state dictionaries.
+        """
+
+        hidden = list(hidden)
+        outputs = []
+        for x_t in input.unbind(0):
+            h = x_t.unsqueeze(0)
+            for i, cell in enumerate(self._Cells):
+                h, hidden[i] = cell.forward_sequence(h, hidden[i])
+            outputs.append(h)
+        return torch.cat(outputs, 0), hidden
+
+    def _output_layer(self, h):
+        """Computes the model outputs from the hidden outputs of the last layer."""
+
+        # one [seq_len * batch_size, hidden_size] x [hidden_size, vocab_size] GEMM for all steps.
+        h_flat = h.reshape(-1, h.shape[-1])
+        if self._adaptive_softmax is not None:
+            return self._adaptive_softmax.log_prob(h_flat).view(*h.shape[:-1], -1)
+
+        with autocast(self._precision, self._device):
+            if self._quantized_h2o is not None:
+                output = self._quantized_h2o(h_flat)
+            else:
+                output = torch.addmm(self._b_o, h_flat, self._W_h2o)
+        output = output.to(self._b_o.dtype).view(*h.shape[:-1], -1)
+        if self._output_activation_fn is not None:
+            output = self._output_activation_fn(output)
         return output
 
+    def output_loss(self, h, target, return_outputs=False):
+        """Returns the mean cross-entropy of the outputs of hidden states.
+
+        The loss over all time steps is a single cross-entropy call.
+
+        Args:
+            h: [seq_len, batch_size, hidden_size] hidden outputs of the last layer.
+            target: [seq_len, batch_size] target token ids.
+            return_outputs: bool, if True, also returns the [seq_len, batch_size, vocab_size]
+                outputs, e.g. for accuracies. With the adaptive softmax, these are exact
+                log-probabilities computed without gradient.
+        """
+
+        if self._adaptive_softmax is not None:
+            loss = self._adaptive_softmax(h.reshape(-1, h.shape[-1]), target.reshape(-1))
+            if not return_outputs:
+                return loss
+            with torch.no_grad():
+                return loss, self._output_layer(h)
+
+        output = self._output_layer(h)
+        loss = F.cross_entropy(output.reshape(-1, output.shape[-1]), target.reshape(-1))
+        return (loss, output) if return_outputs else loss
+
+    def log_prob(self, h):
+        """Returns the exact [seq_len, batch_size, vocab_size] log-probabilities of all tokens
+        for the hidden outputs h of the last layer."""
+
+        if self._adaptive_softmax is not None:
+            return self._output_layer(h)
+        return F.log_softmax(self._output_layer(h), dim=-1)
+
     def _forward_util(self, input):
         """Implements forward computation of the model.
 
@@ -72,7 +244,7 @@ class LanguageModel(nn.Module):
             input: current input vector.
 
         Returns:
-            model output for current time step.
+            hidden output of the last layer for current time step.
         """
         
         h = []
@@ -80,11 +252,28 @@ class LanguageModel(nn.Module):
         for i, cell in enumerate(self._Cells):
             if i != 0:
                 h.append(cell(h[i-1]["h"], self._h_prev[i]))
-        output = torch.add(torch.mm(h[-1]["h"], self._W_h2o), self._b_o)
-        if self._output_activation_fn is not None:
-            output = self._output_activation_fn(output)
         self._h_prev = h
-        return output
+        return h[-1]["h"]
+
+    def _select_backend(self):
+        """Returns the backend for forward_sequence and reports when it changes.
+
+        The native backend falls back to the python cells whenever the cells compute
+        something torch.lstm can not, e.g. once peephole weights are loaded.
+        """
+
+        backend, reason = "python", None
+        if self._backend == "native":
+            reason = native_incompatibility(self._cell_name, self._Cells, self._layer_norm)
+            if reason is None:
+                backend = "native"
+        if backend != self.backend:
+            self.backend = backend
+            if reason is None:
+                print("Backend : {}".format(backend))
+            else:
+                print("Backend : {} ({})".format(backend, reason))
+        return backend
 
     def reset_hidden(self, batch_size):
         """Resets the hidden state for truncating the dependency."""
@@ -101,8 +290,27 @@ class LanguageModel(nn.Module):
     def _reset_parameters(self):
         """Initializes the parameters."""
 
-        nn.init.xavier_normal_(self._W_h2o, gain=nn.init.calculate_gain(self._output_activation))
-        nn.init.constant_(self._b_o, 0)
+        if self._adaptive_softmax is None:
+            nn.init.xavier_normal_(self._W_h2o, gain=nn.init.calculate_gain(self._output_activation))
+            nn.init.constant_(self._b_o, 0)
+
+    def quantize(self):
+        """Converts the model for int8 dynamic quantized CPU inference.
+
+        The gate weights of every cell and the output projection are replaced by int8
+        linear layers with per output channel scales. The converted model is inference only.
+        """
+
+        assert self._cell_name in ("RNN", "LSTM", "GRU", "JANET"), \
+            "{} cells can not be quantized".format(self._cell_name)
+        assert not self._jit, "scripted cells can not be quantized"
+        assert self._adaptive_softmax is None, "the adaptive softmax can not be quantized"
+
+        self._backend = "python"
+        self._precision = "fp32"
+        self._Cells = [QuantizedCell(cell) for cell in self._Cells]
+        self._list_of_modules = nn.ModuleList(self._Cells)
+        self._quantized_h2o = quantized_linear(self._W_h2o.detach(), self._b_o.detach())
 
     def register_optimizer(self, optimizer):
         """Registers an optimizer for the model.
@@ -124,19 +332,26 @@ class LanguageModel(nn.Module):
         if self._cell_name == "RNN":
             self._Cells.append(RNNCell(self._device, input_size, hidden_size,
                                        activation=self._activation, layer_norm=self._layer_norm,
-                                       identity_init=self._identity_init))
+                                       identity_init=self._identity_init, packed=self._packed))
         elif self._cell_name == "LSTM":
             self._Cells.append(LSTMCell(self._device, input_size, hidden_size, layer_norm=self._layer_norm,
-                                        chrono_init=self._chrono_init, t_max=self._t_max))
+                                        chrono_init=self._chrono_init, t_max=self._t_max,
+                                        packed=self._packed, peephole=self._peephole,
+                                        memory_efficient=self._memory_efficient))
         elif self._cell_name == "JANET":
             self._Cells.append(JANETCell(self._device, input_size, hidden_size, layer_norm=self._layer_norm,
-                                         chrono_init=self._chrono_init, t_max=self._t_max))
+                                         chrono_init=self._chrono_init, t_max=self._t_max,
+                                         packed=self._packed, memory_efficient=self._memory_efficient))
         elif self._cell_name == "GRU":
-            self._Cells.append(GRUCell(self._device, input_size, hidden_size))
+            self._Cells.append(GRUCell(self._device, input_size, hidden_size, packed=self._packed,
+                                       memory_efficient=self._memory_efficient))
         elif self._cell_name == "FlatMemory":
             self._Cells.append(FlatMemoryCell(self._device, input_size, hidden_size, 
                                                 memory_size=self._memory_size, k=self._k, use_relu=self._use_relu))
 
+        if self._jit:
+            self._Cells[-1] = script_cell(self._Cells[-1])
+
     def save(self, save_dir):
         """Saves the model and the optimizer.
 
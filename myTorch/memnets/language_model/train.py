@@ -3,7 +3,7 @@ import math
 import argparse
 import logging
 import os
-import hashlib
+import queue
 import time
 
 import torch
@@ -16,7 +16,7 @@ from myTorch.task.copying_memory import CopyingMemoryData
 from myTorch.task.adding_task import AddingData
 from myTorch.task.denoising import DenoisingData
 from myTorch.utils.logger import Logger
-from myTorch.utils import MyContainer, get_optimizer, create_config
+from myTorch.utils import MyContainer, ArtifactCache, get_optimizer, create_config
 from myTorch.memnets.language_model import data
 from myTorch.memnets.language_model.lm import LanguageModel
 
@@ -39,129 +39,284 @@ def batchify(data, bsz):
     nbatch = data.size(0) // bsz
     # Trim off any extra elements that wouldn't cleanly fit (remainders).
     data = data.narrow(0, 0, nbatch * bsz)
-    # Evenly divide the data across the bsz batches.
-    data = data.view(bsz, -1).t().contiguous()
+    # Evenly divide the data across the bsz batches, as a view of the token store.
+    data = data.view(bsz, -1).t()
     return data
 
 def get_batch(source, i, bptt, seq_len=None, evaluation=False):
     seq_len = min(seq_len if seq_len else bptt, len(source) - 1 - i)
-    data = source[i:i+seq_len]
-    target = source[i+1:i+1+seq_len]
+    data = source[i:i+seq_len].long()
+    target = source[i+1:i+1+seq_len].long()
     done = False
     if i+seq_len > source.shape[0] or data.shape[0] < bptt:
         done = True 
     return data, target, done, i+seq_len
 
+def topk_hits(outputs, target, max_k):
+    """Returns the [max_k] float64 numbers of targets within the top 1, ..., max_k outputs.
+
+    Args:
+        outputs: [seq_len, batch_size, vocab_size] output logits or log-probabilities.
+        target: [seq_len, batch_size] target token ids.
+        max_k: int.
+    """
+
+    with torch.no_grad():
+        _, ids = torch.topk(outputs, max_k, dim=-1)
+        # the target is within the top k if it is among the first k of the top max_k.
+        hits = torch.eq(ids, target.unsqueeze(-1)).cumsum(-1)
+        return hits.reshape(-1, max_k).sum(0, dtype=torch.float64)
+
+class StreamingLMStats(object):
+    """Token-weighted cross-entropy and top-k accuracies of a split, accumulated on the
+    device of the model so that no step waits for a device to host copy."""
+
+    def __init__(self, device, ks=(1, 2, 3, 5)):
+        self._ks = list(ks)
+        self._loss = torch.zeros((), dtype=torch.float64, device=device)
+        self._hits = torch.zeros(max(self._ks), dtype=torch.float64, device=device)
+        self._num_tokens = 0
+
+    def update(self, loss, outputs, target):
+        """Adds a window with mean cross-entropy loss, outputs and target token ids."""
+
+        self._loss += loss.double() * target.numel()
+        self._hits += topk_hits(outputs, target, max(self._ks))
+        self._num_tokens += target.numel()
+
+    def result(self):
+        """Returns a dict with the loss, BPC, perplexity and acc_at_k of the split."""
+
+        loss = self._loss.item() / max(self._num_tokens, 1)
+        hits = (self._hits * 100.0 / max(self._num_tokens, 1)).tolist()
+        return {"loss": loss, "bpc": loss / math.log(2), "perplexity": _safe_exp(loss),
+                "acc_at_k": {k: hits[k - 1] for k in self._ks}}
+
 def get_batched_data(config):
-    fn = 'corpus.{}.data'.format(hashlib.md5(config.data.encode()).hexdigest())
-    if os.path.exists(fn):
-        print('Loading cached dataset...')
-        corpus = torch.load(fn)
-    else:
-        print('Producing dataset...')
-        corpus = data.Corpus(config.data)
-        torch.save(corpus, fn)
+    store_dir = ArtifactCache().get("corpus", data.source_files(config.data),
+                                    lambda store_dir: data.Corpus(config.data, store_dir),
+                                    tokenizer=data.TOKENIZER_VERSION)
+    corpus = data.Corpus(config.data, store_dir)
 
     batched_data = {}
     batched_data["train"] = batchify(corpus.train, config.batch_size)
-    batched_data["valid"] = batchify(corpus.valid, config.eval_batch_size)
-    batched_data["test"] = batchify(corpus.test, config.test_batch_size)
+    batched_data["valid"] = batchify(corpus.valid, config.inference_batch_size or config.eval_batch_size)
+    batched_data["test"] = batchify(corpus.test, config.inference_batch_size or config.test_batch_size)
     vocab = corpus.dictionary
     print("Vocab size : {}".format(len(vocab)))
     return batched_data, vocab
 
 
 
-def run_epoch(epoch_id, mode, experiment, model, config, batched_data, tr, logger, device):
-    """Training loop.
+def run_epoch(epoch_id, experiment, model, config, batched_data, tr, logger, device):
+    """Training loop over one epoch of the train split.
+
+    The epoch loss is weighted by tokens, as in evaluate, and the accuracies are those of
+    the windows of every config.acc_every_n-th update.
 
     Args:
         experiment: experiment object.
         model: model object.
         config: config dictionary.
-        data_iterator: data iterator object
+        batched_data: dict of batchified splits.
         tr: training statistics dictionary.
         logger: logger object.
     """
 
-    assert(mode == "train" or mode == "test" or mode == "valid")
-    if mode == "train":
-        batch_size = config.batch_size
-    elif mode == "valid":
-        batch_size = config.eval_batch_size
-    elif mode == "test":
-        batch_size = config.test_batch_size
-
-    batched_data[mode] = batched_data[mode].to(device)
-
-    model.reset_hidden(batch_size=batch_size)
+    mode = "train"
+    model.reset_hidden(batch_size=config.batch_size)
     num_total_words = batched_data[mode].shape[0] * batched_data[mode].shape[1]
     done = False
     step = 0
-    curr_epoch_loss = []
-    curr_epoch_acc_at_k = {1: [], 2:[], 3:[], 5:[]}
+    epoch_loss, num_tokens = 0.0, 0
+    acc_stats = StreamingLMStats(device)
     start_time = time.time()
     while not done:
         model.repackage_hidden()
 
         x, y, done, tr.mini_batch_id[mode] = get_batch(batched_data[mode], tr.mini_batch_id[mode], config.bptt)
-        seqloss = 0
-        output_logits = model(x)
-
-        curr_time_steps = y.shape[0]
-        for i in range(curr_time_steps):
-            seqloss += F.cross_entropy(output_logits[i], y[i])
-        seqloss /= curr_time_steps
-
-        # accuracy computation
-        def _acc_at_k(k):
-            _, ids = torch.topk(torch.stack(output_logits,dim=0),k,dim=2)
-            eq_vec = torch.eq(y.unsqueeze(-1).expand_as(ids), ids).double()
-            acc = torch.mean(torch.sum(eq_vec, dim=-1)).cpu().item()*100.0
-            return acc
-
-        for k in curr_epoch_acc_at_k:
-            curr_epoch_acc_at_k[k].append(_acc_at_k(k))
-        
+        if y.numel() == 0:
+            break
+        x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
+
+        h = model.forward_hidden(x)
+        # the training accuracies are only computed every acc_every_n updates.
+        if config.acc_every_n and step % config.acc_every_n == 0:
+            seqloss, output_logits = model.output_loss(h, y, return_outputs=True)
+            acc_stats.update(seqloss.detach(), output_logits, y)
+        else:
+            seqloss = model.output_loss(h, y)
+
         tr.average_loss[mode].append(seqloss.item())
-        curr_epoch_loss.append(seqloss.item())
+        epoch_loss += tr.average_loss[mode][-1] * y.numel()
+        num_tokens += y.numel()
 
         running_average = sum(tr.average_loss[mode]) / len(tr.average_loss[mode])
 
-        if config.use_tflogger and mode == "train":
+        if config.use_tflogger:
             logger.log_scalar("running_avg_loss", running_average, tr.updates_done[mode] + 1)
             logger.log_scalar("loss", tr.average_loss[mode][-1], tr.updates_done[mode] + 1)
             logger.log_scalar("running_perplexity", _safe_exp(running_average), tr.updates_done[mode] + 1)
             logger.log_scalar("inst_perplexity", _safe_exp(tr.average_loss[mode][-1]), tr.updates_done[mode] + 1)
 
-        if mode == "train":
-            model.optimizer.zero_grad()
-            seqloss.backward(retain_graph=False)
-            torch.nn.utils.clip_grad_norm(model.parameters(), config.grad_clip_norm)
-            model.optimizer.step()
+        model.optimizer.zero_grad()
+        seqloss.backward(retain_graph=False)
+        torch.nn.utils.clip_grad_norm_(model.parameters(), config.grad_clip_norm)
+        model.optimizer.step()
 
         tr.updates_done[mode] +=1
         step += 1
-        if tr.updates_done[mode] % 1e6 == 0 and mode == "train":
-            logging.info("Epoch : {}, {} %: {}, step : {}, time : {}".format(epoch_id, mode, (100.0*step*batch_size*curr_time_steps/num_total_words), tr.updates_done[mode], time.time() -start_time))
+        if tr.updates_done[mode] % 1e6 == 0:
+            logging.info("Epoch : {}, {} %: {}, step : {}, time : {}".format(epoch_id, mode, (100.0*num_tokens/num_total_words), tr.updates_done[mode], time.time() -start_time))
             logging.info("inst loss: {}, inst perp: {}".format(tr.average_loss[mode][-1], _safe_exp(tr.average_loss[mode][-1])))
-            
-    curr_epoch_avg_loss = np.mean(np.array(curr_epoch_loss))
+
+    curr_epoch_avg_loss = epoch_loss / max(num_tokens, 1)
     tr.average_loss_per_epoch[mode].append(curr_epoch_avg_loss)
-    for k in curr_epoch_acc_at_k:
-        curr_epoch_acc_at_k[k] = np.mean(np.array(curr_epoch_acc_at_k[k]))
+    if config.acc_every_n:
+        curr_epoch_acc_at_k = acc_stats.result()["acc_at_k"]
+    else:
+        curr_epoch_acc_at_k = {k: float("nan") for k in (1, 2, 3, 5)}
     tr.acc_at_k_per_epoch[mode].append(curr_epoch_acc_at_k)
 
-    logging.info("Avg {} loss: {}, BPC : {}, Avg perp: {}, time : {}".format(mode, curr_epoch_avg_loss, curr_epoch_avg_loss/0.693, _safe_exp(curr_epoch_avg_loss), time.time() - start_time))
+    logging.info("Avg {} loss: {}, BPC : {}, Avg perp: {}, time : {}".format(mode, curr_epoch_avg_loss, curr_epoch_avg_loss/math.log(2), _safe_exp(curr_epoch_avg_loss), time.time() - start_time))
 
     for k in curr_epoch_acc_at_k:
         logging.info("Acc at {} : {}".format(k, curr_epoch_acc_at_k[k]))
 
-    batched_data[mode] = batched_data[mode].to("cpu")
 
-    if mode != "train":
-        logger.log_scalar("loss_{}".format(mode), curr_epoch_avg_loss, epoch_id+1)
-        logger.log_scalar("perplexity_{}".format(mode), _safe_exp(curr_epoch_avg_loss), epoch_id+1)
+def evaluate(model, config, source, device):
+    """Evaluates the model on a batchified split, without building any graph.
+
+    The model runs under torch.inference_mode, or torch.no_grad for scripted cells, on
+    windows of config.bptt time steps with the hidden state carried over, and the loss
+    and accuracies are accumulated with StreamingLMStats.
+
+    Args:
+        model: LanguageModel.
+        config: config dictionary.
+        source: [num_steps, batch_size] token ids, see batchify.
+        device: torch device of the model.
+
+    Returns:
+        the result dict of StreamingLMStats, with the evaluation time.
+    """
+
+    start_time = time.time()
+    stats = StreamingLMStats(device)
+    with torch.no_grad() if config.jit else torch.inference_mode():
+        model.reset_hidden(batch_size=source.shape[1])
+        i, done = 0, False
+        while not done:
+            x, y, done, i = get_batch(source, i, config.bptt)
+            if y.numel() == 0:
+                break
+            x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
+            loss, outputs = model.output_loss(model.forward_hidden(x), y, return_outputs=True)
+            stats.update(loss, outputs, y)
+
+    result = stats.result()
+    result["time"] = time.time() - start_time
+    return result
+
+def log_evaluation(epoch_id, mode, result, config, tr, logger):
+    """Logs the evaluation result of an epoch and stores it in the training statistics."""
+
+    tr.average_loss_per_epoch[mode].append(result["loss"])
+    tr.acc_at_k_per_epoch[mode].append(result["acc_at_k"])
+
+    logging.info("Epoch : {}, avg {} loss: {}, BPC : {}, Avg perp: {}, time : {}".format(
+        epoch_id, mode, result["loss"], result["bpc"], result["perplexity"], result["time"]))
+    for k in result["acc_at_k"]:
+        logging.info("Acc at {} : {}".format(k, result["acc_at_k"][k]))
+
+    if config.use_tflogger:
+        logger.log_scalar("loss_{}".format(mode), result["loss"], epoch_id+1)
+        logger.log_scalar("perplexity_{}".format(mode), result["perplexity"], epoch_id+1)
+
+
+def _evaluation_worker(config_dict, tasks, results):
+    """Evaluates the weight snapshots of the tasks queue on the valid and test splits."""
+
+    config = MyContainer()
+    config.add_from_dict(config_dict)
+    device = torch.device(config.device)
+    batched_data, vocab = get_batched_data(config)
+    model = create_model(config, vocab, device)
+
+    for epoch_id, state_dict in iter(tasks.get, None):
+        model.load_state_dict(state_dict)
+        for mode in ["valid", "test"]:
+            results.put((epoch_id, mode, evaluate(model, config, batched_data[mode], device)))
+
+
+class BackgroundEvaluator(object):
+    """Evaluates snapshots of the model weights in a background process.
+
+    Training goes on while a snapshot is evaluated. The process loads the data from the
+    artifact cache and builds its own model, and the results come back in order of the
+    snapshots.
+    """
+
+    def __init__(self, config):
+        """Starts the evaluation process.
+
+        Args:
+            config: config dictionary.
+        """
+
+        context = torch.multiprocessing.get_context("spawn")
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._pending = 0
+        self._process = context.Process(target=_evaluation_worker,
+                                        args=(dict(config.get()), self._tasks, self._results), daemon=True)
+        self._process.start()
+
+    def submit(self, epoch_id, model):
+        """Queues the evaluation of a snapshot of the current weights of the model."""
+
+        state_dict = {key: value.detach().to("cpu", copy=True) for key, value in model.state_dict().items()}
+        self._tasks.put((epoch_id, state_dict))
+        self._pending += 2
+
+    def results(self, block=False):
+        """Returns the available (epoch_id, mode, result) evaluations, or all of them if block."""
+
+        results = []
+        while self._pending > 0 and (block or not self._results.empty()):
+            try:
+                results.append(self._results.get(timeout=1.0))
+            except queue.Empty:
+                assert self._process.is_alive(), "the evaluation process died"
+                continue
+            self._pending -= 1
+        return results
+
+    def close(self):
+        """Waits for the pending evaluations and stops the process."""
+
+        results = self.results(block=True)
+        self._tasks.put(None)
+        self._process.join()
+        return results
+
+
+def create_model(config, vocab, device):
+    """Creates the language model of config for a vocabulary."""
+
+    return LanguageModel(device, len(vocab), config.input_emb_size,
+                      num_layers=config.num_layers, layer_size=config.layer_size,
+                      cell_name=config.model, activation=config.activation,
+                      output_activation="linear", layer_norm=config.layer_norm,
+                      identity_init=config.identity_init, chrono_init=config.chrono_init,
+                      t_max=config.bptt/3, memory_size=config.memory_size, k=config.k, use_relu=config.use_relu,
+                      packed=config.packed_weights, jit=config.jit,
+                      peephole=not config.no_peephole, backend=config.backend,
+                      memory_efficient=config.memory_efficient, precision=config.precision,
+                      schedule=config.schedule, wavefront_chunk=config.wavefront_chunk,
+                      output_layer=config.output_layer,
+                      token_counts=[vocab.counter[i] for i in range(len(vocab))],
+                      adaptive_cutoffs=config.adaptive_cutoffs).to(device)
 
 
 def create_experiment(config):
@@ -171,24 +326,16 @@ def create_experiment(config):
     logging.info("using {}".format(config.device))
 
     experiment = Experiment(config.name, config.save_dir)
-    experiment.register_config(config)
 
     logger = None
     if config.use_tflogger:
         logger = Logger(config.tflog_dir)
-        experiment.register_logger(logger)
 
     torch.manual_seed(config.rseed)
 
     batch_data, vocab = get_batched_data(config)
-    
-    model = LanguageModel(device, len(vocab), config.input_emb_size,
-                      num_layers=config.num_layers, layer_size=config.layer_size,
-                      cell_name=config.model, activation=config.activation,
-                      output_activation="linear", layer_norm=config.layer_norm,
-                      identity_init=config.identity_init, chrono_init=config.chrono_init,
-                      t_max=config.bptt/3, memory_size=config.memory_size, k=config.k, use_relu=config.use_relu).to(device)
-    experiment.register_model(model)
+
+    model = create_model(config, vocab, device)
 
     optimizer = get_optimizer(model.parameters(), config)
     model.register_optimizer(optimizer)
@@ -204,9 +351,8 @@ def create_experiment(config):
         tr.average_loss[mode] = []
         tr.average_loss_per_epoch[mode] = []
         tr.acc_at_k_per_epoch[mode] = []
-        
 
-    experiment.register_train_statistics(tr)
+    experiment.register_experiment(model=model, config=config, logger=logger, train_statistics=tr)
 
     return experiment, model, batch_data, tr, logger, device
 
@@ -227,11 +373,24 @@ def run_experiment(args):
     else:
         experiment.force_restart()
 
+    evaluator = BackgroundEvaluator(config) if config.background_eval else None
+
     for i in range(config.num_epochs):
         logging.info("\n#####################\n Epoch id: {}\n".format(i+1))
-        for mode in ["train", "valid", "test"]:
-            tr.mini_batch_id[mode] = 0
-            run_epoch(i, mode, experiment, model, config, batched_data, tr, logger, device)
+        tr.mini_batch_id["train"] = 0
+        run_epoch(i, experiment, model, config, batched_data, tr, logger, device)
+
+        if evaluator is not None:
+            evaluator.submit(i, model)
+            for epoch_id, mode, result in evaluator.results():
+                log_evaluation(epoch_id, mode, result, config, tr, logger)
+        else:
+            for mode in ["valid", "test"]:
+                log_evaluation(i, mode, evaluate(model, config, batched_data[mode], device), config, tr, logger)
+
+    if evaluator is not None:
+        for epoch_id, mode, result in evaluator.close():
+            log_evaluation(epoch_id, mode, result, config, tr, logger)
 
     logging.info("\n#####################\n Best Model\n")
     min_id = np.argmin(np.array(tr.average_loss_per_epoch["valid"]))
@@ -2,9 +2,20 @@ import os
 
 from myTorch.utils import MyContainer
 from myTorch.memnets.train import create_experiment
+from myTorch.memnets.language_model import train as lm_train
 
 
-def load_experiment(save_dir):
+def load_experiment(save_dir, quantized=False):
+    """Loads a trained experiment for evaluation on cpu.
+
+    No int8 checkpoint is saved: with quantized=True the float checkpoint is loaded and
+    converted again with model.quantize(), which only takes the time of one pass over
+    the weights.
+
+    Args:
+        save_dir: absolute path to the experiment dir.
+        quantized: bool, if True, converts the model for int8 dynamic quantized inference.
+    """
 
     config = MyContainer()
     file_name = os.path.join(save_dir, "current", "config.p")
@@ -31,5 +42,38 @@ def load_experiment(save_dir):
 
     experiment.resume()
 
+    if quantized:
+        model.quantize()
+
     return experiment, model, data_iterator, device, config
 
+
+
+def load_lm_experiment(save_dir, quantized=False):
+    """Loads a trained language model experiment for evaluation on cpu.
+
+    As with load_experiment, a quantized model is converted from the float checkpoint.
+
+    Args:
+        save_dir: absolute path to the experiment dir.
+        quantized: bool, if True, converts the model for int8 dynamic quantized inference.
+
+    Returns:
+        the experiment, the model, the dict of batchified splits, the device and the config.
+    """
+
+    config = MyContainer()
+    config.load(os.path.join(save_dir, "current", "config.p"))
+
+    config.device = "cpu"
+    config.use_tflogger = False
+    config.save_dir = save_dir
+
+    experiment, model, batched_data, tr, logger, device = lm_train.create_experiment(config)
+
+    experiment.resume()
+
+    if quantized:
+        model.quantize()
+
+    return experiment, model, batched_data, device, config
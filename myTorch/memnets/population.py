@@ -0,0 +1,165 @@
+"""Vectorized training of a population of Recurrent replicas in one process."""
+import os
+
+import torch
+import torch.nn as nn
+from torch.func import functional_call, vmap
+
+from myTorch.memory.precision import autocast
+
+
+class _ReplicaSequence(nn.Module):
+    """Exposes the stateless sequence computation of a Recurrent model as forward."""
+
+    def __init__(self, model):
+        super(_ReplicaSequence, self).__init__()
+        self.model = model
+
+    def forward(self, input, hidden):
+        h, hidden = self.model._run_cells(input, hidden)
+        return self.model._output_layer(h), hidden
+
+
+class Population(object):
+    """N replicas of a Recurrent model, e.g. with different seeds or learning rates.
+
+    Every replica keeps its own parameters and its own registered optimizer. The forward
+    pass stacks the replica parameters along a leading dimension and runs the sequence
+    once under vmap, so that the small per replica matmuls of every time step become one
+    batched matmul. The stacked parameters are differentiable views of the replicas, so
+    backward deposits the gradients into each replica.
+    """
+
+    def __init__(self, models, configs=None):
+        """Initializes a population.
+
+        Args:
+            models: list of Recurrent models with the same architecture and a registered
+                optimizer each. They run with the python backend, without jit, checkpointing
+                or memory efficient cells.
+            configs: optional list of per replica config objects, saved with the replicas.
+        """
+
+        for model in models:
+            assert model._backend == "python" and not model._jit, \
+                "population replicas need the python backend without jit"
+            assert not model._memory_efficient, "memory efficient cells do not support vmap"
+            assert model._schedule != "wavefront", "vmap does not support the wavefront threads"
+
+        self.models = models
+        self._configs = configs
+        self._template = _ReplicaSequence(models[0])
+
+    def __len__(self):
+        return len(self.models)
+
+    def _stacked_state(self):
+        """Returns the replica parameters and buffers stacked along a leading dimension."""
+
+        replicas = [dict(_ReplicaSequence(model).named_parameters()) for model in self.models]
+        state = {name: torch.stack([replica[name] for replica in replicas]) for name in replicas[0]}
+        replicas = [dict(_ReplicaSequence(model).named_buffers()) for model in self.models]
+        state.update({name: torch.stack([replica[name] for replica in replicas]) for name in replicas[0]})
+        return state
+
+    def forward_sequence(self, input):
+        """Implements forward computation of all replicas over a whole sequence.
+
+        Args:
+            input: [seq_len, batch_size, input_size] input sequence, shared by the replicas.
+
+        Returns:
+            [num_replicas, seq_len, batch_size, output_size] outputs of every replica.
+        """
+
+        def run(state, hidden):
+            return functional_call(self._template, state, (input, hidden))
+
+        with autocast(self.models[0]._precision, self.models[0]._device):
+            outputs, self._h_prev = vmap(run)(self._stacked_state(), self._h_prev)
+        return outputs
+
+    def reset_hidden(self, batch_size):
+        """Resets the hidden state of every replica."""
+
+        self._h_prev = []
+        for cell in self.models[0]._Cells:
+            hidden = cell.reset_hidden(batch_size)
+            self._h_prev.append({key: value.expand(len(self), *value.shape).contiguous()
+                                 for key, value in hidden.items()})
+
+    def detach_hidden(self):
+        """Detaches the hidden state from the graph for truncating the backpropagation."""
+
+        self._h_prev = [{key: value.detach() for key, value in last_hidden.items()}
+                        for last_hidden in self._h_prev]
+
+    def save(self, save_dir):
+        """Saves every replica as an individual model.p and optim.p.
+
+        Replica i is saved in `save_dir/replica_i`, together with its config when the
+        population has per replica configs.
+
+        Args:
+            save_dir: absolute path to saving dir.
+        """
+
+        for i, model in enumerate(self.models):
+            replica_dir = os.path.join(save_dir, "replica_{}".format(i))
+            os.makedirs(replica_dir, exist_ok=True)
+            model.save(replica_dir)
+            if self._configs is not None:
+                self._configs[i].save(os.path.join(replica_dir, "config.p"))
+
+    def load(self, save_dir):
+        """Loads every replica saved by save.
+
+        Args:
+            save_dir: absolute path to loading dir.
+        """
+
+        for i, model in enumerate(self.models):
+            model.load(os.path.join(save_dir, "replica_{}".format(i)))
+
+
+def population_update(population, x, window_loss, grad_clip_norm=None):
+    """Trains every replica of a population on one batch of sequences.
+
+    Args:
+        population: Population with an initialized hidden state.
+        x: [seq_len, batch_size, input_size] input sequence.
+        window_loss: function (outputs, start) -> (masked loss summed over the steps of
+            `outputs`, float sum of the masks), as for tbptt_update. It is vmapped over
+            the replicas.
+        grad_clip_norm: float, if not None, clips the gradient norm of each replica.
+
+    Returns:
+        list of the masked losses and list of the gradient norms, one per replica. The
+        gradient norms are empty if the masks of the batch are all zero.
+    """
+
+    def replica_loss(outputs):
+        loss, weight = window_loss(outputs, 0)
+        return loss, torch.tensor(weight)
+
+    outputs = population.forward_sequence(x)
+    losses, weights = vmap(replica_loss)(outputs)
+    weight = weights[0].item()
+    # as in tbptt_update, a batch whose masks are all zero gives no update.
+    if weight == 0:
+        population.detach_hidden()
+        return [0.0] * len(population.models), []
+
+    for model in population.models:
+        model.optimizer.zero_grad()
+    # the replicas share no parameters, so the summed loss gives each replica its own gradients.
+    (losses.sum() / weight).backward()
+
+    grad_norms = []
+    for model in population.models:
+        if grad_clip_norm is not None:
+            grad_norms.append(torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip_norm).item())
+        model.optimizer.step()
+
+    population.detach_hidden()
+    return (losses.detach() / weight).tolist(), grad_norms
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Reports the accuracy and speed of the int8 quantized model against the float model."""
+import argparse
+import time
+
+import numpy
+import torch
+import torch.nn.functional as F
+
+from myTorch.memnets.load import load_experiment, load_lm_experiment
+from myTorch.memnets.language_model import train as lm_train
+
+parser = argparse.ArgumentParser(description="Int8 quantization report")
+parser.add_argument("--save_dir", type=str, required=True, help="absolute path to the experiment dir.")
+parser.add_argument("--num_batches", type=int, default=100, help="number of evaluation batches.")
+parser.add_argument("--language_model", action="store_true", help="if set, save_dir is a language model experiment.")
+
+
+def evaluate(model, config, batches, device):
+    """Returns the masked loss, the accuracy and the forward time in seconds over the batches."""
+
+    total_loss, total_mask, correct, num_outputs, forward_time = 0.0, 0.0, 0.0, 0.0, 0.0
+
+    with torch.inference_mode():
+        for data in batches:
+            model.reset_hidden(batch_size=config.batch_size)
+            x = torch.from_numpy(numpy.asarray(data['x'])).to(device)
+
+            start = time.perf_counter()
+            outputs = model.forward_sequence(x)
+            forward_time += time.perf_counter() - start
+
+            for i in range(0, data["datalen"]):
+                mask = float(data["mask"][i])
+                if mask == 0:
+                    continue
+
+                y = torch.from_numpy(numpy.asarray(data['y'][i])).to(device)
+                output = outputs[i]
+                if config.task == "copying_memory" or config.task == "denoising_copy":
+                    loss = F.cross_entropy(output, y.squeeze(1))
+                    correct += (output.argmax(1) == y.squeeze(1)).float().mean().item() * mask
+                    num_outputs += mask
+                elif config.task == "adding":
+                    loss = F.mse_loss(output, y)
+                else:
+                    loss = F.binary_cross_entropy_with_logits(output, y)
+                    correct += ((output > 0).float() == y).float().mean().item() * mask
+                    num_outputs += mask
+
+                total_loss += loss.item() * mask
+                total_mask += mask
+
+    accuracy = correct / num_outputs if num_outputs > 0 else float("nan")
+    return total_loss / total_mask, accuracy, forward_time
+
+
+def lm_report(args):
+    """Reports the valid split metrics of a language model, on its first num_batches windows."""
+
+    experiment, model, batched_data, device, config = load_lm_experiment(args.save_dir)
+    source = batched_data["valid"][:args.num_batches * config.bptt + 1]
+
+    results = {}
+    results["float"] = lm_train.evaluate(model, config, source, device)
+    model.quantize()
+    results["int8"] = lm_train.evaluate(model, config, source, device)
+
+    for name in ("float", "int8"):
+        result = results[name]
+        print("{:5} : loss {:.6f}, BPC {:.4f}, perplexity {:.3f}, acc@1 {:.4f}, time {:.3f}s".format(
+            name, result["loss"], result["bpc"], result["perplexity"], result["acc_at_k"][1], result["time"]))
+    print("delta : loss {:+.6f}, BPC {:+.4f}, perplexity {:+.3f}, acc@1 {:+.4f}, speedup {:.2f}x".format(
+        results["int8"]["loss"] - results["float"]["loss"], results["int8"]["bpc"] - results["float"]["bpc"],
+        results["int8"]["perplexity"] - results["float"]["perplexity"],
+        results["int8"]["acc_at_k"][1] - results["float"]["acc_at_k"][1],
+        results["float"]["time"] / results["int8"]["time"]))
+
+
+def main():
+    args = parser.parse_args()
+    if args.language_model:
+        lm_report(args)
+        return
+
+    experiment, model, data_iterator, device, config = load_experiment(args.save_dir)
+    # the tasks generate their data, so fresh batches are held out from training.
+    batches = [data_iterator.next() for _ in range(args.num_batches)]
+
+    float_loss, float_accuracy, float_time = evaluate(model, config, batches, device)
+    model.quantize()
+    int8_loss, int8_accuracy, int8_time = evaluate(model, config, batches, device)
+
+    print("float : loss {:.6f}, accuracy {:.4f}, forward {:.3f}s".format(float_loss, float_accuracy, float_time))
+    print("int8  : loss {:.6f}, accuracy {:.4f}, forward {:.3f}s".format(int8_loss, int8_accuracy, int8_time))
+    print("delta : loss {:+.6f}, accuracy {:+.4f}, speedup {:.2f}x".format(
+        int8_loss - float_loss, int8_accuracy - float_accuracy, float_time / int8_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,19 +3,33 @@ import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from myTorch.memory import RNNCell, GRUCell, LSTMCell, JANETCell
+from myTorch.memory.native import native_incompatibility, native_sequence
+from myTorch.memory.precision import autocast, check_precision
+from myTorch.memory.quantized import QuantizedCell, quantized_linear
+from myTorch.memory.scripting import script_cell
+from myTorch.memory.wavefront import wavefront_sequence
 from myTorch.memnets.FlatMemoryCell import FlatMemoryCell
 from myTorch.memnets.SRUCell import SRUCell
 
 
+def window_lengths(lengths, start, end):
+    """Returns the number of valid time steps of each example within the window [start, end)."""
+
+    return (torch.as_tensor(lengths) - start).clamp(0, end - start)
+
+
 class Recurrent(nn.Module):
     """Implementation of a generic Recurrent Network."""
 
     def __init__(self, device, input_size, output_size, num_layers=1, layer_size=[10],
                  cell_name="LSTM", activation="tanh", output_activation="linear",
                  layer_norm=False, identity_init=False, chrono_init=False, t_max=10, use_relu=False,
-                 memory_size=64, k=4, phi_size=256, r_size=64):
+                 memory_size=64, k=4, phi_size=256, r_size=64, packed=False, jit=False,
+                 peephole=True, backend="python", checkpoint_chunk=0, memory_efficient=False,
+                 precision="fp32", schedule="layer", wavefront_chunk=16, sru_feedback_lag=1):
         """Initializes a recurrent network."""
         
         super(Recurrent, self).__init__()
@@ -37,6 +51,24 @@ class Recurrent(nn.Module):
         self._k = k
         self._phi_size = phi_size
         self._r_size = r_size
+        self._packed = packed
+        self._jit = jit
+        self._peephole = peephole
+        self._memory_efficient = memory_efficient
+        self._precision = check_precision(precision)
+        self._schedule = schedule or "layer"
+        self._wavefront_chunk = wavefront_chunk or 16
+        self._sru_feedback_lag = sru_feedback_lag or 1
+        assert self._schedule in ("layer", "time", "wavefront"), "schedule must be layer, time or wavefront"
+        assert not (self._schedule != "layer" and backend == "native"), "the native backend is layer-major"
+        self._backend = backend
+        self.backend = None
+        self._checkpoint_chunk = checkpoint_chunk or 0
+        # the recomputation of scripted cells does not reproduce the tensors saved by their first run.
+        assert not (self._jit and self._checkpoint_chunk > 0), "checkpoint_chunk is not supported with jit"
+        # the checkpoint contexts are thread local and do not reach the wavefront workers.
+        assert not (self._schedule == "wavefront" and self._checkpoint_chunk > 0), \
+            "checkpoint_chunk is not supported with the wavefront schedule"
 
         self._Cells = []
 
@@ -55,6 +87,7 @@ class Recurrent(nn.Module):
 
         self._W_h2o = nn.Parameter(torch.Tensor(layer_size[-1], output_size))
         self._b_o = nn.Parameter(torch.Tensor(output_size))
+        self._quantized_h2o = None
 
         self._reset_parameters()
         self.print_num_parameters()
@@ -69,17 +102,215 @@ class Recurrent(nn.Module):
             model output for current time step.
         """
         
-        h = []
-        h.append(self._Cells[0](input, self._h_prev[0]))
+        with autocast(self._precision, self._device):
+            h = []
+            h.append(self._Cells[0](input, self._h_prev[0]))
+            for i, cell in enumerate(self._Cells):
+                if i != 0:
+                    h.append(cell(h[i-1]["h"], self._h_prev[i]))
+            output = self._output_layer(h[-1]["h"])
+        self._h_prev = h
+        return output
+
+    def forward_sequence(self, input, lengths=None):
+        """Implements forward computation of the model over a whole sequence.
+
+        With the default layer-major schedule, each layer consumes the full output sequence
+        of the layer below, so that its input projections are computed with one matmul for
+        all time steps. The time-major schedule runs every time step through all layers
+        first, and the wavefront schedule runs the layers concurrently on a thread pool,
+        see wavefront_sequence. All schedules run the same operations per time step, so
+        their outputs agree to the last bit unless the BLAS picks different kernels for
+        different row counts, and all run the output layer once on all time steps. With the
+        native backend, plain LSTM stacks run in a single fused torch.lstm call. With bf16
+        precision the matmuls run under autocast, while the hidden state and the outputs
+        stay in the dtype of the parameters.
+
+        With per example lengths, the hidden state of an example is frozen once its
+        sequence ends and no computation is spent on the padding, see _run_packed.
+
+        Args:
+            input: [seq_len, batch_size, input_size] input sequence.
+            lengths: optional [batch_size] int tensor, number of valid time steps per example.
+
+        Returns:
+            [seq_len, batch_size, output_size] model outputs for all time steps. The outputs
+            of padding time steps are computed from zero hidden outputs.
+        """
+
+        with autocast(self._precision, self._device):
+            if self._checkpoint_chunk > 0 and torch.is_grad_enabled():
+                return self._checkpointed_sequence(input, lengths)
+
+            h, self._h_prev = self._run_cells(input, self._h_prev, lengths)
+            return self._output_layer(h)
+
+    def _run_cells(self, input, hidden, lengths=None):
+        """Runs the stack of cells over a sequence.
+
+        Args:
+            input: [seq_len, batch_size, input_size] input sequence.
+            hidden: list of hidden state dictionaries, one per layer.
+            lengths: optional [batch_size] int tensor, number of valid time steps per example.
+
+        Returns:
+            [seq_len, batch_size, hidden_size] outputs of the last layer and the list of
+            last hidden state dictionaries.
+        """
+
+        if lengths is not None:
+            return self._run_packed(input, hidden, lengths)
+
+        h = input
+        if self._select_backend() == "native":
+            h, hidden = native_sequence(self._Cells, h, hidden)
+            return h, [{key: value.to(self._b_o.dtype) for key, value in layer.items()} for layer in hidden]
+        if self._schedule == "time":
+            return self._run_time_major(h, hidden)
+        if self._schedule == "wavefront" and len(self._Cells) > 1:
+            return wavefront_sequence(self._Cells, h, hidden, self._wavefront_chunk)
+
+        hidden = list(hidden)
         for i, cell in enumerate(self._Cells):
-            if i != 0:
-                h.append(cell(h[i-1]["h"], self._h_prev[i]))
-        output = torch.add(torch.mm(h[-1]["h"], self._W_h2o), self._b_o)
+            h, hidden[i] = cell.forward_sequence(h, hidden[i])
+        return h, hidden
+
+    def _run_time_major(self, input, hidden):
+        """Runs the stack of cells with the time-major schedule.
+
+        Every time step passes through all layers before the next time step starts. Each
+        step runs as a one step sequence of every cell, so the arithmetic is the same as in
+        the layer-major schedule.
+
+        Args:
+            input: [seq_len, batch_size, input_size] input sequence.
+            hidden: list of hidden state dictionaries, one per layer.
+
+        Returns:
+            [seq_len, batch_size, hidden_size] outputs of the last layer and the list of
+            last hidden state dictionaries.
+        """
+
+        hidden = list(hidden)
+        outputs = []
+        for x_t in input.unbind(0):
+            h = x_t.unsqueeze(0)
+            for i, cell in enumerate(self._Cells):
+                h, hidden[i] = cell.forward_sequence(h, hidden[i])
+            outputs.append(h)
+        return torch.cat(outputs, 0), hidden
+
+    def _run_packed(self, input, hidden, lengths):
+        """Runs the stack of cells over a padded batch of variable length sequences.
+
+        The examples are sorted by decreasing length, so that the examples still running
+        at any time step are a prefix of the batch. Between two consecutive lengths the
+        number of running examples is constant, and that span of time steps runs as one
+        sequence on the prefix of the batch. The hidden state of finished examples is
+        carried unchanged and the time loop stops once the longest example ends.
+
+        Args:
+            input: [seq_len, batch_size, input_size] padded input sequence.
+            hidden: list of hidden state dictionaries, one per layer.
+            lengths: [batch_size] int tensor, number of valid time steps per example.
+
+        Returns:
+            [seq_len, batch_size, hidden_size] outputs of the last layer, zero after the end
+            of each example, and the list of hidden state dictionaries at the end of each example.
+        """
+
+        seq_len, batch_size = input.shape[0], input.shape[1]
+        lengths, order = torch.as_tensor(lengths).clamp(max=seq_len).sort(descending=True)
+        order = order.to(input.device)
+        input = input.index_select(1, order)
+        hidden = [{key: value.index_select(0, order) for key, value in layer.items()} for layer in hidden]
+
+        outputs, start = [], 0
+        for end in sorted(set(lengths.tolist()) - {0}):
+            num_running = int((lengths >= end).sum())
+            running = [{key: value[:num_running] for key, value in layer.items()} for layer in hidden]
+            h, running = self._run_cells(input[start:end, :num_running], running)
+            outputs.append(F.pad(h, (0, 0, 0, batch_size - num_running)))
+            hidden = [{key: torch.cat((running[i][key], value[num_running:]), 0) for key, value in layer.items()}
+                      for i, layer in enumerate(hidden)]
+            start = end
+        if start < seq_len:
+            outputs.append(input.new_zeros(seq_len - start, batch_size, self._layer_size[-1]))
+
+        inverse = torch.empty_like(order)
+        inverse[order] = torch.arange(batch_size, device=order.device)
+        h = torch.cat(outputs, 0).index_select(1, inverse)
+        hidden = [{key: value.index_select(0, inverse) for key, value in layer.items()} for layer in hidden]
+        return h, hidden
+
+    def _output_layer(self, h):
+        """Computes the model outputs from the hidden outputs of the last layer."""
+
+        if self._quantized_h2o is not None:
+            output = self._quantized_h2o(h)
+        else:
+            output = torch.matmul(h, self._W_h2o) + self._b_o
+        output = output.to(self._b_o.dtype)
         if self._output_activation_fn is not None:
             output = self._output_activation_fn(output)
-        self._h_prev = h
         return output
 
+    def _checkpointed_sequence(self, input, lengths=None):
+        """Implements forward_sequence with time-chunked gradient checkpointing.
+
+        Only the hidden states at chunk boundaries and the model outputs are kept for the
+        backward pass; the activations inside a chunk are recomputed during backward. This
+        trades one extra forward pass for memory that no longer grows with the activations
+        of every time step and layer.
+
+        Args:
+            input: [seq_len, batch_size, input_size] input sequence.
+            lengths: optional [batch_size] int tensor, number of valid time steps per example.
+
+        Returns:
+            [seq_len, batch_size, output_size] model outputs for all time steps.
+        """
+
+        keys = [sorted(last_hidden) for last_hidden in self._h_prev]
+
+        def run_chunk(x, chunk_lengths, *flat_hidden):
+            flat_hidden = iter(flat_hidden)
+            hidden = [{key: next(flat_hidden) for key in layer_keys} for layer_keys in keys]
+            h, hidden = self._run_cells(x, hidden, chunk_lengths)
+            return (self._output_layer(h),) + tuple(layer[key] for layer in hidden for key in sorted(layer))
+
+        outputs = []
+        flat_hidden = tuple(layer[key] for layer in self._h_prev for key in sorted(layer))
+        for start in range(0, input.shape[0], self._checkpoint_chunk):
+            x = input[start:start + self._checkpoint_chunk]
+            chunk_lengths = None if lengths is None else window_lengths(lengths, start, start + x.shape[0])
+            output, *flat_hidden = checkpoint(run_chunk, x, chunk_lengths, *flat_hidden, use_reentrant=False)
+            outputs.append(output)
+
+        flat_hidden = iter(flat_hidden)
+        self._h_prev = [{key: next(flat_hidden) for key in layer_keys} for layer_keys in keys]
+        return torch.cat(outputs, 0)
+
+    def _select_backend(self):
+        """Returns the backend for forward_sequence and reports when it changes.
+
+        The native backend falls back to the python cells whenever the cells compute
+        something torch.lstm can not, e.g. once peephole weights are loaded.
+        """
+
+        backend, reason = "python", None
+        if self._backend == "native":
+            reason = native_incompatibility(self._cell_name, self._Cells, self._layer_norm)
+            if reason is None:
+                backend = "native"
+        if backend != self.backend:
+            self.backend = backend
+            if reason is None:
+                print("Backend : {}".format(backend))
+            else:
+                print("Backend : {} ({})".format(backend, reason))
+        return backend
+
     def reset_hidden(self, batch_size):
         """Resets the hidden state for truncating the dependency."""
 
@@ -87,12 +318,46 @@ class Recurrent(nn.Module):
         for cell in self._Cells:
             self._h_prev.append(cell.reset_hidden(batch_size))
 
+    def get_hidden(self):
+        """Returns the hidden state, a list of hidden state dictionaries, one per layer."""
+
+        return list(self._h_prev)
+
+    def set_hidden(self, hidden):
+        """Sets the hidden state from a list returned by get_hidden."""
+
+        self._h_prev = list(hidden)
+
+    def detach_hidden(self):
+        """Detaches the hidden state from the graph for truncating the backpropagation."""
+
+        self._h_prev = [{key: value.detach() for key, value in last_hidden.items()}
+                        for last_hidden in self._h_prev]
+
     def _reset_parameters(self):
         """Initializes the parameters."""
 
         nn.init.xavier_normal(self._W_h2o, gain=nn.init.calculate_gain(self._output_activation))
         nn.init.constant(self._b_o, 0)
 
+    def quantize(self):
+        """Converts the model for int8 dynamic quantized CPU inference.
+
+        The gate weights of every cell and the output projection are replaced by int8
+        linear layers with per output channel scales. The converted model is inference only.
+        """
+
+        assert self._cell_name in ("RNN", "LSTM", "GRU", "JANET"), \
+            "{} cells can not be quantized".format(self._cell_name)
+        assert not self._jit, "scripted cells can not be quantized"
+
+        self._backend = "python"
+        self._precision = "fp32"
+        self._checkpoint_chunk = 0
+        self._Cells = [QuantizedCell(cell) for cell in self._Cells]
+        self._list_of_modules = nn.ModuleList(self._Cells)
+        self._quantized_h2o = quantized_linear(self._W_h2o.detach(), self._b_o.detach())
+
     def register_optimizer(self, optimizer):
         """Registers an optimizer for the model.
 
@@ -113,22 +378,29 @@ class Recurrent(nn.Module):
         if self._cell_name == "RNN":
             self._Cells.append(RNNCell(self._device, input_size, hidden_size,
                                        activation=self._activation, layer_norm=self._layer_norm,
-                                       identity_init=self._identity_init))
+                                       identity_init=self._identity_init, packed=self._packed))
         elif self._cell_name == "LSTM":
             self._Cells.append(LSTMCell(self._device, input_size, hidden_size, layer_norm=self._layer_norm,
-                                        chrono_init=self._chrono_init, t_max=self._t_max))
+                                        chrono_init=self._chrono_init, t_max=self._t_max,
+                                        packed=self._packed, peephole=self._peephole,
+                                        memory_efficient=self._memory_efficient))
         elif self._cell_name == "JANET":
             self._Cells.append(JANETCell(self._device, input_size, hidden_size, layer_norm=self._layer_norm,
-                                         chrono_init=self._chrono_init, t_max=self._t_max))
+                                         chrono_init=self._chrono_init, t_max=self._t_max,
+                                         packed=self._packed, memory_efficient=self._memory_efficient))
         elif self._cell_name == "GRU":
-            self._Cells.append(GRUCell(self._device, input_size, hidden_size, layer_norm=self._layer_norm))
+            self._Cells.append(GRUCell(self._device, input_size, hidden_size, layer_norm=self._layer_norm,
+                                       packed=self._packed, memory_efficient=self._memory_efficient))
         elif self._cell_name == "FlatMemory":
             self._Cells.append(FlatMemoryCell(self._device, input_size, hidden_size, 
                                               memory_size=self._memory_size, k=self._k,
                                               use_relu=self._use_relu, layer_norm=self._layer_norm))
         elif self._cell_name == "SRU":
             self._Cells.append(SRUCell(self._device, input_size, hidden_size, phi_size=self._phi_size,
-                                r_size=self._r_size))
+                                r_size=self._r_size, feedback_lag=self._sru_feedback_lag))
+
+        if self._jit:
+            self._Cells[-1] = script_cell(self._Cells[-1])
                                     
 
     def save(self, save_dir):
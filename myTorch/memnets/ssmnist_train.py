@@ -6,6 +6,7 @@ import torch
 
 from myTorch import Experiment
 from myTorch.memnets.recurrent_net import Recurrent
+from myTorch.memnets.tbptt import tbptt_update
 from myTorch.task.ssmnist_task import SSMNISTData
 from myTorch.task.mnist_task import PMNISTData
 from myTorch.utils.logger import Logger
@@ -46,13 +47,15 @@ def evaluate(experiment, model, config, data_iterator, tr, logger, device, tag):
         accuracy = torch.zeros(config.batch_size).to(device)
         num_outputs = torch.zeros(config.batch_size).to(device)
 
+        x = torch.from_numpy(numpy.asarray(data['x'])).to(device)
+        outputs = model.forward_sequence(x, lengths=data.get('lengths'))
+
         for i in range(0, data["datalen"]):
 
-            x = torch.from_numpy(numpy.asarray(data['x'][i])).to(device)
             y = torch.from_numpy(numpy.asarray(data['y'][i])).to(device)
             mask = torch.from_numpy(numpy.asarray(data['mask'][i])).to(device)
 
-            output = model(x)
+            output = outputs[i]
 
             values, indices = torch.max(output, 1)
 
@@ -102,45 +105,39 @@ def train(experiment, model, config, data_iterator, tr, logger, device):
             data_iterator.reset_iterator()
             data = data_iterator.next("train")
 
-        seqloss = 0
-
         model.reset_hidden(batch_size=config.batch_size)
 
-        for i in range(0, data["datalen"]):
-
-            x = torch.from_numpy(numpy.asarray(data['x'][i])).to(device)
-            y = torch.from_numpy(numpy.asarray(data['y'][i])).to(device)
-            mask = torch.from_numpy(numpy.asarray(data['mask'][i])).to(device)
+        x = torch.from_numpy(numpy.asarray(data['x'])).to(device)
 
-            model.optimizer.zero_grad()
+        def window_loss(outputs, start):
+            seqloss = 0
+            for i in range(start, min(start + outputs.shape[0], data["datalen"])):
 
-            output = model(x)
+                y = torch.from_numpy(numpy.asarray(data['y'][i])).to(device)
+                mask = torch.from_numpy(numpy.asarray(data['mask'][i])).to(device)
 
-            loss = F.cross_entropy(output, y, reduce=False)
+                output = outputs[i - start]
 
-            loss = (loss * mask).sum()
+                loss = F.cross_entropy(output, y, reduce=False)
 
+                loss = (loss * mask).sum()
 
-            seqloss += loss
+                seqloss += loss
+            return seqloss, float(data["mask"][start:start + outputs.shape[0]].sum())
 
-        seqloss /= float(data["mask"].sum())
-        tr.ce["train"].append(seqloss.item())
+        seqloss, grad_norms = tbptt_update(model, x, window_loss, k1=config.tbptt_k1, k2=config.tbptt_k2,
+                                           grad_clip_norm=config.grad_clip_norm, lengths=data.get('lengths'))
+        tr.ce["train"].append(seqloss)
         running_average = sum(tr.ce["train"]) / len(tr.ce["train"])
 
         if config.use_tflogger:
             logger.log_scalar("running_avg_loss", running_average, step + 1)
             logger.log_scalar("train loss", tr.ce["train"][-1], step + 1)
 
-        seqloss.backward(retain_graph=False)
-
-
-        total_norm = torch.nn.utils.clip_grad_norm(model.parameters(), config.grad_clip_norm)
-        tr.grad_norm.append(total_norm)
-
-        if config.use_tflogger:
-            logger.log_scalar("inst_total_norm", total_norm, step + 1)
+        tr.grad_norm.extend(grad_norms)
 
-        model.optimizer.step()
+        if config.use_tflogger and grad_norms:
+            logger.log_scalar("inst_total_norm", grad_norms[-1], step + 1)
 
         tr.updates_done += 1
 
@@ -171,7 +168,13 @@ def create_experiment(config):
                       output_activation="linear", layer_norm=config.layer_norm,
                       identity_init=config.identity_init, chrono_init=config.chrono_init,
                       t_max=config.t_max, use_relu=config.use_relu, memory_size=config.memory_size,
-                      k=config.k, phi_size=config.phi_size, r_size=config.r_size).to(device)
+                      k=config.k, phi_size=config.phi_size, r_size=config.r_size,
+                      packed=config.packed_weights, jit=config.jit,
+                      peephole=not config.no_peephole, backend=config.backend,
+                      checkpoint_chunk=config.checkpoint_chunk, memory_efficient=config.memory_efficient,
+                      precision=config.precision, schedule=config.schedule,
+                      wavefront_chunk=config.wavefront_chunk,
+                      sru_feedback_lag=config.sru_feedback_lag).to(device)
 
     data_iterator = get_data_iterator(config)
 
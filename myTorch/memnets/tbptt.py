@@ -0,0 +1,69 @@
+"""Truncated backpropagation through time for the memnets training loops."""
+import torch
+
+from myTorch.memnets.recurrent_net import window_lengths
+
+
+def tbptt_update(model, x, window_loss, k1=0, k2=0, grad_clip_norm=None, lengths=None):
+    """Trains the model on one batch of sequences with truncated BPTT.
+
+    Every k1 time steps the masked loss of those k1 steps is backpropagated through the
+    last k2 time steps and the parameters are updated. The hidden state is detached
+    between windows; when k2 > k1 the extra k2 - k1 steps are recomputed from the
+    detached hidden state stored at the window start. With k1 = 0 the whole sequence
+    is a single window, which is plain BPTT with one update.
+
+    Args:
+        model: Recurrent model with a registered optimizer and an initialized hidden state.
+        x: [seq_len, batch_size, input_size] input sequence.
+        window_loss: function (outputs, start) -> (masked loss summed over the steps of
+            `outputs`, float sum of the masks), where outputs[i] is the model output of
+            time step start + i.
+        k1: int, number of time steps between updates, 0 for the whole sequence.
+        k2: int, number of time steps to backpropagate through, a multiple of k1. 0 means k1.
+        grad_clip_norm: float, if not None, clips the gradient norm before each update.
+        lengths: optional [batch_size] int tensor, number of valid time steps per example.
+            The hidden state of an example is frozen after its end, and the windows after
+            the end of the longest example are skipped.
+
+    Returns:
+        masked loss of the whole sequence and the list of gradient norms of the updates.
+    """
+
+    seq_len = x.shape[0]
+    if lengths is not None:
+        seq_len = min(seq_len, int(torch.as_tensor(lengths).max()))
+    k1 = k1 or seq_len
+    k2 = k2 or k1
+    assert k2 % k1 == 0, "tbptt k2 must be a multiple of k1"
+
+    # detached hidden states at the window starts that may still be recomputed from.
+    boundaries = {0: model.get_hidden()}
+    total_loss, total_weight, grad_norms = 0.0, 0.0, []
+
+    for start in range(0, seq_len, k1):
+        end = min(start + k1, seq_len)
+        recompute_from = max(0, start - (k2 - k1))
+        model.set_hidden(boundaries[recompute_from])
+
+        if lengths is None:
+            outputs = model.forward_sequence(x[recompute_from:end])
+        else:
+            outputs = model.forward_sequence(x[recompute_from:end],
+                                             lengths=window_lengths(lengths, recompute_from, end))
+        loss, weight = window_loss(outputs[start - recompute_from:], start)
+
+        if weight > 0:
+            model.optimizer.zero_grad()
+            (loss / weight).backward()
+            if grad_clip_norm is not None:
+                grad_norms.append(torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip_norm).item())
+            model.optimizer.step()
+            total_loss += loss.item()
+            total_weight += weight
+
+        model.detach_hidden()
+        boundaries[end] = model.get_hidden()
+        boundaries.pop(end - k2, None)
+
+    return total_loss / max(total_weight, 1e-12), grad_norms
@@ -2,11 +2,14 @@
 import numpy
 import argparse
 import logging
+from copy import deepcopy
 
 import torch
 
 from myTorch import Experiment
 from myTorch.memnets.recurrent_net import Recurrent
+from myTorch.memnets.population import Population, population_update
+from myTorch.memnets.tbptt import tbptt_update
 from myTorch.task.copy_task import CopyData
 from myTorch.task.repeat_copy_task import RepeatCopyData
 from myTorch.task.associative_recall_task import AssociativeRecallData
@@ -71,45 +74,55 @@ def train(experiment, model, config, data_iterator, tr, logger, device):
                 experiment.save(str(tr.updates_done))
 
         data = data_iterator.next()
-        seqloss = 0
 
         model.reset_hidden(batch_size=config.batch_size)
 
-        for i in range(0, data["datalen"]):
-
-            x = torch.from_numpy(numpy.asarray(data['x'][i])).to(device)
-            y = torch.from_numpy(numpy.asarray(data['y'][i])).to(device)
-            mask = float(data["mask"][i])
-
-            model.optimizer.zero_grad()
-
-            output = model(x)
-            if config.task == "copying_memory" or config.task == "denoising_copy":
-                loss = F.cross_entropy(output, y.squeeze(1))
-            elif config.task == "adding":
-                loss = F.mse_loss(output, y)
-            else:
-                loss = F.binary_cross_entropy_with_logits(output, y)
-
-            seqloss += (loss * mask)
-
-        seqloss /= sum(data["mask"])
-        tr.average_bce.append(seqloss.item())
+        x = torch.from_numpy(numpy.asarray(data['x'])).to(device)
+
+        def window_loss(outputs, start):
+            seqloss, mask_sum = outputs.new_zeros(()), 0.0
+            for i in range(start, min(start + outputs.shape[0], data["datalen"])):
+                mask = float(data["mask"][i])
+                if mask == 0:
+                    continue
+
+                y = torch.from_numpy(numpy.asarray(data['y'][i])).to(device)
+                output = outputs[i - start]
+                if config.task == "copying_memory" or config.task == "denoising_copy":
+                    loss = F.cross_entropy(output, y.squeeze(1))
+                elif config.task == "adding":
+                    loss = F.mse_loss(output, y)
+                else:
+                    loss = F.binary_cross_entropy_with_logits(output, y)
+
+                seqloss += (loss * mask)
+                mask_sum += mask
+            return seqloss, mask_sum
+
+        if isinstance(model, Population):
+            replica_losses, grad_norms = population_update(model, x, window_loss,
+                                                           grad_clip_norm=config.grad_clip_norm)
+            tr.replica_bce.append(replica_losses)
+            if config.use_tflogger:
+                for i, replica_loss in enumerate(replica_losses):
+                    logger.log_scalar("loss_replica_{}".format(i), replica_loss, step + 1)
+            seqloss = sum(replica_losses) / len(replica_losses)
+        else:
+            seqloss, grad_norms = tbptt_update(model, x, window_loss, k1=config.tbptt_k1, k2=config.tbptt_k2,
+                                               grad_clip_norm=config.grad_clip_norm)
+        tr.average_bce.append(seqloss)
         running_average = sum(tr.average_bce) / len(tr.average_bce)
 
         if config.use_tflogger:
             logger.log_scalar("running_avg_loss", running_average, step + 1)
             logger.log_scalar("loss", tr.average_bce[-1], step + 1)
 
-        seqloss.backward(retain_graph=False)
-
-        total_norm = torch.nn.utils.clip_grad_norm(model.parameters(), config.grad_clip_norm)
-        tr.grad_norm.append(total_norm)
+        tr.grad_norm.extend(grad_norms)
+        total_norm = grad_norms[-1] if grad_norms else 0.0
 
         if config.use_tflogger:
             logger.log_scalar("inst_total_norm", total_norm, step + 1)
 
-        model.optimizer.step()
         #if torch.isnan(total_norm) != 1:
         #    model.optimizer.step()
         #else:
@@ -146,22 +159,17 @@ def create_experiment(config):
     else:
         t_max = 1
 
-    model = Recurrent(device, input_size, output_size,
-                      num_layers=config.num_layers, layer_size=config.layer_size,
-                      cell_name=config.model, activation=config.activation,
-                      output_activation="linear", layer_norm=config.layer_norm,
-                      identity_init=config.identity_init, chrono_init=config.chrono_init,
-                      t_max=t_max, use_relu=config.use_relu, memory_size=config.memory_size, 
-                      k=config.k, phi_size=config.phi_size, r_size=config.r_size).to(device)
+    if config.population_size is not None and config.population_size > 1:
+        model = create_population(config, device, input_size, output_size, t_max)
+    else:
+        model = create_model(config, device, input_size, output_size, t_max)
 
     data_iterator = get_data_iterator(config)
 
-    optimizer = get_optimizer(model.parameters(), config)
-    model.register_optimizer(optimizer)
-
     tr = MyContainer()
     tr.updates_done = 0
     tr.average_bce = []
+    tr.replica_bce = []
     tr.grad_norm = []
 
     experiment.register_experiment(model=model, config=config, logger=logger, train_statistics=tr,
@@ -170,6 +178,52 @@ def create_experiment(config):
     return experiment, model, data_iterator, tr, logger, device
 
 
+def create_model(config, device, input_size, output_size, t_max):
+    """Creates a Recurrent model with its optimizer."""
+
+    model = Recurrent(device, input_size, output_size,
+                      num_layers=config.num_layers, layer_size=config.layer_size,
+                      cell_name=config.model, activation=config.activation,
+                      output_activation="linear", layer_norm=config.layer_norm,
+                      identity_init=config.identity_init, chrono_init=config.chrono_init,
+                      t_max=t_max, use_relu=config.use_relu, memory_size=config.memory_size, 
+                      k=config.k, phi_size=config.phi_size, r_size=config.r_size,
+                      packed=config.packed_weights, jit=config.jit,
+                      peephole=not config.no_peephole, backend=config.backend,
+                      checkpoint_chunk=config.checkpoint_chunk, memory_efficient=config.memory_efficient,
+                      precision=config.precision, schedule=config.schedule,
+                      wavefront_chunk=config.wavefront_chunk,
+                      sru_feedback_lag=config.sru_feedback_lag).to(device)
+
+    optimizer = get_optimizer(model.parameters(), config)
+    model.register_optimizer(optimizer)
+    return model
+
+
+def create_population(config, device, input_size, output_size, t_max):
+    """Creates a population of Recurrent replicas.
+
+    Replica i is seeded with rseed + i and trained with population_lr[i] if given, else lr.
+    Every replica is saved with its own config, in which it is a single model.
+    """
+
+    assert not config.tbptt_k1, "population training updates once per sequence"
+
+    models, configs = [], []
+    for i in range(config.population_size):
+        replica_config = deepcopy(config)
+        replica_config.population_size = 0
+        replica_config.rseed = config.rseed + i
+        if config.population_lr:
+            replica_config.lr = config.population_lr[i]
+
+        torch.manual_seed(replica_config.rseed)
+        models.append(create_model(replica_config, device, input_size, output_size, t_max))
+        configs.append(replica_config)
+
+    return Population(models, configs)
+
+
 def run_experiment(args):
     """Runs the experiment."""
 
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Compares the layer-major and the wavefront schedule of Recurrent across layer counts."""
+import argparse
+import time
+
+import torch
+
+from myTorch.memnets.recurrent_net import Recurrent
+
+parser = argparse.ArgumentParser(description="Wavefront schedule benchmark")
+parser.add_argument("--cell", type=str, default="LSTM", help="RNN, GRU, LSTM, JANET, FlatMemory or SRU.")
+parser.add_argument("--hidden_size", type=int, default=128, help="hidden layer dimension.")
+parser.add_argument("--input_size", type=int, default=8, help="size of the input vector.")
+parser.add_argument("--batch_size", type=int, default=16, help="batch size.")
+parser.add_argument("--seq_len", type=int, default=200, help="number of time steps per sequence.")
+parser.add_argument("--max_layers", type=int, default=4, help="benchmarks 1 to max_layers layers.")
+parser.add_argument("--chunks", type=int, nargs="+", default=[1, 4, 16], help="wavefront chunk sizes.")
+parser.add_argument("--num_iters", type=int, default=10, help="number of timed iterations.")
+parser.add_argument("--backward", action="store_true", help="also times the backward pass.")
+args = parser.parse_args()
+
+
+def time_model(model, x):
+    """Returns the average time per sequence in milliseconds."""
+
+    def run():
+        model.reset_hidden(x.shape[1])
+        output = model.forward_sequence(x)
+        if args.backward:
+            model.zero_grad()
+            output.sum().backward()
+
+    with torch.set_grad_enabled(args.backward):
+        run()
+        start = time.perf_counter()
+        for _ in range(args.num_iters):
+            run()
+    return (time.perf_counter() - start) / args.num_iters * 1000
+
+
+def main():
+    device = torch.device("cpu")
+    x = torch.randn(args.seq_len, args.batch_size, args.input_size)
+    print("{} hidden {} batch {} seq_len {}, {} intra-op threads".format(
+        args.cell, args.hidden_size, args.batch_size, args.seq_len, torch.get_num_threads()))
+
+    for num_layers in range(1, args.max_layers + 1):
+        results = []
+        for schedule, chunk in [("layer", None)] + [("wavefront", chunk) for chunk in args.chunks]:
+            torch.manual_seed(5)
+            model = Recurrent(device, args.input_size, args.input_size, num_layers=num_layers,
+                              layer_size=[args.hidden_size] * num_layers, cell_name=args.cell,
+                              schedule=schedule, wavefront_chunk=chunk)
+            results.append(time_model(model, x))
+
+        print("layers {} : layer-major {:.2f} ms, ".format(num_layers, results[0]) + ", ".join(
+            "wavefront chunk {} {:.2f} ms ({:.2f}x)".format(chunk, result, results[0] / result)
+            for chunk, result in zip(args.chunks, results[1:])))
+
+
+if __name__ == '__main__':
+    main()
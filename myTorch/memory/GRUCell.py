@@ -1,19 +1,49 @@
 """Implementation of a GRU Cell."""
+from typing import Dict, Final, NamedTuple, Tuple
+
 import torch
 import torch.nn as nn
 import numpy as np
 
+from myTorch.memory.functions import GRUStep
+from myTorch.memory.jacobians import diag_mm, layer_norm_jacobian, recurrent_jacobian
+from myTorch.memory.packing import gate_blocks, convert_state_dict, project_inputs
+
+
+class GRUState(NamedTuple):
+    """Hidden state of a GRU Cell."""
+
+    h: torch.Tensor
+
 
 class GRUCell(nn.Module):
-    """Implementation of a GRU cell based on https://arxiv.org/pdf/1412.3555.pdf"""
+    """Implementation of a GRU cell based on https://arxiv.org/pdf/1412.3555.pdf
 
-    def __init__(self, device, input_size, hidden_size, layer_norm=False):
+    The cell is scriptable with torch.jit.script: `step` and `step_sequence` work on a typed
+    GRUState, `forward` and `forward_sequence` are dictionary adapters over them.
+    """
+
+    _input_size: Final[int]
+    _hidden_size: Final[int]
+    _layer_norm: Final[bool]
+    _packed: Final[bool]
+    _memory_efficient: Final[bool]
+
+    # (W_x, W_h, b) of every gate, in the column order of the packed weights.
+    _GATES = (("_W_i2r", "_W_h2r", "_b_r"),
+              ("_W_i2z", "_W_h2z", "_b_z"),
+              ("_W_i2h", "_W_h2h", "_b_h"))
+
+    def __init__(self, device, input_size, hidden_size, layer_norm=False, packed=False, memory_efficient=False):
         """Initializes a GRU Cell.
 
         Args:
             device: torch device object.
             input_size: int, size of the input vector.
             hidden_size: int, RNN hidden layer dimension.
+            packed: bool, if True, stores all gate weights in one [input+hidden, 3*hidden] parameter.
+            memory_efficient: bool, if True and without layer normalization, uses a hand-written
+                backward that only saves the gate activations.
         """
 
         super(GRUCell, self).__init__()
@@ -22,28 +52,34 @@ class GRUCell(nn.Module):
         self._input_size = input_size
         self._hidden_size = hidden_size
         self._layer_norm = layer_norm
+        self._packed = packed
+        self._memory_efficient = memory_efficient
+
+        if self._packed:
+            self._W = nn.Parameter(torch.Tensor(input_size + hidden_size, 3 * hidden_size))
+            self._b = nn.Parameter(torch.Tensor(3 * hidden_size))
+        else:
+            self._W_i2r = nn.Parameter(torch.Tensor(input_size, hidden_size))
+            self._W_h2r = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
+            self._b_r = nn.Parameter(torch.Tensor(hidden_size))
 
-        self._W_i2r = nn.Parameter(torch.Tensor(input_size, hidden_size))
-        self._W_h2r = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
-        self._b_r = nn.Parameter(torch.Tensor(hidden_size))
-        
-        self._W_i2z = nn.Parameter(torch.Tensor(input_size, hidden_size))
-        self._W_h2z = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
-        self._b_z = nn.Parameter(torch.Tensor(hidden_size))
-        
-        self._W_i2h = nn.Parameter(torch.Tensor(input_size, hidden_size))
-        self._W_h2h = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
-        self._b_h = nn.Parameter(torch.Tensor(hidden_size))
+            self._W_i2z = nn.Parameter(torch.Tensor(input_size, hidden_size))
+            self._W_h2z = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
+            self._b_z = nn.Parameter(torch.Tensor(hidden_size))
+
+            self._W_i2h = nn.Parameter(torch.Tensor(input_size, hidden_size))
+            self._W_h2h = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
+            self._b_h = nn.Parameter(torch.Tensor(hidden_size))
 
         if self._layer_norm:
             self._ln_r = nn.LayerNorm(hidden_size)
             self._ln_z = nn.LayerNorm(hidden_size)
             self._ln_h = nn.LayerNorm(hidden_size)
 
-
+        self._register_load_state_dict_pre_hook(self._convert_state_dict)
         self._reset_parameters()
 
-    def forward(self, input, last_hidden):
+    def forward(self, input, last_hidden: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         """Implements forward computation of an RNN Cell.
 
         Args:
@@ -53,51 +89,178 @@ class GRUCell(nn.Module):
         Returns:
             current hidden state as a dictionary.
         """
-        
-        self._W_r = torch.cat((self._W_i2r, self._W_h2r), 0)
-        self._W_z = torch.cat((self._W_i2z, self._W_h2z), 0)
-        c_input = torch.cat((input, last_hidden["h"]), 1)
 
-        pre_r = torch.add(torch.mm(c_input, self._W_r), self._b_r)
+        state = self.step(input, GRUState(last_hidden["h"]))
+        return {"h": state.h}
+
+    @torch.jit.export
+    def forward_sequence(self, inputs,
+                         last_hidden: Dict[str, torch.Tensor]) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        """Implements forward computation over a whole sequence.
+
+        Args:
+            inputs: [seq_len, batch_size, input_size] input sequence.
+            last_hidden: hidden state dictionary before the first time step.
+
+        Returns:
+            [seq_len, batch_size, hidden_size] hidden outputs and the last hidden state dictionary.
+        """
+
+        outputs, state = self.step_sequence(inputs, GRUState(last_hidden["h"]))
+        return outputs, {"h": state.h}
+
+    @torch.jit.export
+    def step(self, input, state: GRUState) -> GRUState:
+        """Computes one time step on a typed hidden state."""
+
+        W, b = self._packed_weights()
+        x_proj = torch.addmm(b, input, W[:self._input_size])
+        return self._gates2state(x_proj, state, W[self._input_size:])
+
+    @torch.jit.export
+    def step_sequence(self, inputs, state: GRUState) -> Tuple[torch.Tensor, GRUState]:
+        """Computes a whole sequence on a typed hidden state.
+
+        The input-to-hidden products do not depend on the recurrence, so they are computed
+        for all time steps with one matmul and only the recurrent part runs in the time loop.
+        """
+
+        W, b = self._packed_weights()
+        x_proj = project_inputs(inputs, W[:self._input_size], b)
+        W_h = W[self._input_size:]
+
+        outputs = []
+        for x_t in x_proj.unbind(0):
+            state = self._gates2state(x_t, state, W_h)
+            outputs.append(state.h)
+        return torch.stack(outputs), state
+
+    @torch.jit.export
+    def step_jacobian(self, input, last_hidden: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """Computes the Jacobian dh_t/dh_(t-1) of one time step in closed form.
+
+        Args:
+            input: [batch_size, input_size] current input vector.
+            last_hidden: previous hidden state dictionary.
+
+        Returns:
+            [batch_size, hidden_size, hidden_size] Jacobian, entry [b, i, j] is the derivative
+            of h_t[b, i] w.r.t. h_(t-1)[b, j].
+        """
+
+        h = last_hidden["h"]
+        H = self._hidden_size
+        W, b = self._packed_weights()
+        x_rz, x_h = torch.addmm(b, input, W[:self._input_size]).split([2 * H, H], 1)
+        W_h = W[self._input_size:]
+
+        pre_r, pre_z = torch.addmm(x_rz, h, W_h[:, :2 * H]).to(h.dtype).chunk(2, 1)
+        J_r, J_z = recurrent_jacobian(W_h[:, :2 * H], h.shape[0]).chunk(2, 1)
         if self._layer_norm:
+            J_r = layer_norm_jacobian(pre_r, J_r, self._ln_r.weight, self._ln_r.eps)
             pre_r = self._ln_r(pre_r)
         r = torch.sigmoid(pre_r)
+        J_r = diag_mm(r * (1 - r), J_r)
 
-        pre_z = torch.add(torch.mm(c_input, self._W_z), self._b_z)
         if self._layer_norm:
+            J_z = layer_norm_jacobian(pre_z, J_z, self._ln_z.weight, self._ln_z.eps)
             pre_z = self._ln_z(pre_z)
         z = torch.sigmoid(pre_z)
+        J_z = diag_mm(z * (1 - z), J_z)
 
-        hp_pre = torch.mm(input, self._W_i2h) + torch.mm(last_hidden["h"] * r, self._W_h2h) + self._b_h
+        # d(h * r)/dh = diag(r) + diag(h) J_r
+        W_hh = W_h[:, 2 * H:].t()
+        hp_pre = torch.addmm(x_h, h * r, W_h[:, 2 * H:]).to(h.dtype)
+        J_hp = W_hh.unsqueeze(0) * r.unsqueeze(1) + torch.matmul(W_hh, diag_mm(h, J_r))
         if self._layer_norm:
+            J_hp = layer_norm_jacobian(hp_pre, J_hp, self._ln_h.weight, self._ln_h.eps)
             hp_pre = self._ln_h(hp_pre)
         hp = torch.tanh(hp_pre)
+        J_hp = diag_mm(1 - hp * hp, J_hp)
+
+        return diag_mm(1 - z, J_hp) + diag_mm(h - hp, J_z) + torch.diag_embed(z)
 
-        h = ((1 - z) * hp) + (z * last_hidden["h"])
-        
-        hidden = {}
-        hidden["h"] = h
-        return hidden
+    @torch.jit.export
+    def init_state(self, batch_size: int) -> GRUState:
+        """Returns an all-zero typed hidden state."""
 
-    def reset_hidden(self, batch_size):
+        return GRUState(torch.zeros(batch_size, self._hidden_size, device=self._device))
+
+    @torch.jit.export
+    def reset_hidden(self, batch_size: int) -> Dict[str, torch.Tensor]:
         """Resets the hidden state for truncating the dependency."""
 
-        hidden = {}
-        hidden["h"] = torch.Tensor(np.zeros((batch_size, self._hidden_size))).to(self._device)
+        return {"h": self.init_state(batch_size).h}
+
+    def _packed_weights(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the packed (W, b), concatenating the per-gate parameters if needed."""
+
+        if self._packed:
+            return self._W, self._b
+        W_x = torch.cat((self._W_i2r, self._W_i2z, self._W_i2h), 1)
+        W_h = torch.cat((self._W_h2r, self._W_h2z, self._W_h2h), 1)
+        b = torch.cat((self._b_r, self._b_z, self._b_h), 0)
+        return torch.cat((W_x, W_h), 0), b
+
+    def _gates2state(self, x_proj, last_state: GRUState, W_h) -> GRUState:
+        """Computes the hidden state from the packed input projections.
+
+        The candidate state needs `r * h` before its recurrent matmul, so unlike the
+        other cells the recurrent part can not be folded into the input projection.
+
+        Args:
+            x_proj: [batch_size, 3*hidden_size] input projections (with biases) of the r, z and h gates.
+            last_state: previous hidden state.
+            W_h: [hidden_size, 3*hidden_size] packed recurrent weights.
+
+        Returns:
+            current hidden state.
+        """
+
+        if not torch.jit.is_scripting():
+            if self._memory_efficient and not self._layer_norm:
+                return GRUState(GRUStep.apply(x_proj, last_state.h, W_h))
+
+        H = self._hidden_size
+        x_rz, x_h = x_proj.split([2 * H, H], 1)
+
+        pre_r, pre_z = torch.addmm(x_rz, last_state.h, W_h[:, :2 * H]).to(last_state.h.dtype).chunk(2, 1)
+        if self._layer_norm:
+            pre_r = self._ln_r(pre_r)
+        r = torch.sigmoid(pre_r)
+
+        if self._layer_norm:
+            pre_z = self._ln_z(pre_z)
+        z = torch.sigmoid(pre_z)
+
+        hp_pre = torch.addmm(x_h, last_state.h * r, W_h[:, 2 * H:]).to(last_state.h.dtype)
+        if self._layer_norm:
+            hp_pre = self._ln_h(hp_pre)
+        hp = torch.tanh(hp_pre)
+
+        h = ((1 - z) * hp) + (z * last_state.h)
+
+        return GRUState(h)
 
-        return hidden
+    def _convert_state_dict(self, state_dict, prefix, *args):
+        """Loads checkpoints saved with the other (packed or per-gate) weight layout."""
+
+        convert_state_dict(state_dict, prefix, self._GATES, self._packed, self._input_size, self._hidden_size)
 
     def _reset_parameters(self):
         """Initializes the GRU Cell parameters."""
 
-        nn.init.xavier_normal(self._W_i2r)
-        nn.init.xavier_normal(self._W_i2z)
-        nn.init.xavier_normal(self._W_i2h)
-        
-        nn.init.orthogonal(self._W_h2r)
-        nn.init.orthogonal(self._W_h2z)
-        nn.init.orthogonal(self._W_h2h)
-        
-        nn.init.constant(self._b_r, 0)
-        nn.init.constant(self._b_z, 0)
-        nn.init.constant(self._b_h, 0)
+        (W_i2r, W_h2r, b_r), (W_i2z, W_h2z, b_z), (W_i2h, W_h2h, b_h) = gate_blocks(self, self._GATES)
+
+        with torch.no_grad():
+            nn.init.xavier_normal_(W_i2r)
+            nn.init.xavier_normal_(W_i2z)
+            nn.init.xavier_normal_(W_i2h)
+
+            nn.init.orthogonal_(W_h2r)
+            nn.init.orthogonal_(W_h2z)
+            nn.init.orthogonal_(W_h2h)
+
+            nn.init.constant_(b_r, 0)
+            nn.init.constant_(b_z, 0)
+            nn.init.constant_(b_h, 0)
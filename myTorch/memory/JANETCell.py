@@ -1,13 +1,40 @@
 """Implementation of a JANET Cell."""
+from typing import Dict, Final, NamedTuple, Tuple
+
 import torch
 import torch.nn as nn
 import numpy as np
 
+from myTorch.memory.functions import JANETPointwise
+from myTorch.memory.jacobians import diag_mm, layer_norm_jacobian, recurrent_jacobian
+from myTorch.memory.packing import gate_blocks, convert_state_dict, project_inputs
+
+
+class JANETState(NamedTuple):
+    """Hidden state of a JANET Cell."""
+
+    h: torch.Tensor
+
 
 class JANETCell(nn.Module):
-    """Implementation of a JANET Cell based on https://arxiv.org/pdf/1804.04849.pdf"""
+    """Implementation of a JANET Cell based on https://arxiv.org/pdf/1804.04849.pdf
+
+    The cell is scriptable with torch.jit.script: `step` and `step_sequence` work on a typed
+    JANETState, `forward` and `forward_sequence` are dictionary adapters over them.
+    """
+
+    _input_size: Final[int]
+    _hidden_size: Final[int]
+    _layer_norm: Final[bool]
+    _packed: Final[bool]
+    _memory_efficient: Final[bool]
 
-    def __init__(self, device, input_size, hidden_size, layer_norm=False, chrono_init=False, t_max=10):
+    # (W_x, W_h, b) of every gate, in the column order of the packed weights.
+    _GATES = (("_W_x2f", "_W_h2f", "_b_f"),
+              ("_W_x2c", "_W_h2c", "_b_c"))
+
+    def __init__(self, device, input_size, hidden_size, layer_norm=False, chrono_init=False, t_max=10,
+                 packed=False, memory_efficient=False):
         """Initializes a JANET Cell.
 
         Args:
@@ -15,6 +42,10 @@ class JANETCell(nn.Module):
             input_size: int, size of the input vector.
             hidden_size: int, LSTM hidden layer dimension.
             layer_norm: bool, if True, applies layer normalization.
+            packed: bool, if True, stores all gate weights in one [input+hidden, 2*hidden] parameter
+                and computes every gate pre-activation with a single matmul.
+            memory_efficient: bool, if True and without layer normalization, uses a hand-written
+                backward that only saves the gate activations.
         """
 
         super(JANETCell, self).__init__()
@@ -25,21 +56,28 @@ class JANETCell(nn.Module):
         self._layer_norm = layer_norm
         self._chrono_init = chrono_init
         self._t_max = t_max
+        self._packed = packed
+        self._memory_efficient = memory_efficient
 
-        self._W_x2f = nn.Parameter(torch.Tensor(input_size, hidden_size))
-        self._W_h2f = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
-        self._b_f = nn.Parameter(torch.Tensor(hidden_size))
+        if self._packed:
+            self._W = nn.Parameter(torch.Tensor(input_size + hidden_size, 2 * hidden_size))
+            self._b = nn.Parameter(torch.Tensor(2 * hidden_size))
+        else:
+            self._W_x2f = nn.Parameter(torch.Tensor(input_size, hidden_size))
+            self._W_h2f = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
+            self._b_f = nn.Parameter(torch.Tensor(hidden_size))
 
-        self._W_x2c = nn.Parameter(torch.Tensor(input_size, hidden_size))
-        self._W_h2c = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
-        self._b_c = nn.Parameter(torch.Tensor(hidden_size))
+            self._W_x2c = nn.Parameter(torch.Tensor(input_size, hidden_size))
+            self._W_h2c = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
+            self._b_c = nn.Parameter(torch.Tensor(hidden_size))
 
         if self._layer_norm:
             self._ln = nn.LayerNorm(hidden_size)
 
+        self._register_load_state_dict_pre_hook(self._convert_state_dict)
         self._reset_parameters()
 
-    def forward(self, input, last_hidden):
+    def forward(self, input, last_hidden: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         """Implements forward computation of an LSTM Cell.
 
         Args:
@@ -50,46 +88,151 @@ class JANETCell(nn.Module):
             current hidden state as a dictionary.
         """
 
-        self._W_f = torch.cat((self._W_x2f, self._W_h2f), 0)
-        self._W_c = torch.cat((self._W_x2c, self._W_h2c), 0)
+        state = self.step(input, JANETState(last_hidden["h"]))
+        return {"h": state.h}
+
+    @torch.jit.export
+    def forward_sequence(self, inputs,
+                         last_hidden: Dict[str, torch.Tensor]) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        """Implements forward computation over a whole sequence.
+
+        Args:
+            inputs: [seq_len, batch_size, input_size] input sequence.
+            last_hidden: hidden state dictionary before the first time step.
+
+        Returns:
+            [seq_len, batch_size, hidden_size] hidden outputs and the last hidden state dictionary.
+        """
+
+        outputs, state = self.step_sequence(inputs, JANETState(last_hidden["h"]))
+        return outputs, {"h": state.h}
+
+    @torch.jit.export
+    def step(self, input, state: JANETState) -> JANETState:
+        """Computes one time step on a typed hidden state."""
+
+        W, b = self._packed_weights()
+        c_input = torch.cat((input, state.h), 1)
+        return self._gates2state(torch.addmm(b, c_input, W).to(state.h.dtype), state)
+
+    @torch.jit.export
+    def step_sequence(self, inputs, state: JANETState) -> Tuple[torch.Tensor, JANETState]:
+        """Computes a whole sequence on a typed hidden state.
+
+        The input-to-hidden products do not depend on the recurrence, so they are computed
+        for all time steps with one matmul and only the recurrent part runs in the time loop.
+        """
+
+        W, b = self._packed_weights()
+        x_proj = project_inputs(inputs, W[:self._input_size], b)
+        W_h = W[self._input_size:]
+
+        outputs = []
+        for x_t in x_proj.unbind(0):
+            state = self._gates2state(torch.addmm(x_t, state.h, W_h).to(state.h.dtype), state)
+            outputs.append(state.h)
+        return torch.stack(outputs), state
+
+    @torch.jit.export
+    def step_jacobian(self, input, last_hidden: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """Computes the Jacobian dh_t/dh_(t-1) of one time step in closed form.
+
+        Args:
+            input: [batch_size, input_size] current input vector.
+            last_hidden: previous hidden state dictionary.
+
+        Returns:
+            [batch_size, hidden_size, hidden_size] Jacobian, entry [b, i, j] is the derivative
+            of h_t[b, i] w.r.t. h_(t-1)[b, j].
+        """
+
+        h = last_hidden["h"]
+        W, b = self._packed_weights()
+        gates = torch.addmm(b, torch.cat((input, h), 1), W).to(h.dtype)
+        pre_f, cp = gates.chunk(2, 1)
+        J_f, J_cp = recurrent_jacobian(W[self._input_size:], h.shape[0]).chunk(2, 1)
 
-        c_input = torch.cat((input, last_hidden["h"]), 1)
-        f = torch.sigmoid(torch.mm(c_input, self._W_f) + self._b_f)
+        f = torch.sigmoid(pre_f)
+        J_f = diag_mm(f * (1 - f), J_f)
 
-        cp_input = torch.cat((input, last_hidden["h"]), 1)
-        cp = torch.mm(cp_input, self._W_c) + self._b_c
         if self._layer_norm:
+            J_cp = layer_norm_jacobian(cp, J_cp, self._ln.weight, self._ln.eps)
             cp = self._ln(cp)
         cp = torch.tanh(cp)
+        J_cp = diag_mm(1 - cp * cp, J_cp)
 
-        c = f * last_hidden["h"] + (1-f) * cp
+        return diag_mm(h - cp, J_f) + diag_mm(1 - f, J_cp) + torch.diag_embed(f)
 
-        h = c
+    @torch.jit.export
+    def init_state(self, batch_size: int) -> JANETState:
+        """Returns an all-zero typed hidden state."""
 
-        hidden = {}
-        hidden["h"] = h
-        return hidden
+        return JANETState(torch.zeros(batch_size, self._hidden_size, device=self._device))
 
-    def reset_hidden(self, batch_size):
+    @torch.jit.export
+    def reset_hidden(self, batch_size: int) -> Dict[str, torch.Tensor]:
         """Resets the hidden state for truncating the dependency."""
 
-        hidden = {}
-        hidden["h"] = torch.Tensor(np.zeros((batch_size, self._hidden_size))).to(self._device)
-        return hidden
+        return {"h": self.init_state(batch_size).h}
+
+    def _packed_weights(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the packed (W, b), concatenating the per-gate parameters if needed."""
+
+        if self._packed:
+            return self._W, self._b
+        W_x = torch.cat((self._W_x2f, self._W_x2c), 1)
+        W_h = torch.cat((self._W_h2f, self._W_h2c), 1)
+        b = torch.cat((self._b_f, self._b_c), 0)
+        return torch.cat((W_x, W_h), 0), b
+
+    def _gates2state(self, gates, last_state: JANETState) -> JANETState:
+        """Computes the hidden state from the packed gate pre-activations.
+
+        Args:
+            gates: [batch_size, 2*hidden_size] pre-activations of the f and c gates.
+            last_state: previous hidden state.
+
+        Returns:
+            current hidden state.
+        """
+
+        if not torch.jit.is_scripting():
+            if self._memory_efficient and not self._layer_norm:
+                return JANETState(JANETPointwise.apply(gates, last_state.h))
+
+        pre_f, cp = gates.chunk(2, 1)
+        f = torch.sigmoid(pre_f)
+
+        if self._layer_norm:
+            cp = self._ln(cp)
+        cp = torch.tanh(cp)
+
+        c = f * last_state.h + (1-f) * cp
+
+        h = c
+
+        return JANETState(h)
+
+    def _convert_state_dict(self, state_dict, prefix, *args):
+        """Loads checkpoints saved with the other (packed or per-gate) weight layout."""
+
+        convert_state_dict(state_dict, prefix, self._GATES, self._packed, self._input_size, self._hidden_size)
 
     def _reset_parameters(self):
         """Initializes the RNN Cell parameters."""
 
-        nn.init.xavier_normal_(self._W_x2f)
-        nn.init.xavier_normal_(self._W_x2c)
+        (W_x2f, W_h2f, b_f), (W_x2c, W_h2c, b_c) = gate_blocks(self, self._GATES)
+
+        with torch.no_grad():
+            nn.init.xavier_normal_(W_x2f)
+            nn.init.xavier_normal_(W_x2c)
 
-        nn.init.orthogonal_(self._W_h2f)
-        nn.init.orthogonal_(self._W_h2c)
+            nn.init.orthogonal_(W_h2f)
+            nn.init.orthogonal_(W_h2c)
 
-        nn.init.constant_(self._b_f, 1)
-        nn.init.constant_(self._b_c, 0)
+            nn.init.constant_(b_f, 1)
+            nn.init.constant_(b_c, 0)
 
-        if self._chrono_init:
-            print(self._t_max)
-            b_f = torch.from_numpy(np.log(np.random.randint(1, self._t_max + 1, size=self._hidden_size)))
-            self._b_f.data.copy_(b_f)
+            if self._chrono_init:
+                print(self._t_max)
+                b_f.copy_(torch.from_numpy(np.log(np.random.randint(1, self._t_max + 1, size=self._hidden_size))))
@@ -1,13 +1,43 @@
 """Implementation of an LSTM Cell."""
+from typing import Dict, Final, NamedTuple, Tuple
+
 import torch
 import torch.nn as nn
 import numpy as np
 
+from myTorch.memory.functions import LSTMPointwise
+from myTorch.memory.jacobians import diag_mm, layer_norm_jacobian, recurrent_jacobian
+from myTorch.memory.packing import gate_blocks, convert_state_dict, project_inputs
+
+
+class LSTMState(NamedTuple):
+    """Hidden state of an LSTM Cell."""
+
+    h: torch.Tensor
+    c: torch.Tensor
+
 
 class LSTMCell(nn.Module):
-    """Implementation of an LSTM Cell based on https://arxiv.org/pdf/1308.0850.pdf"""
+    """Implementation of an LSTM Cell based on https://arxiv.org/pdf/1308.0850.pdf
 
-    def __init__(self, device, input_size, hidden_size, layer_norm=False, chrono_init=False, t_max=10):
+    The cell is scriptable with torch.jit.script: `step` and `step_sequence` work on a typed
+    LSTMState, `forward` and `forward_sequence` are dictionary adapters over them.
+    """
+
+    _input_size: Final[int]
+    _hidden_size: Final[int]
+    _layer_norm: Final[bool]
+    _packed: Final[bool]
+    _memory_efficient: Final[bool]
+
+    # (W_x, W_h, b) of every gate, in the column order of the packed weights.
+    _GATES = (("_W_x2i", "_W_h2i", "_b_i"),
+              ("_W_x2f", "_W_h2f", "_b_f"),
+              ("_W_x2c", "_W_h2c", "_b_c"),
+              ("_W_x2o", "_W_h2o", "_b_o"))
+
+    def __init__(self, device, input_size, hidden_size, layer_norm=False, chrono_init=False, t_max=10,
+                 packed=False, peephole=True, memory_efficient=False):
         """Initializes an LSTM Cell.
 
         Args:
@@ -15,6 +45,11 @@ class LSTMCell(nn.Module):
             input_size: int, size of the input vector.
             hidden_size: int, LSTM hidden layer dimension.
             layer_norm: bool, if True, applies layer normalization.
+            packed: bool, if True, stores all gate weights in one [input+hidden, 4*hidden] parameter
+                and computes every gate pre-activation with a single matmul.
+            peephole: bool, if False, the peephole weights W_c2* are fixed to zero.
+            memory_efficient: bool, if True and without layer normalization, uses a hand-written
+                backward that only saves the gate activations.
         """
 
         super(LSTMCell, self).__init__()
@@ -25,25 +60,41 @@ class LSTMCell(nn.Module):
         self._layer_norm = layer_norm
         self._chrono_init = chrono_init
         self._t_max = t_max
+        self._packed = packed
+        self._memory_efficient = memory_efficient
+        self._peephole = peephole
+
+        if self._packed:
+            self._W = nn.Parameter(torch.Tensor(input_size + hidden_size, 4 * hidden_size))
+            self._b = nn.Parameter(torch.Tensor(4 * hidden_size))
+            self._W_c2i = nn.Parameter(torch.Tensor(hidden_size))
+            self._W_c2f = nn.Parameter(torch.Tensor(hidden_size))
+            self._W_c2o = nn.Parameter(torch.Tensor(hidden_size))
+        else:
+            self._W_x2i = nn.Parameter(torch.Tensor(input_size, hidden_size))
+            self._W_h2i = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
+            self._W_c2i = nn.Parameter(torch.Tensor(hidden_size))
+            self._b_i = nn.Parameter(torch.Tensor(hidden_size))
+
+            self._W_x2f = nn.Parameter(torch.Tensor(input_size, hidden_size))
+            self._W_h2f = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
+            self._W_c2f = nn.Parameter(torch.Tensor(hidden_size))
+            self._b_f = nn.Parameter(torch.Tensor(hidden_size))
 
-        self._W_x2i = nn.Parameter(torch.Tensor(input_size, hidden_size))
-        self._W_h2i = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
-        self._W_c2i = nn.Parameter(torch.Tensor(hidden_size))
-        self._b_i = nn.Parameter(torch.Tensor(hidden_size))
-        
-        self._W_x2f = nn.Parameter(torch.Tensor(input_size, hidden_size))
-        self._W_h2f = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
-        self._W_c2f = nn.Parameter(torch.Tensor(hidden_size))
-        self._b_f = nn.Parameter(torch.Tensor(hidden_size))
-        
-        self._W_x2o = nn.Parameter(torch.Tensor(input_size, hidden_size))
-        self._W_h2o = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
-        self._W_c2o = nn.Parameter(torch.Tensor(hidden_size))
-        self._b_o = nn.Parameter(torch.Tensor(hidden_size))
-        
-        self._W_x2c = nn.Parameter(torch.Tensor(input_size, hidden_size))
-        self._W_h2c = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
-        self._b_c = nn.Parameter(torch.Tensor(hidden_size))
+            self._W_x2o = nn.Parameter(torch.Tensor(input_size, hidden_size))
+            self._W_h2o = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
+            self._W_c2o = nn.Parameter(torch.Tensor(hidden_size))
+            self._b_o = nn.Parameter(torch.Tensor(hidden_size))
+
+            self._W_x2c = nn.Parameter(torch.Tensor(input_size, hidden_size))
+            self._W_h2c = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
+            self._b_c = nn.Parameter(torch.Tensor(hidden_size))
+
+        if not self._peephole:
+            # zero buffers keep the state dict keys of the peephole weights.
+            for name in ("_W_c2i", "_W_c2f", "_W_c2o"):
+                delattr(self, name)
+                self.register_buffer(name, torch.zeros(hidden_size))
 
         if self._layer_norm:
             self._ln_c = nn.LayerNorm(hidden_size)
@@ -51,10 +102,11 @@ class LSTMCell(nn.Module):
             self._ln_f = nn.LayerNorm(hidden_size)
             self._ln_o = nn.LayerNorm(hidden_size)
             self._ln_g = nn.LayerNorm(hidden_size)
-        
+
+        self._register_load_state_dict_pre_hook(self._convert_state_dict)
         self._reset_parameters()
 
-    def forward(self, input, last_hidden):
+    def forward(self, input, last_hidden: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         """Implements forward computation of an LSTM Cell.
 
         Args:
@@ -64,79 +116,214 @@ class LSTMCell(nn.Module):
         Returns:
             current hidden state as a dictionary.
         """
- 
-        self._W_i = torch.cat((self._W_x2i, self._W_h2i), 0)
-        self._W_f = torch.cat((self._W_x2f, self._W_h2f), 0)
-        self._W_o = torch.cat((self._W_x2o, self._W_h2o), 0)
-        self._W_c = torch.cat((self._W_x2c, self._W_h2c), 0)
- 
-        c_input = torch.cat((input, last_hidden["h"]), 1)
-
-        pre_i = torch.mm(c_input, self._W_i) + self._b_i + last_hidden["c"] * self._W_c2i
+
+        state = self.step(input, LSTMState(last_hidden["h"], last_hidden["c"]))
+        return {"h": state.h, "c": state.c}
+
+    @torch.jit.export
+    def forward_sequence(self, inputs,
+                         last_hidden: Dict[str, torch.Tensor]) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        """Implements forward computation over a whole sequence.
+
+        Args:
+            inputs: [seq_len, batch_size, input_size] input sequence.
+            last_hidden: hidden state dictionary before the first time step.
+
+        Returns:
+            [seq_len, batch_size, hidden_size] hidden outputs and the last hidden state dictionary.
+        """
+
+        outputs, state = self.step_sequence(inputs, LSTMState(last_hidden["h"], last_hidden["c"]))
+        return outputs, {"h": state.h, "c": state.c}
+
+    @torch.jit.export
+    def step(self, input, state: LSTMState) -> LSTMState:
+        """Computes one time step on a typed hidden state."""
+
+        W, b = self._packed_weights()
+        c_input = torch.cat((input, state.h), 1)
+        return self._gates2state(torch.addmm(b, c_input, W).to(state.h.dtype), state)
+
+    @torch.jit.export
+    def step_sequence(self, inputs, state: LSTMState) -> Tuple[torch.Tensor, LSTMState]:
+        """Computes a whole sequence on a typed hidden state.
+
+        The input-to-hidden products do not depend on the recurrence, so they are computed
+        for all time steps with one matmul and only the recurrent part runs in the time loop.
+        """
+
+        W, b = self._packed_weights()
+        x_proj = project_inputs(inputs, W[:self._input_size], b)
+        W_h = W[self._input_size:]
+
+        outputs = []
+        for x_t in x_proj.unbind(0):
+            state = self._gates2state(torch.addmm(x_t, state.h, W_h).to(state.h.dtype), state)
+            outputs.append(state.h)
+        return torch.stack(outputs), state
+
+    @torch.jit.export
+    def step_jacobian(self, input, last_hidden: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """Computes the Jacobian dh_t/dh_(t-1) of one time step in closed form.
+
+        The cell state c_(t-1) is held fixed.
+
+        Args:
+            input: [batch_size, input_size] current input vector.
+            last_hidden: previous hidden state dictionary.
+
+        Returns:
+            [batch_size, hidden_size, hidden_size] Jacobian, entry [b, i, j] is the derivative
+            of h_t[b, i] w.r.t. h_(t-1)[b, j].
+        """
+
+        h, last_c = last_hidden["h"], last_hidden["c"]
+        W, b = self._packed_weights()
+        gates = torch.addmm(b, torch.cat((input, h), 1), W).to(h.dtype)
+        pre_i, pre_f, pre_cp, pre_o = gates.chunk(4, 1)
+        J_i, J_f, J_cp, J_o = recurrent_jacobian(W[self._input_size:], h.shape[0]).chunk(4, 1)
+
+        pre_i = pre_i + last_c * self._W_c2i
         if self._layer_norm:
+            J_i = layer_norm_jacobian(pre_i, J_i, self._ln_i.weight, self._ln_i.eps)
             pre_i = self._ln_i(pre_i)
         i = torch.sigmoid(pre_i)
+        J_i = diag_mm(i * (1 - i), J_i)
 
-        pre_f = torch.mm(c_input, self._W_f) + self._b_f + last_hidden["c"] * self._W_c2f
+        pre_f = pre_f + last_c * self._W_c2f
         if self._layer_norm:
+            J_f = layer_norm_jacobian(pre_f, J_f, self._ln_f.weight, self._ln_f.eps)
             pre_f = self._ln_f(pre_f)
         f = torch.sigmoid(pre_f)
+        J_f = diag_mm(f * (1 - f), J_f)
 
-        cp_input = torch.cat((input, last_hidden["h"]), 1)
-        pre_cp = torch.mm(cp_input, self._W_c) + self._b_c
         if self._layer_norm:
+            J_cp = layer_norm_jacobian(pre_cp, J_cp, self._ln_g.weight, self._ln_g.eps)
             pre_cp = self._ln_g(pre_cp)
         cp = torch.tanh(pre_cp)
+        J_cp = diag_mm(1 - cp * cp, J_cp)
 
-        c = f * last_hidden["c"] + i * cp
+        c = f * last_c + i * cp
+        J_c = diag_mm(last_c, J_f) + diag_mm(cp, J_i) + diag_mm(i, J_cp)
 
-        o_input = torch.cat((input, last_hidden["h"]), 1)
-        pre_o = torch.mm(o_input, self._W_o) + self._b_o + c * self._W_c2o
+        pre_o = pre_o + c * self._W_c2o
+        J_o = J_o + diag_mm(self._W_c2o.expand_as(c), J_c)
         if self._layer_norm:
+            J_o = layer_norm_jacobian(pre_o, J_o, self._ln_o.weight, self._ln_o.eps)
             pre_o = self._ln_o(pre_o)
         o = torch.sigmoid(pre_o)
+        J_o = diag_mm(o * (1 - o), J_o)
 
         if self._layer_norm:
+            J_c = layer_norm_jacobian(c, J_c, self._ln_c.weight, self._ln_c.eps)
             c = self._ln_c(c)
-        h = o*torch.tanh(c)
-        
-        hidden = {}
-        hidden["h"] = h
-        hidden["c"] = c 
-        return hidden
+        tanh_c = torch.tanh(c)
+        return diag_mm(tanh_c, J_o) + diag_mm(o * (1 - tanh_c * tanh_c), J_c)
+
+    @torch.jit.export
+    def init_state(self, batch_size: int) -> LSTMState:
+        """Returns an all-zero typed hidden state."""
 
-    def reset_hidden(self, batch_size):
+        return LSTMState(torch.zeros(batch_size, self._hidden_size, device=self._device),
+                         torch.zeros(batch_size, self._hidden_size, device=self._device))
+
+    @torch.jit.export
+    def reset_hidden(self, batch_size: int) -> Dict[str, torch.Tensor]:
         """Resets the hidden state for truncating the dependency."""
 
-        hidden = {}
-        hidden["h"] = torch.Tensor(np.zeros((batch_size, self._hidden_size))).to(self._device)
-        hidden["c"] = torch.Tensor(np.zeros((batch_size, self._hidden_size))).to(self._device)
-        return hidden
+        state = self.init_state(batch_size)
+        return {"h": state.h, "c": state.c}
+
+    @torch.jit.export
+    def _packed_weights(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the packed (W, b), concatenating the per-gate parameters if needed."""
+
+        if self._packed:
+            return self._W, self._b
+        W_x = torch.cat((self._W_x2i, self._W_x2f, self._W_x2c, self._W_x2o), 1)
+        W_h = torch.cat((self._W_h2i, self._W_h2f, self._W_h2c, self._W_h2o), 1)
+        b = torch.cat((self._b_i, self._b_f, self._b_c, self._b_o), 0)
+        return torch.cat((W_x, W_h), 0), b
+
+    def _gates2state(self, gates, last_state: LSTMState) -> LSTMState:
+        """Computes the hidden state from the packed gate pre-activations.
+
+        Args:
+            gates: [batch_size, 4*hidden_size] pre-activations of the i, f, c and o gates.
+            last_state: previous hidden state.
+
+        Returns:
+            current hidden state.
+        """
+
+        if not torch.jit.is_scripting():
+            if self._memory_efficient and not self._layer_norm:
+                h, c = LSTMPointwise.apply(gates, last_state.c, self._W_c2i, self._W_c2f, self._W_c2o)
+                return LSTMState(h, c)
+
+        pre_i, pre_f, pre_cp, pre_o = gates.chunk(4, 1)
+
+        pre_i = pre_i + last_state.c * self._W_c2i
+        if self._layer_norm:
+            pre_i = self._ln_i(pre_i)
+        i = torch.sigmoid(pre_i)
+
+        pre_f = pre_f + last_state.c * self._W_c2f
+        if self._layer_norm:
+            pre_f = self._ln_f(pre_f)
+        f = torch.sigmoid(pre_f)
+
+        if self._layer_norm:
+            pre_cp = self._ln_g(pre_cp)
+        cp = torch.tanh(pre_cp)
+
+        c = f * last_state.c + i * cp
+
+        pre_o = pre_o + c * self._W_c2o
+        if self._layer_norm:
+            pre_o = self._ln_o(pre_o)
+        o = torch.sigmoid(pre_o)
+
+        if self._layer_norm:
+            c = self._ln_c(c)
+        h = o*torch.tanh(c)
+
+        return LSTMState(h, c)
+
+    def _convert_state_dict(self, state_dict, prefix, *args):
+        """Loads checkpoints saved with the other (packed or per-gate) weight layout."""
+
+        convert_state_dict(state_dict, prefix, self._GATES, self._packed, self._input_size, self._hidden_size)
 
     def _reset_parameters(self):
         """Initializes the RNN Cell parameters."""
 
-        nn.init.xavier_normal_(self._W_x2i)
-        nn.init.xavier_normal_(self._W_x2f)
-        nn.init.xavier_normal_(self._W_x2o)
-        nn.init.xavier_normal_(self._W_x2c)
-        
-        nn.init.orthogonal_(self._W_h2i)
-        nn.init.orthogonal_(self._W_h2f)
-        nn.init.orthogonal_(self._W_h2o)
-        nn.init.orthogonal_(self._W_h2c)
-        
-        nn.init.uniform_(self._W_c2i)
-        nn.init.uniform_(self._W_c2f)
-        nn.init.uniform_(self._W_c2o)
-        
-        nn.init.constant_(self._b_i, 0)
-        nn.init.constant_(self._b_f, 1)
-        nn.init.constant_(self._b_o, 0)
-        nn.init.constant_(self._b_c, 0)
-
-        if self._chrono_init:
-            print(self._t_max)
-            b_f = torch.from_numpy(np.log(np.random.randint(1, self._t_max+1, size=self._hidden_size)))
-            self._b_f.data.copy_(b_f)
-            self._b_i.data.copy_(-b_f)
\ No newline at end of file
+        (W_x2i, W_h2i, b_i), (W_x2f, W_h2f, b_f), (W_x2c, W_h2c, b_c), (W_x2o, W_h2o, b_o) = \
+            gate_blocks(self, self._GATES)
+
+        with torch.no_grad():
+            nn.init.xavier_normal_(W_x2i)
+            nn.init.xavier_normal_(W_x2f)
+            nn.init.xavier_normal_(W_x2o)
+            nn.init.xavier_normal_(W_x2c)
+
+            nn.init.orthogonal_(W_h2i)
+            nn.init.orthogonal_(W_h2f)
+            nn.init.orthogonal_(W_h2o)
+            nn.init.orthogonal_(W_h2c)
+
+            if self._peephole:
+                nn.init.uniform_(self._W_c2i)
+                nn.init.uniform_(self._W_c2f)
+                nn.init.uniform_(self._W_c2o)
+
+            nn.init.constant_(b_i, 0)
+            nn.init.constant_(b_f, 1)
+            nn.init.constant_(b_o, 0)
+            nn.init.constant_(b_c, 0)
+
+            if self._chrono_init:
+                print(self._t_max)
+                b_f_chrono = torch.from_numpy(np.log(np.random.randint(1, self._t_max+1, size=self._hidden_size)))
+                b_f.copy_(b_f_chrono)
+                b_i.copy_(-b_f_chrono)
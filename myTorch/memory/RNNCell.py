@@ -1,14 +1,39 @@
 """Implementation of an RNN Cell."""
+from typing import Dict, Final, NamedTuple, Tuple
+
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from myTorch.memory.jacobians import diag_mm, layer_norm_jacobian, recurrent_jacobian
+from myTorch.memory.packing import gate_blocks, convert_state_dict, project_inputs
+
+
+class RNNState(NamedTuple):
+    """Hidden state of an RNN Cell."""
+
+    h: torch.Tensor
+
 
 class RNNCell(nn.Module):
-    """Implementation of an RNN Cell."""
+    """Implementation of an RNN Cell.
+
+    The cell is scriptable with torch.jit.script: `step` and `step_sequence` work on a typed
+    RNNState, `forward` and `forward_sequence` are dictionary adapters over them.
+    """
+
+    _input_size: Final[int]
+    _hidden_size: Final[int]
+    _activation: Final[str]
+    _layer_norm: Final[bool]
+    _packed: Final[bool]
 
-    def __init__(self, device, input_size, hidden_size, activation="tanh", layer_norm=False, identity_init=False):
+    # (W_x, W_h, b) of the single hidden "gate", in the layout of the packed weights.
+    _GATES = (("_W_i2h", "_W_h2h", "_b_h"),)
+
+    def __init__(self, device, input_size, hidden_size, activation="tanh", layer_norm=False, identity_init=False,
+                 packed=False):
         """Initializes an RNN Cell.
 
         Args:
@@ -18,6 +43,7 @@ class RNNCell(nn.Module):
             activation: str, hidden layer activation function.
             layer_norm: bool, if True, applies layer normalization.
             identity_init: bool, if true, initializes hidden matrix with identity matrix.
+            packed: bool, if True, stores the weights in one [input+hidden, hidden] parameter.
         """
         
         super(RNNCell, self).__init__()
@@ -28,24 +54,23 @@ class RNNCell(nn.Module):
         self._activation = activation
         self._layer_norm = layer_norm
         self._identity_init = identity_init
+        self._packed = packed
 
-        if self._activation == "tanh":
-            self._activation_fn = F.tanh
-        elif self._activation == "sigmoid":
-            self._activation_fn = F.sigmoid
-        elif self._activation == "relu":
-            self._activation_fn = F.relu
-        
-        self._W_i2h = nn.Parameter(torch.Tensor(input_size, hidden_size))
-        self._W_h2h = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
-        self._b_h = nn.Parameter(torch.Tensor(hidden_size))
+        if self._packed:
+            self._W = nn.Parameter(torch.Tensor(input_size + hidden_size, hidden_size))
+            self._b = nn.Parameter(torch.Tensor(hidden_size))
+        else:
+            self._W_i2h = nn.Parameter(torch.Tensor(input_size, hidden_size))
+            self._W_h2h = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
+            self._b_h = nn.Parameter(torch.Tensor(hidden_size))
 
         if self._layer_norm:
             self._ln = nn.LayerNorm(hidden_size)
 
+        self._register_load_state_dict_pre_hook(self._convert_state_dict)
         self._reset_parameters()
 
-    def forward(self, input, last_hidden):
+    def forward(self, input, last_hidden: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         """Implements forward computation of an RNN Cell.
 
         Args:
@@ -56,29 +81,137 @@ class RNNCell(nn.Module):
             current hidden state as a dictionary.
         """
 
-        c_input = torch.cat((input, last_hidden["h"]), 1)
-        W_h = torch.cat((self._W_i2h, self._W_h2h), 0)
-        pre_hidden = torch.add(torch.mm(c_input, W_h), self._b_h)
+        state = self.step(input, RNNState(last_hidden["h"]))
+        return {"h": state.h}
+
+    @torch.jit.export
+    def forward_sequence(self, inputs,
+                         last_hidden: Dict[str, torch.Tensor]) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        """Implements forward computation over a whole sequence.
+
+        Args:
+            inputs: [seq_len, batch_size, input_size] input sequence.
+            last_hidden: hidden state dictionary before the first time step.
+
+        Returns:
+            [seq_len, batch_size, hidden_size] hidden outputs and the last hidden state dictionary.
+        """
+
+        outputs, state = self.step_sequence(inputs, RNNState(last_hidden["h"]))
+        return outputs, {"h": state.h}
+
+    @torch.jit.export
+    def step(self, input, state: RNNState) -> RNNState:
+        """Computes one time step on a typed hidden state."""
+
+        W, b = self._packed_weights()
+        c_input = torch.cat((input, state.h), 1)
+        return self._gates2state(torch.addmm(b, c_input, W).to(state.h.dtype))
+
+    @torch.jit.export
+    def step_sequence(self, inputs, state: RNNState) -> Tuple[torch.Tensor, RNNState]:
+        """Computes a whole sequence on a typed hidden state.
+
+        The input-to-hidden products do not depend on the recurrence, so they are computed
+        for all time steps with one matmul and only the recurrent part runs in the time loop.
+        """
+
+        W, b = self._packed_weights()
+        x_proj = project_inputs(inputs, W[:self._input_size], b)
+        W_h = W[self._input_size:]
+
+        outputs = []
+        for x_t in x_proj.unbind(0):
+            state = self._gates2state(torch.addmm(x_t, state.h, W_h).to(state.h.dtype))
+            outputs.append(state.h)
+        return torch.stack(outputs), state
+
+    @torch.jit.export
+    def step_jacobian(self, input, last_hidden: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """Computes the Jacobian dh_t/dh_(t-1) of one time step in closed form.
+
+        Args:
+            input: [batch_size, input_size] current input vector.
+            last_hidden: previous hidden state dictionary.
+
+        Returns:
+            [batch_size, hidden_size, hidden_size] Jacobian, entry [b, i, j] is the derivative
+            of h_t[b, i] w.r.t. h_(t-1)[b, j].
+        """
+
+        h = last_hidden["h"]
+        W, b = self._packed_weights()
+        pre_hidden = torch.addmm(b, torch.cat((input, h), 1), W).to(h.dtype)
+        J = recurrent_jacobian(W[self._input_size:], h.shape[0])
+
         if self._layer_norm:
+            J = layer_norm_jacobian(pre_hidden, J, self._ln.weight, self._ln.eps)
             pre_hidden = self._ln(pre_hidden)
-        h = self._activation_fn(pre_hidden)
 
-        hidden = {}
-        hidden["h"] = h
-        return hidden
+        if self._activation == "sigmoid":
+            a = torch.sigmoid(pre_hidden)
+            d = a * (1 - a)
+        elif self._activation == "relu":
+            d = (pre_hidden > 0).to(pre_hidden.dtype)
+        else:
+            a = torch.tanh(pre_hidden)
+            d = 1 - a * a
+        return diag_mm(d, J)
 
-    def reset_hidden(self, batch_size):
+    @torch.jit.export
+    def init_state(self, batch_size: int) -> RNNState:
+        """Returns an all-zero typed hidden state."""
+
+        return RNNState(torch.zeros(batch_size, self._hidden_size, device=self._device))
+
+    @torch.jit.export
+    def reset_hidden(self, batch_size: int) -> Dict[str, torch.Tensor]:
         """Resets the hidden state for truncating the dependency."""
 
-        hidden = {}
-        hidden["h"] = torch.Tensor(np.zeros((batch_size, self._hidden_size))).to(self._device)
-        return hidden
+        return {"h": self.init_state(batch_size).h}
+
+    def _packed_weights(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the packed (W, b), concatenating the per-gate parameters if needed."""
+
+        if self._packed:
+            return self._W, self._b
+        return torch.cat((self._W_i2h, self._W_h2h), 0), self._b_h
+
+    def _gates2state(self, pre_hidden) -> RNNState:
+        """Computes the hidden state from the hidden pre-activation.
+
+        Args:
+            pre_hidden: [batch_size, hidden_size] pre-activation of the hidden layer.
+
+        Returns:
+            current hidden state.
+        """
+
+        if self._layer_norm:
+            pre_hidden = self._ln(pre_hidden)
+
+        if self._activation == "sigmoid":
+            h = torch.sigmoid(pre_hidden)
+        elif self._activation == "relu":
+            h = F.relu(pre_hidden)
+        else:
+            h = torch.tanh(pre_hidden)
+
+        return RNNState(h)
+
+    def _convert_state_dict(self, state_dict, prefix, *args):
+        """Loads checkpoints saved with the other (packed or per-gate) weight layout."""
+
+        convert_state_dict(state_dict, prefix, self._GATES, self._packed, self._input_size, self._hidden_size)
 
     def _reset_parameters(self):
         """Initializes the RNN Cell parameters."""
 
-        nn.init.xavier_normal(self._W_i2h, gain=nn.init.calculate_gain(self._activation))
-        nn.init.orthogonal_(self._W_h2h)
-        if self._identity_init:
-            self._W_h2h.data.copy_(torch.eye(self._hidden_size))
-        nn.init.constant_(self._b_h, 0)
+        (W_i2h, W_h2h, b_h), = gate_blocks(self, self._GATES)
+
+        with torch.no_grad():
+            nn.init.xavier_normal_(W_i2h, gain=nn.init.calculate_gain(self._activation))
+            nn.init.orthogonal_(W_h2h)
+            if self._identity_init:
+                W_h2h.copy_(torch.eye(self._hidden_size))
+            nn.init.constant_(b_h, 0)
@@ -0,0 +1,172 @@
+"""Hand-written autograd Functions for the recurrent steps of the memory cells.
+
+Autograd keeps every intermediate of a cell step alive for the backward pass. These
+Functions only save the gate activations and the previous state, and recompute the cheap
+pieces (e.g. tanh(c), r * h) during backward. They cover the cells without layer
+normalization.
+
+Run this file to gradcheck the Functions and compare them with the autograd cells.
+"""
+import torch
+
+
+class LSTMPointwise(torch.autograd.Function):
+    """Pointwise part of an LSTM step, from the gate pre-activations to the new (h, c)."""
+
+    @staticmethod
+    def forward(ctx, gates, c_prev, W_c2i, W_c2f, W_c2o):
+        """Computes the new LSTM state.
+
+        Args:
+            gates: [batch_size, 4*hidden_size] pre-activations of the i, f, c and o gates.
+            c_prev: [batch_size, hidden_size] previous cell state.
+            W_c2i, W_c2f, W_c2o: [hidden_size] peephole weights.
+
+        Returns:
+            new hidden state h and cell state c.
+        """
+
+        pre_i, pre_f, pre_cp, pre_o = gates.chunk(4, 1)
+        i = torch.sigmoid(pre_i + c_prev * W_c2i)
+        f = torch.sigmoid(pre_f + c_prev * W_c2f)
+        cp = torch.tanh(pre_cp)
+        c = f * c_prev + i * cp
+        o = torch.sigmoid(pre_o + c * W_c2o)
+        h = o * torch.tanh(c)
+
+        ctx.save_for_backward(torch.cat((i, f, cp, o), 1), c_prev, c, W_c2i, W_c2f, W_c2o)
+        return h, c
+
+    @staticmethod
+    def backward(ctx, grad_h, grad_c):
+        acts, c_prev, c, W_c2i, W_c2f, W_c2o = ctx.saved_tensors
+        i, f, cp, o = acts.chunk(4, 1)
+        tanh_c = torch.tanh(c)
+
+        grad_pre_o = grad_h * tanh_c * o * (1 - o)
+        grad_c = grad_c + grad_h * o * (1 - tanh_c * tanh_c) + grad_pre_o * W_c2o
+
+        grad_pre_i = grad_c * cp * i * (1 - i)
+        grad_pre_f = grad_c * c_prev * f * (1 - f)
+        grad_pre_cp = grad_c * i * (1 - cp * cp)
+
+        grad_gates = torch.cat((grad_pre_i, grad_pre_f, grad_pre_cp, grad_pre_o), 1)
+        grad_c_prev = grad_c * f + grad_pre_i * W_c2i + grad_pre_f * W_c2f
+
+        return (grad_gates, grad_c_prev, (grad_pre_i * c_prev).sum(0), (grad_pre_f * c_prev).sum(0),
+                (grad_pre_o * c).sum(0))
+
+
+class GRUStep(torch.autograd.Function):
+    """Recurrent part of a GRU step, from the input projections and h to the new h.
+
+    The candidate state needs `r * h` before its recurrent matmul, so the Function
+    includes the recurrent matmuls.
+    """
+
+    @staticmethod
+    def forward(ctx, x_proj, h_prev, W_h):
+        """Computes the new GRU state.
+
+        Args:
+            x_proj: [batch_size, 3*hidden_size] input projections (with biases) of the r, z and h gates.
+            h_prev: [batch_size, hidden_size] previous hidden state.
+            W_h: [hidden_size, 3*hidden_size] packed recurrent weights.
+
+        Returns:
+            new hidden state h.
+        """
+
+        H = h_prev.shape[1]
+        x_rz, x_h = x_proj.split([2 * H, H], 1)
+        r, z = torch.sigmoid(torch.addmm(x_rz, h_prev, W_h[:, :2 * H]).to(h_prev.dtype)).chunk(2, 1)
+        hp = torch.tanh(torch.addmm(x_h, h_prev * r, W_h[:, 2 * H:]).to(h_prev.dtype))
+        h = (1 - z) * hp + z * h_prev
+
+        ctx.save_for_backward(torch.cat((r, z, hp), 1), h_prev, W_h)
+        return h
+
+    @staticmethod
+    def backward(ctx, grad_h):
+        acts, h_prev, W_h = ctx.saved_tensors
+        H = h_prev.shape[1]
+        r, z, hp = acts.chunk(3, 1)
+        W_rz, W_hh = W_h[:, :2 * H], W_h[:, 2 * H:]
+        h_r = h_prev * r
+
+        grad_pre_hp = grad_h * (1 - z) * (1 - hp * hp)
+        grad_h_r = torch.mm(grad_pre_hp, W_hh.t())
+        grad_pre_r = grad_h_r * h_prev * r * (1 - r)
+        grad_pre_z = grad_h * (h_prev - hp) * z * (1 - z)
+        grad_pre_rz = torch.cat((grad_pre_r, grad_pre_z), 1)
+
+        grad_h_prev = grad_h * z + grad_h_r * r + torch.mm(grad_pre_rz, W_rz.t())
+        grad_W_h = torch.cat((torch.mm(h_prev.t(), grad_pre_rz), torch.mm(h_r.t(), grad_pre_hp)), 1)
+
+        return torch.cat((grad_pre_rz, grad_pre_hp), 1), grad_h_prev, grad_W_h
+
+
+class JANETPointwise(torch.autograd.Function):
+    """Pointwise part of a JANET step, from the gate pre-activations to the new h."""
+
+    @staticmethod
+    def forward(ctx, gates, h_prev):
+        """Computes the new JANET state.
+
+        Args:
+            gates: [batch_size, 2*hidden_size] pre-activations of the f and c gates.
+            h_prev: [batch_size, hidden_size] previous hidden state.
+
+        Returns:
+            new hidden state h.
+        """
+
+        pre_f, pre_cp = gates.chunk(2, 1)
+        f = torch.sigmoid(pre_f)
+        cp = torch.tanh(pre_cp)
+        h = f * h_prev + (1 - f) * cp
+
+        ctx.save_for_backward(f, cp, h_prev)
+        return h
+
+    @staticmethod
+    def backward(ctx, grad_h):
+        f, cp, h_prev = ctx.saved_tensors
+
+        grad_pre_f = grad_h * (h_prev - cp) * f * (1 - f)
+        grad_pre_cp = grad_h * (1 - f) * (1 - cp * cp)
+
+        return torch.cat((grad_pre_f, grad_pre_cp), 1), grad_h * f
+
+
+if __name__ == "__main__":
+    from torch.autograd import gradcheck
+
+    from myTorch.memory import GRUCell, JANETCell, LSTMCell
+
+    torch.manual_seed(5)
+    torch.set_default_dtype(torch.float64)
+    B, H = 3, 5
+    kwargs = dict(dtype=torch.float64, requires_grad=True)
+
+    assert gradcheck(LSTMPointwise.apply, (torch.randn(B, 4 * H, **kwargs), torch.randn(B, H, **kwargs),
+                                           torch.randn(H, **kwargs), torch.randn(H, **kwargs),
+                                           torch.randn(H, **kwargs)))
+    assert gradcheck(GRUStep.apply, (torch.randn(B, 3 * H, **kwargs), torch.randn(B, H, **kwargs),
+                                     torch.randn(H, 3 * H, **kwargs)))
+    assert gradcheck(JANETPointwise.apply, (torch.randn(B, 2 * H, **kwargs), torch.randn(B, H, **kwargs)))
+    print("gradcheck passed")
+
+    device = torch.device("cpu")
+    x = torch.randn(7, B, 4)
+    for cell_class in [LSTMCell, GRUCell, JANETCell]:
+        cells = [cell_class(device, 4, H, memory_efficient=memory_efficient)
+                 for memory_efficient in [False, True]]
+        cells[1].load_state_dict(cells[0].state_dict())
+        results = []
+        for cell in cells:
+            outputs, _ = cell.forward_sequence(x, cell.reset_hidden(B))
+            outputs.pow(2).sum().backward()
+            results.append([outputs] + [p.grad for p in cell.parameters()])
+        print("{} max difference to autograd: {}".format(
+            cell_class.__name__, max((a - b).abs().max().item() for a, b in zip(*results))))
@@ -0,0 +1,78 @@
+"""Streaming inference for memory cells, e.g. recurrent policies stepping batched environments."""
+import torch
+
+
+class InferenceEngine(object):
+    """Steps a memory cell under torch.inference_mode with preallocated hidden buffers.
+
+    The hidden state dictionary is allocated once per batch size on the cell device and
+    updated in place on every step, so the dictionary returned by `hidden` stays valid for
+    the whole rollout. Tensors created by the engine are inference tensors and can not be
+    used for autograd.
+    """
+
+    def __init__(self, cell):
+        """Initializes the engine.
+
+        Args:
+            cell: memory cell with the dictionary `forward` and `reset_hidden` api.
+        """
+
+        self._cell = cell
+        self._hidden = None
+
+    @property
+    def hidden(self):
+        return self._hidden
+
+    def reset_hidden(self, batch_size):
+        """Zeroes the hidden buffers, allocating them only if the batch size changed."""
+
+        with torch.inference_mode():
+            if self._hidden is not None and self._hidden["h"].shape[0] == batch_size:
+                for h in self._hidden.values():
+                    h.zero_()
+            else:
+                self._hidden = self._cell.reset_hidden(batch_size)
+
+    def mask_hidden(self, mask):
+        """Multiplies the hidden buffers in place by a [batch_size, 1] mask.
+
+        Args:
+            mask: 0 for the environments whose state is reset, 1 otherwise.
+        """
+
+        with torch.inference_mode():
+            for h in self._hidden.values():
+                h.mul_(mask)
+
+    def reset_done(self, dones):
+        """Zeroes the hidden state of the environments that are done, in place.
+
+        Args:
+            dones: [batch_size] tensor or array, nonzero for finished environments.
+        """
+
+        with torch.inference_mode():
+            done_mask = torch.as_tensor(dones, device=self._hidden["h"].device).view(-1, 1).bool()
+            for h in self._hidden.values():
+                h.masked_fill_(done_mask, 0)
+
+    def step(self, input, update_hidden=True):
+        """Computes one time step.
+
+        Args:
+            input: current input vector.
+            update_hidden: bool, if False, the hidden buffers are left unchanged.
+
+        Returns:
+            hidden state dictionary after the step, the preallocated buffers if updated.
+        """
+
+        with torch.inference_mode():
+            hidden_next = self._cell(input, self._hidden)
+            if not update_hidden:
+                return hidden_next
+            for key, h in self._hidden.items():
+                h.copy_(hidden_next[key])
+        return self._hidden
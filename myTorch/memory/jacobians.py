@@ -0,0 +1,37 @@
+"""Helpers for the closed-form step Jacobians dh_t/dh_(t-1) of the cells.
+
+All Jacobians are batched [batch_size, num_outputs, hidden_size] tensors whose entry
+[b, i, j] is the derivative of output i w.r.t. h_(t-1)[j] for example b.
+"""
+import torch
+
+
+def diag_mm(v, J):
+    """Returns diag(v) @ J for every example, v: [batch_size, n], J: [batch_size, n, m]."""
+
+    return v.unsqueeze(2) * J
+
+
+def recurrent_jacobian(W_h, batch_size: int):
+    """Returns the Jacobian of h @ W_h w.r.t. h, for [hidden_size, n] recurrent weights W_h."""
+
+    return W_h.t().unsqueeze(0).expand(batch_size, -1, -1)
+
+
+def layer_norm_jacobian(x, J, weight, eps: float):
+    """Propagates the Jacobian J of x through a layer normalization of x.
+
+    d layer_norm(x)/dx = diag(weight * rstd) (I - 11^T / n - x_hat x_hat^T / n).
+
+    Args:
+        x: [batch_size, n] input of the layer normalization.
+        J: [batch_size, n, m] Jacobian of x.
+        weight: [n] gain of the layer normalization.
+        eps: float, epsilon of the layer normalization.
+    """
+
+    mean = x.mean(1, keepdim=True)
+    rstd = torch.rsqrt(x.var(1, unbiased=False, keepdim=True) + eps)
+    x_hat = ((x - mean) * rstd).unsqueeze(2)
+    J = J - J.mean(1, keepdim=True) - x_hat * (x_hat * J).mean(1, keepdim=True)
+    return diag_mm(weight * rstd, J)
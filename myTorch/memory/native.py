@@ -0,0 +1,109 @@
+"""Runs stacks of LSTM cells on the fused torch.lstm kernel.
+
+Without layer normalization and peepholes, a stack of LSTMCells computes the same function as
+torch.nn.LSTM: our i, f, c, o gate columns match its i, f, g, o rows, and our single bias
+maps onto b_ih with a zero b_hh. The native weights are built from the cell parameters on
+every call, so gradients flow back into the cells and checkpoints keep the cell layout.
+"""
+import torch
+import torch.nn as nn
+
+from myTorch.memory.LSTMCell import LSTMCell
+from myTorch.memory.packing import gate_blocks
+
+
+def native_incompatibility(cell_name, cells, layer_norm):
+    """Returns why the cells can not run on the native kernel, or None if they can.
+
+    Args:
+        cell_name: str, name of the cell type.
+        cells: list of cells, one per layer.
+        layer_norm: bool, if True, the cells apply layer normalization.
+    """
+
+    if cell_name == "GRU":
+        return "the GRU reset gate is applied before the recurrent matmul, unlike torch.nn.GRU"
+    if cell_name != "LSTM":
+        return "{} cells have no native kernel".format(cell_name)
+    if layer_norm:
+        return "layer normalization is not supported by the native kernel"
+    if any(cell._hidden_size != cells[0]._hidden_size for cell in cells):
+        return "the native kernel needs the same hidden size in all layers"
+    for cell in cells:
+        for name in ("_W_c2i", "_W_c2f", "_W_c2o"):
+            W_c = getattr(cell, name)
+            if W_c.requires_grad or bool(W_c.any()):
+                return "peephole weights are in use"
+    return None
+
+
+def native_weights(cells):
+    """Returns the flat weight list of torch.lstm, built from the cell parameters.
+
+    Args:
+        cells: list of LSTM cells, one per layer.
+    """
+
+    weights = []
+    for cell in cells:
+        W, b = cell._packed_weights()
+        weights += [W[:cell._input_size].t(), W[cell._input_size:].t(), b, torch.zeros_like(b)]
+    return weights
+
+
+def native_sequence(cells, inputs, hidden):
+    """Computes a whole sequence through all layers with one torch.lstm call.
+
+    Args:
+        cells: list of LSTM cells, one per layer.
+        inputs: [seq_len, batch_size, input_size] input sequence.
+        hidden: list of hidden state dictionaries, one per layer.
+
+    Returns:
+        [seq_len, batch_size, hidden_size] outputs of the last layer and the list of
+        last hidden state dictionaries.
+    """
+
+    h_0 = torch.stack([last_hidden["h"] for last_hidden in hidden])
+    c_0 = torch.stack([last_hidden["c"] for last_hidden in hidden])
+    outputs, h_n, c_n = torch.lstm(inputs, (h_0, c_0), native_weights(cells), True, len(cells),
+                                   0.0, torch.is_grad_enabled(), False, False)
+    return outputs, [{"h": h_n[i], "c": c_n[i]} for i in range(len(cells))]
+
+
+def to_native(cells):
+    """Returns a torch.nn.LSTM holding a copy of the cell parameters.
+
+    Args:
+        cells: list of LSTM cells, one per layer.
+    """
+
+    lstm = nn.LSTM(cells[0]._input_size, cells[0]._hidden_size, len(cells))
+    lstm.to(cells[0]._W_c2i.device)
+    with torch.no_grad():
+        for param, weight in zip(lstm._flat_weights, native_weights(cells)):
+            param.copy_(weight)
+    return lstm
+
+
+def from_native(lstm, cells):
+    """Copies the parameters of a torch.nn.LSTM into the cells.
+
+    Args:
+        lstm: torch.nn.LSTM with one layer per cell.
+        cells: list of LSTM cells, one per layer.
+    """
+
+    H = lstm.hidden_size
+    with torch.no_grad():
+        for l, cell in enumerate(cells):
+            w_ih = getattr(lstm, "weight_ih_l{}".format(l))
+            w_hh = getattr(lstm, "weight_hh_l{}".format(l))
+            b = getattr(lstm, "bias_ih_l{}".format(l)) + getattr(lstm, "bias_hh_l{}".format(l))
+            for g, (W_x, W_h, b_g) in enumerate(gate_blocks(cell, LSTMCell._GATES)):
+                W_x.copy_(w_ih[g * H:(g + 1) * H].t())
+                W_h.copy_(w_hh[g * H:(g + 1) * H].t())
+                b_g.copy_(b[g * H:(g + 1) * H])
+            cell._W_c2i.zero_()
+            cell._W_c2f.zero_()
+            cell._W_c2o.zero_()
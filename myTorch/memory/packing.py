@@ -0,0 +1,80 @@
+"""Helpers for cells that store all their gate weights in one packed parameter.
+
+A cell describes its gates as a tuple of (W_x, W_h, b) parameter names, e.g.
+(("_W_x2i", "_W_h2i", "_b_i"), ...). In packed mode the cell instead owns
+
+    _W: [input_size + hidden_size, num_gates * hidden_size]
+    _b: [num_gates * hidden_size]
+
+where gate g occupies columns [g * hidden_size, (g + 1) * hidden_size), the
+input rows come first and the hidden rows last.
+"""
+import torch
+
+
+def gate_blocks(cell, gates):
+    """Returns a list of (W_x, W_h, b) tensors, one per gate.
+
+    In packed mode the tensors are views into the packed parameters, so they can be
+    used for in-place initialization.
+
+    Args:
+        cell: cell module with `_packed`, `_input_size` and `_hidden_size` attributes.
+        gates: tuple of (W_x, W_h, b) parameter names.
+    """
+
+    if not cell._packed:
+        return [tuple(getattr(cell, name) for name in gate) for gate in gates]
+
+    blocks = []
+    for g in range(len(gates)):
+        cols = slice(g * cell._hidden_size, (g + 1) * cell._hidden_size)
+        blocks.append((cell._W[:cell._input_size, cols], cell._W[cell._input_size:, cols], cell._b[cols]))
+    return blocks
+
+
+def convert_state_dict(state_dict, prefix, gates, packed, input_size, hidden_size):
+    """Converts a cell state dict in place between the per-gate and the packed layout.
+
+    Args:
+        state_dict: state dict being loaded.
+        prefix: str, prefix of the cell in the state dict.
+        gates: tuple of (W_x, W_h, b) parameter names.
+        packed: bool, layout expected by the cell.
+        input_size: int, size of the input vector.
+        hidden_size: int, hidden layer dimension.
+    """
+
+    W_key, b_key = prefix + "_W", prefix + "_b"
+    gate_keys = [[prefix + name for name in gate] for gate in gates]
+
+    if packed and W_key not in state_dict and all(k in state_dict for gate in gate_keys for k in gate):
+        W_x = torch.cat([state_dict.pop(gate[0]) for gate in gate_keys], 1)
+        W_h = torch.cat([state_dict.pop(gate[1]) for gate in gate_keys], 1)
+        state_dict[W_key] = torch.cat((W_x, W_h), 0)
+        state_dict[b_key] = torch.cat([state_dict.pop(gate[2]) for gate in gate_keys], 0)
+
+    elif not packed and W_key in state_dict and b_key in state_dict:
+        W, b = state_dict.pop(W_key), state_dict.pop(b_key)
+        for g, gate in enumerate(gate_keys):
+            cols = slice(g * hidden_size, (g + 1) * hidden_size)
+            state_dict[gate[0]] = W[:input_size, cols].clone()
+            state_dict[gate[1]] = W[input_size:, cols].clone()
+            state_dict[gate[2]] = b[cols].clone()
+
+
+def project_inputs(inputs, W_x, b):
+    """Computes the input projections of all time steps with a single matmul.
+
+    Args:
+        inputs: [seq_len, batch_size, input_size] input sequence.
+        W_x: [input_size, num_gates * hidden_size] packed input weights.
+        b: [num_gates * hidden_size] packed biases.
+
+    Returns:
+        [seq_len, batch_size, num_gates * hidden_size] input projections.
+    """
+
+    seq_len, batch_size = inputs.shape[0], inputs.shape[1]
+    x_proj = torch.addmm(b, inputs.reshape(seq_len * batch_size, -1), W_x)
+    return x_proj.view(seq_len, batch_size, -1)
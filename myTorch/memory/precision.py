@@ -0,0 +1,29 @@
+"""Reduced precision (autocast) support for the memory cells.
+
+Under autocast the gate matmuls run in the reduced precision while the parameters stay
+float32. The cells cast their gate pre-activations back to the dtype of the hidden state,
+so the pointwise updates and the state carried between time steps remain float32.
+"""
+import torch
+
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16}
+
+
+def check_precision(precision):
+    """Returns the precision name of a config value, "fp32" when it is not set."""
+
+    precision = precision or "fp32"
+    assert precision in PRECISIONS, "precision must be one of {}".format(sorted(PRECISIONS))
+    return precision
+
+
+def autocast(precision, device):
+    """Returns the autocast context for running the model in a precision.
+
+    Args:
+        precision: str, "fp32" (autocast disabled) or "bf16".
+        device: torch.device of the model.
+    """
+
+    dtype = PRECISIONS[precision]
+    return torch.autocast(torch.device(device).type, dtype=dtype or torch.bfloat16, enabled=dtype is not None)
@@ -0,0 +1,119 @@
+"""Dynamic int8 quantized inference for the memory cells.
+
+The cells keep their gate weights as raw matrices, which torch.quantization.quantize_dynamic
+does not recognize. QuantizedCell converts the packed gate weights of a trained cell into
+int8 dynamic quantized linear layers with per output channel scales; activations are
+quantized on the fly. The pointwise part of the step (peepholes, layer normalization)
+reuses the float cell.
+"""
+import torch
+import torch.nn as nn
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+from torch.ao.quantization import per_channel_dynamic_qconfig
+
+from myTorch.memory.GRUCell import GRUCell, GRUState
+from myTorch.memory.RNNCell import RNNCell
+
+
+def quantized_linear(W, b=None):
+    """Returns an int8 dynamic quantized layer computing x @ W + b.
+
+    Args:
+        W: [in_features, out_features] float weights, quantized per output channel.
+        b: [out_features] float bias or None.
+    """
+
+    linear = nn.Linear(W.shape[0], W.shape[1], bias=b is not None)
+    with torch.no_grad():
+        linear.weight.copy_(W.t())
+        if b is not None:
+            linear.bias.copy_(b)
+    linear.qconfig = per_channel_dynamic_qconfig
+    return DynamicQuantizedLinear.from_float(linear)
+
+
+class QuantizedCell(nn.Module):
+    """Inference-only int8 version of an RNN, GRU, LSTM or JANET cell.
+
+    Exposes the dictionary `forward`, `forward_sequence` and `reset_hidden` api of the cells.
+    """
+
+    def __init__(self, cell):
+        """Quantizes the gate weights of a cell.
+
+        Args:
+            cell: trained (not scripted) RNN, GRU, LSTM or JANET cell.
+        """
+
+        super(QuantizedCell, self).__init__()
+
+        self._cell = cell
+        self._state_class = type(cell.init_state(1))
+        I, H = cell._input_size, cell._hidden_size
+
+        with torch.no_grad():
+            W, b = cell._packed_weights()
+        self._x2gates = quantized_linear(W[:I], b)
+        if isinstance(cell, GRUCell):
+            # the reset gate is applied between the two recurrent matmuls.
+            self._h2rz = quantized_linear(W[I:, :2 * H])
+            self._h2h = quantized_linear(W[I:, 2 * H:])
+        else:
+            self._h2gates = quantized_linear(W[I:])
+
+    def forward(self, input, last_hidden):
+        """Implements forward computation of one time step on the hidden state dictionary."""
+
+        _, hidden = self.forward_sequence(input.unsqueeze(0), last_hidden)
+        return hidden
+
+    def forward_sequence(self, inputs, last_hidden):
+        """Implements forward computation over a whole sequence.
+
+        Args:
+            inputs: [seq_len, batch_size, input_size] input sequence.
+            last_hidden: hidden state dictionary before the first time step.
+
+        Returns:
+            [seq_len, batch_size, hidden_size] hidden outputs and the last hidden state dictionary.
+        """
+
+        state = self._state_class(**last_hidden)
+        x_proj = self._x2gates(inputs)
+
+        outputs = []
+        for t in range(inputs.shape[0]):
+            if isinstance(self._cell, GRUCell):
+                state = self._gru_step(x_proj[t], state)
+            elif isinstance(self._cell, RNNCell):
+                state = self._cell._gates2state(x_proj[t] + self._h2gates(state.h))
+            else:
+                state = self._cell._gates2state(x_proj[t] + self._h2gates(state.h), state)
+            outputs.append(state.h)
+        return torch.stack(outputs), state._asdict()
+
+    def reset_hidden(self, batch_size):
+        """Resets the hidden state for truncating the dependency."""
+
+        return self._cell.reset_hidden(batch_size)
+
+    def _gru_step(self, x_proj, last_state):
+        """GRUCell._gates2state with the recurrent matmuls on int8 weights."""
+
+        cell = self._cell
+        H = cell._hidden_size
+        x_rz, x_h = x_proj.split([2 * H, H], 1)
+
+        pre_r, pre_z = (x_rz + self._h2rz(last_state.h)).chunk(2, 1)
+        if cell._layer_norm:
+            pre_r = cell._ln_r(pre_r)
+            pre_z = cell._ln_z(pre_z)
+        r = torch.sigmoid(pre_r)
+        z = torch.sigmoid(pre_z)
+
+        hp_pre = x_h + self._h2h(last_state.h * r)
+        if cell._layer_norm:
+            hp_pre = cell._ln_h(hp_pre)
+        hp = torch.tanh(hp_pre)
+
+        return GRUState(((1 - z) * hp) + (z * last_state.h))
@@ -0,0 +1,19 @@
+"""Helpers for running memory cells as TorchScript modules."""
+import torch
+
+
+def script_cell(cell):
+    """Compiles a cell with torch.jit.script.
+
+    The scripted time loop of `forward_sequence` runs without the python interpreter overhead
+    per step. ScriptModules do not support load hooks, so a scripted cell only loads
+    checkpoints saved with its own (packed or per-gate) weight layout.
+
+    Args:
+        cell: memory cell module.
+
+    Returns:
+        scripted cell with the same parameters and state dict keys.
+    """
+
+    return torch.jit.script(cell)
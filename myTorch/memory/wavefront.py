@@ -0,0 +1,77 @@
+"""Wavefront execution of stacks of memory cells on a thread pool.
+
+Layer l at time chunk c only depends on layer l at chunk c - 1 and on layer l - 1 at chunk c.
+All (layer, chunk) pairs with the same l + c are therefore independent, and the stack runs
+as a sequence of waves whose cells execute concurrently. The torch kernels release the GIL,
+so on multi-core CPUs narrow deep stacks turn their depth into parallelism.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+_pools = {}
+
+
+def _get_pool(num_workers):
+    """Returns a shared thread pool with num_workers threads."""
+
+    if num_workers not in _pools:
+        _pools[num_workers] = ThreadPoolExecutor(num_workers, thread_name_prefix="wavefront")
+    return _pools[num_workers]
+
+
+def wavefront_sequence(cells, inputs, hidden, chunk=1):
+    """Runs a stack of cells over a sequence with the wavefront schedule.
+
+    Every task runs `chunk` time steps of one layer with the cell's forward_sequence. The
+    grad mode, inference mode and autocast state of the caller are applied in the workers,
+    since they are thread local. Activation checkpointing is not supported, as its saved
+    tensor hooks are thread local too and would not apply to the tasks.
+
+    Args:
+        cells: list of cells, one per layer.
+        inputs: [seq_len, batch_size, input_size] input sequence.
+        hidden: list of hidden state dictionaries, one per layer.
+        chunk: int, number of time steps per task.
+
+    Returns:
+        [seq_len, batch_size, hidden_size] outputs of the last layer and the list of last
+        hidden state dictionaries.
+    """
+
+    chunks = inputs.split(chunk, 0)
+    num_layers, num_chunks = len(cells), len(chunks)
+    pool = _get_pool(max(1, num_layers - 1))
+
+    device_type = inputs.device.type
+    grad_enabled = torch.is_grad_enabled()
+    inference_mode = torch.is_inference_mode_enabled()
+    autocast_enabled = torch.is_autocast_enabled(device_type)
+    autocast_dtype = torch.get_autocast_dtype(device_type)
+
+    def run(layer, x, last_hidden):
+        with torch.inference_mode(inference_mode), torch.set_grad_enabled(grad_enabled), \
+                torch.autocast(device_type, dtype=autocast_dtype, enabled=autocast_enabled):
+            return cells[layer].forward_sequence(x, last_hidden)
+
+    hidden = list(hidden)
+    # outputs[l][c] is kept until layer l + 1 has consumed it.
+    outputs = [[None] * num_chunks for _ in range(num_layers)]
+    for wave in range(num_chunks + num_layers - 1):
+        layers = range(max(0, wave - num_chunks + 1), min(num_layers, wave + 1))
+        tasks = []
+        for layer in layers:
+            x = chunks[wave - layer] if layer == 0 else outputs[layer - 1][wave - layer]
+            tasks.append((layer, x))
+
+        # the calling thread runs the first task itself.
+        futures = [pool.submit(run, layer, x, hidden[layer]) for layer, x in tasks[1:]]
+        results = [run(tasks[0][0], tasks[0][1], hidden[tasks[0][0]])] + [future.result() for future in futures]
+
+        for (layer, _), (h, last_hidden) in zip(tasks, results):
+            outputs[layer][wave - layer] = h
+            hidden[layer] = last_hidden
+            if layer > 0:
+                outputs[layer - 1][wave - layer] = None
+
+    return torch.cat(outputs[-1], 0), hidden
@@ -0,0 +1,294 @@
+"""Batched Lyapunov spectrum of the hidden state dynamics of a Recurrent model."""
+import hashlib
+import logging
+import os
+
+import numpy
+import torch
+from torch.func import jacrev, vmap
+
+
+def recurrent_state(cell):
+    """Returns the hidden state entry whose dynamics are analyzed, "h" unless the cell
+    carries its recurrence in another entry, e.g. the mu of SRU cells."""
+
+    return getattr(cell, "recurrent_state", "h")
+
+
+def step_jacobians(cell, input, last_hidden):
+    """Computes one step of a cell with the Jacobians of its recurrent state.
+
+    The Jacobian of an example is the full [state_size, state_size] matrix ds_t/ds_(t-1) of
+    the recurrent_state s, h for most cells, the other state variables (e.g. the LSTM c)
+    are held fixed. Cells with a closed-form step_jacobian, or state_jacobian for states
+    other than h, use it, the others get one reverse-mode pass per output under vmap.
+
+    Args:
+        cell: cell module.
+        input: [batch_size, input_size] input of the cell.
+        last_hidden: hidden state dictionary before the step.
+
+    Returns:
+        [batch_size, state_size, state_size] Jacobians and the next hidden state dictionary.
+    """
+
+    state_key = recurrent_state(cell)
+    if state_key != "h" and hasattr(cell, "state_jacobian"):
+        return cell.state_jacobian(input, last_hidden), cell(input, last_hidden)
+    if state_key == "h" and hasattr(cell, "step_jacobian"):
+        return cell.step_jacobian(input, last_hidden), cell(input, last_hidden)
+
+    def step(s, x, rest):
+        hidden = {key: value.unsqueeze(0) for key, value in rest.items()}
+        hidden[state_key] = s.unsqueeze(0)
+        hidden = {key: value.squeeze(0) for key, value in cell(x.unsqueeze(0), hidden).items()}
+        return hidden[state_key], hidden
+
+    rest = {key: value for key, value in last_hidden.items() if key != state_key}
+    return vmap(jacrev(step, has_aux=True))(last_hidden[state_key], input, rest)
+
+
+def evolve_and_qr(Q, J):
+    """Evolves the orthonormal bases Q with the Jacobians J and re-orthonormalizes them.
+
+    Args:
+        Q: [batch_size, hidden_size, num_exps] float64 orthonormal bases.
+        J: [batch_size, hidden_size, hidden_size] Jacobians.
+
+    Returns:
+        the evolved bases and the [batch_size, num_exps] absolute diagonals of the R factors.
+    """
+
+    Q, R = torch.linalg.qr(torch.bmm(J.to(Q.dtype), Q))
+    return Q, torch.diagonal(R, dim1=1, dim2=2).abs()
+
+
+class LyapunovAnalyzer(object):
+    """Streaming Lyapunov spectrum of one layer along a batch of trajectories.
+
+    Every example of the batch is one trajectory. The model advances step by step from a
+    reset hidden state, and at every step the bases of all trajectories are evolved with
+    the Jacobians of the recurrent state of the layer and re-orthonormalized with one
+    batched QR. The bases start from a fixed random orthonormal matrix, as the first axes
+    may lie in the kernel of Jacobians with zero rows, e.g. of ReLU or SRU cells. The log
+    diagonals of R are summed in float64. Only the hidden states, the bases and the sums
+    are kept, so inputs of any length can be fed in chunks, and the state can be saved and
+    loaded to resume an analysis.
+    """
+
+    def __init__(self, model, batch_size, frac_exps=1., layer=0, device=None):
+        """Initializes an analyzer.
+
+        Args:
+            model: Recurrent model.
+            batch_size: int, number of trajectories.
+            frac_exps: float, fraction of the state_size exponents to compute, where the
+                state is the recurrent_state of the layer, e.g. mu for SRU cells.
+            layer: int, layer whose hidden state is analyzed.
+            device: torch device of the inputs.
+        """
+
+        self._model = model
+        self._batch_size = batch_size
+        self._layer = layer
+        self._device = device
+        cell = model._Cells[layer]
+        self._state_size = cell.reset_hidden(1)[recurrent_state(cell)].shape[1]
+        self.num_exps = int(frac_exps * self._state_size)
+        self.reset()
+
+    def reset(self):
+        """Restarts the trajectories and the spectrum."""
+
+        self._hidden = [cell.reset_hidden(self._batch_size) for cell in self._model._Cells]
+        generator = torch.Generator().manual_seed(0)
+        Q = torch.linalg.qr(torch.randn(self._state_size, self.num_exps, dtype=torch.float64,
+                                        generator=generator))[0].to(self._device)
+        self._Q = Q.expand(self._batch_size, self._state_size, self.num_exps)
+        self._log_r = torch.zeros(self._batch_size, self.num_exps, dtype=torch.float64, device=self._device)
+        self.steps_done = 0
+
+    def update(self, inputs):
+        """Advances the trajectories over a chunk of inputs.
+
+        Args:
+            inputs: [seq_len, batch_size, input_size] next inputs of the trajectories.
+        """
+
+        # torch.func computes its Jacobians regardless of the grad mode, the steps need no graph.
+        with torch.no_grad():
+            for x_t in inputs.unbind(0):
+                h = x_t
+                for i, cell in enumerate(self._model._Cells):
+                    if i == self._layer:
+                        J, self._hidden[i] = step_jacobians(cell, h, self._hidden[i])
+                    else:
+                        self._hidden[i] = cell(h, self._hidden[i])
+                    h = self._hidden[i]["h"]
+
+                self._Q, r = evolve_and_qr(self._Q, J)
+                self._log_r += torch.log2(r)
+        self.steps_done += inputs.shape[0]
+
+    def spectrum(self):
+        """Returns the [batch_size, num_exps] float64 exponents in bits per time step."""
+
+        return self._log_r / max(self.steps_done, 1)
+
+    def fingerprint(self, stream_settings=None):
+        """Returns a hash of everything the exponents depend on.
+
+        Args:
+            stream_settings: dict, settings of the input stream, e.g. the fold and the
+                number of time steps.
+        """
+
+        sha = hashlib.sha1()
+        for name, value in self._model.state_dict().items():
+            sha.update(name.encode())
+            sha.update(value.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+        settings = {"layer": self._layer, "num_exps": self.num_exps, "batch_size": self._batch_size}
+        settings.update(stream_settings or {})
+        sha.update(repr(sorted(settings.items())).encode())
+        return sha.hexdigest()
+
+    def run(self, chunks, checkpoint_file=None, checkpoint_every=0, stream_settings=None):
+        """Feeds a stream of input chunks, with periodic checkpoints.
+
+        If checkpoint_file holds an unfinished analysis with the same fingerprint, the
+        analysis resumes from it: the stream must produce the same inputs as before, and its
+        first steps_done time steps are skipped. Checkpoints of another model or other
+        settings are ignored, and the checkpoint is removed once the stream is over.
+
+        Args:
+            chunks: iterable of [seq_len, batch_size, input_size] input chunks.
+            checkpoint_file: str, optional file name with absolute path for the checkpoints.
+            checkpoint_every: int, if > 0, saves the state after every chunk that crosses a
+                multiple of checkpoint_every steps.
+            stream_settings: dict, settings of the input stream, part of the fingerprint.
+
+        Returns:
+            the [batch_size, num_exps] exponents after the whole stream.
+        """
+
+        fingerprint = None
+        if checkpoint_file is not None:
+            fingerprint = self.fingerprint(stream_settings)
+            if os.path.isfile(checkpoint_file):
+                if self.load(checkpoint_file, fingerprint):
+                    logging.info("resuming the Lyapunov analysis after {} steps".format(self.steps_done))
+                else:
+                    logging.warning("ignoring {}, saved for another model or settings".format(checkpoint_file))
+
+        skip = self.steps_done
+        for inputs in chunks:
+            if skip >= inputs.shape[0]:
+                skip -= inputs.shape[0]
+                continue
+            inputs, skip = inputs[skip:], 0
+
+            last_steps = self.steps_done
+            self.update(inputs)
+            if checkpoint_file is not None and checkpoint_every > 0 and \
+                    self.steps_done // checkpoint_every > last_steps // checkpoint_every:
+                self.save(checkpoint_file, fingerprint)
+
+        if checkpoint_file is not None and os.path.isfile(checkpoint_file):
+            os.remove(checkpoint_file)
+        return self.spectrum()
+
+    def save(self, file_name, fingerprint=None):
+        """Saves the state of the analyzer.
+
+        Args:
+            file_name: str, file name with absolute path.
+            fingerprint: str, fingerprint of the analysis, checked by load.
+        """
+
+        state = {"hidden": self._hidden, "Q": self._Q, "log_r": self._log_r,
+                 "steps_done": self.steps_done, "fingerprint": fingerprint}
+        # writes a complete file before replacing the previous checkpoint.
+        torch.save(state, file_name + ".tmp")
+        os.replace(file_name + ".tmp", file_name)
+
+    def load(self, file_name, fingerprint=None):
+        """Loads the state of the analyzer.
+
+        Args:
+            file_name: str, file name with absolute path.
+            fingerprint: str, if given, the state is only loaded if it was saved with the
+                same fingerprint.
+
+        Returns:
+            True if the state was loaded.
+        """
+
+        state = torch.load(file_name, map_location=self._device)
+        if fingerprint is not None and state.get("fingerprint") != fingerprint:
+            return False
+        self._hidden, self._Q, self._log_r = state["hidden"], state["Q"], state["log_r"]
+        self.steps_done = state["steps_done"]
+        return True
+
+
+def input_stream(data_iterator, input_flag, num_steps, batch_size, input_size, device, chunk_size=1000):
+    """Yields the inputs of long trajectories in chunks.
+
+    The batches of a fold are concatenated in time, restarting the fold when it runs out,
+    so trajectories can be longer than the sequences of the task.
+
+    Args:
+        data_iterator: data iterator object, with batches of batch_size sequences.
+        input_flag: str, fold of the data iterator ("train", "valid" or "test"), or "zero"
+            for all-zero inputs.
+        num_steps: int, total number of time steps, or None for the length of one batch
+            (chunk_size steps for "zero").
+        batch_size: int, number of trajectories.
+        input_size: int, size of the input vector.
+        device: torch device object.
+        chunk_size: int, maximum number of time steps per chunk.
+
+    Yields:
+        [seq_len, batch_size, input_size] input chunks.
+    """
+
+    if input_flag == "zero":
+        num_steps = num_steps or chunk_size
+        for start in range(0, num_steps, chunk_size):
+            yield torch.zeros(min(chunk_size, num_steps - start), batch_size, input_size, device=device)
+        return
+
+    data_iterator.reset_iterator()
+    steps = 0
+    while num_steps is None or steps < num_steps:
+        data = data_iterator.next(input_flag)
+        if data is None:
+            data_iterator.reset_iterator()
+            continue
+
+        x = torch.from_numpy(numpy.asarray(data['x'])).to(device)
+        if num_steps is None:
+            num_steps = x.shape[0]
+        x = x[:num_steps - steps]
+        for inputs in x.split(chunk_size, 0):
+            yield inputs
+        steps += x.shape[0]
+
+
+def lyapunov_spectrum(model, inputs, frac_exps=1., layer=0):
+    """Computes the Lyapunov exponents of one layer along a batch of trajectories.
+
+    Args:
+        model: Recurrent model.
+        inputs: [seq_len, batch_size, input_size] input sequences, one trajectory per example.
+        frac_exps: float, fraction of the state_size exponents to compute, see LyapunovAnalyzer.
+        layer: int, layer whose hidden state is analyzed.
+
+    Returns:
+        [batch_size, num_exps] float64 tensor of the largest exponents of every trajectory,
+        in bits per time step.
+    """
+
+    analyzer = LyapunovAnalyzer(model, inputs.shape[1], frac_exps, layer, inputs.device)
+    analyzer.update(inputs)
+    return analyzer.spectrum()
@@ -2,17 +2,18 @@ import numpy
 import numpy as np
 import argparse
 import logging
+import os
 
 import torch
 
 from myTorch import Experiment
 from myTorch.memnets.recurrent_net import Recurrent
+from myTorch.projects.chaos.lyapunov import LyapunovAnalyzer, input_stream
 from myTorch.task.ssmnist_task import SSMNISTData
 from myTorch.task.mnist_task import PMNISTData
 from myTorch.utils.logger import Logger
 from myTorch.utils import MyContainer, get_optimizer, create_config
 import torch.nn.functional as F
-from torch.autograd import grad
 
 parser = argparse.ArgumentParser(description="Algorithm Learning Task")
 parser.add_argument("--config", type=str, default="config/default.yaml", help="config file path.")
@@ -48,13 +49,15 @@ def evaluate(experiment, model, config, data_iterator, tr, logger, device, tag):
         accuracy = torch.zeros(config.batch_size).to(device)
         num_outputs = torch.zeros(config.batch_size).to(device)
 
+        x = torch.from_numpy(numpy.asarray(data['x'])).to(device)
+        outputs = model.forward_sequence(x, lengths=data.get('lengths'))
+
         for i in range(0, data["datalen"]):
 
-            x = torch.from_numpy(numpy.asarray(data['x'][i])).to(device)
             y = torch.from_numpy(numpy.asarray(data['y'][i])).to(device)
             mask = torch.from_numpy(numpy.asarray(data['mask'][i])).to(device)
 
-            output = model(x)
+            output = outputs[i]
 
             values, indices = torch.max(output, 1)
 
@@ -107,16 +110,17 @@ def train(experiment, model, config, data_iterator, tr, logger, device):
         seqloss = 0
 
         model.reset_hidden(batch_size=config.batch_size)
+        model.optimizer.zero_grad()
+
+        x = torch.from_numpy(numpy.asarray(data['x'])).to(device)
+        outputs = model.forward_sequence(x, lengths=data.get('lengths'))
 
         for i in range(0, data["datalen"]):
 
-            x = torch.from_numpy(numpy.asarray(data['x'][i])).to(device)
             y = torch.from_numpy(numpy.asarray(data['y'][i])).to(device)
             mask = torch.from_numpy(numpy.asarray(data['mask'][i])).to(device)
 
-            model.optimizer.zero_grad()
-
-            output = model(x)
+            output = outputs[i]
 
             loss = F.cross_entropy(output, y, reduce=False)
 
@@ -199,81 +203,39 @@ def create_experiment(config):
 
 ## START Lyapunov spectrum analysis functions ##
 
-def evolve_and_QR(Q,J):
-    
-    Z = J @ Q
-    q,r = np.linalg.qr(Z,mode='reduced')
-    #return q, np.diag(r)
-    s = np.diag(np.sign(np.diag(r)))                                               #changes QR sign convention so r is positive
-    return q.dot(s), np.diag(r.dot(s))
-
-def calculate_LEs(model, data_iterator, input_flag, device, frac_exps):
-    """Lyapunov spectrum calculation using QR decomposition"""
-
-    data_iterator.reset_iterator()
-    data = data_iterator.next(input_flag)
-    
-    print('store hidden states')
-    h_list = list()
-    model.reset_hidden(batch_size=1)
-    h_list.append(model._h_prev[0]["h"])
-    h_list[-1].requires_grad_()
-    for i in range(0, data["datalen"]):
-
-        x = torch.from_numpy(numpy.asarray(data['x'][i])).to(device)
-        y = torch.from_numpy(numpy.asarray(data['y'][i])).to(device)
-        mask = torch.from_numpy(numpy.asarray(data['mask'][i])).to(device)
-        
-        x = x[0].unsqueeze(1)
-
-        output = model(x)
-        h_list.append(model._h_prev[0]["h"])
-        h_list[-1].requires_grad_()
-
-    state_dim = model._h_prev[0]["h"].shape[1]
-    num_exps=int(frac_exps*state_dim)
-    print('compute '+str(num_exps)+' LEs')
-
-    #state_dim=sum([var.shape[1] for var in model._h_prev[0].values])               #generalizes to models with multiple state variables
-    #Q = torch.eye(state_dim).to(device)                                             #would random vectors be better here?
-    Q = np.eye(state_dim)                                             #would random vectors be better here?    Q = Q[:,:num_exp]
-    #Q = Q.unsqueeze(0)
-    Q = Q[:,:num_exps]
-    r_diag_store = []
-    jacobian=np.zeros([state_dim]*2)
-    for i in range(1, len(h_list)):
-        
-        model.optimizer.zero_grad()
-        
-        for k in range(0, len(h_list[i][0])):
-            jacobian[k,:]=grad(h_list[i][0][k], h_list[i-1], retain_graph=True)[0].data.numpy()
-        #jacobian=torch.stack(j_rows)    
+def calculate_LEs(model, config, data_iterator, input_flag, device):
+    """Lyapunov spectrum calculation using QR decomposition.
 
-        #Q, r_diag_vec = evolve_and_QR(Q,jacobian.unsqueeze(1))
-        Q, r_diag_vec = evolve_and_QR(Q,jacobian)
+    Every sequence of a batch of the input_flag fold is one trajectory, followed by the
+    sequences of the next batches for config.lyapunov_steps time steps. The analysis is
+    checkpointed in config.save_dir and resumes from the last checkpoint of the same model
+    and settings, see LyapunovAnalyzer.run.
 
-        r_diag_store.append(r_diag_vec)
-        
-    LEs = np.sum(np.log2(np.vstack(r_diag_store)),axis=0)/len(h_list)
-    
-    return LEs
+    Returns:
+        [num_trajectories, num_exps] numpy array of the exponents of every trajectory.
+    """
 
-def analyze_dynamics(model, data_iterator, device, frac_exps=1):
+    analyzer = LyapunovAnalyzer(model, config.batch_size, config.lyapunov_frac_exps or 1., device=device)
+    logging.info("computing {} LEs on {} trajectories".format(analyzer.num_exps, config.batch_size))
+
+    chunks = input_stream(data_iterator, input_flag, config.lyapunov_steps, config.batch_size,
+                          config.input_size, device)
+    checkpoint_file = os.path.join(config.save_dir, "lyapunov_{}.p".format(input_flag))
+    stream_settings = {"input_flag": input_flag, "num_steps": config.lyapunov_steps}
+    LEs = analyzer.run(chunks, checkpoint_file, config.lyapunov_checkpoint_every or 0, stream_settings)
+    return LEs.cpu().numpy()
+
+def analyze_dynamics(model, config, data_iterator, device):
     """Runs Lyapunov spectrum calculation over different input types"""
-    
-    LEs_store=dict()
-    for input_flag in ('test','train','zero'):                                     #add flag and method for zero input data iterator
-        print('computing LEs for '+input_flag+' inputs')
-        LEs=calculate_LEs(model, data_iterator, input_flag, device, frac_exps)
-        LEs_store[input_flag]=LEs
-        #if config.use_tflogger:
-            #logger.log_list(input_flag, LEs_store)#, step + 1)
-            
-    #logging.info("saved LEs across test, train, and zero input conditions")
-    
-    np.save(LEs_store,)
-    experiment.save()
-        
+
+    LEs_store = dict()
+    for input_flag in ("test", "train", "zero"):
+        logging.info("computing LEs for {} inputs".format(input_flag))
+        LEs_store[input_flag] = calculate_LEs(model, config, data_iterator, input_flag, device)
+
+    np.save(os.path.join(config.save_dir, "LEs.npy"), LEs_store)
+    logging.info("saved LEs across test, train, and zero input conditions")
+
 
 ## END Lyapunov spectrum analysis functions ##
 
@@ -294,7 +256,7 @@ def run_experiment(args):
         experiment.force_restart()
 
     #train(experiment, model, config, data_iterator, tr, logger, device)
-    analyze_dynamics(model, data_iterator, device)
+    analyze_dynamics(model, config, data_iterator, device)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,6 @@
 import torch
 import torch.nn as nn
-import numpy as np
-from myTorch.utils.gumbel import gumbel_softmax, gumbel_sigmoid
-from myTorch.utils import utils
-
-from torch.autograd import Variable
+from myTorch.utils import gumbel_softmax, gumbel_sigmoid, sample_gumbel
 
 
 class TARDISCell(nn.Module):
@@ -39,11 +35,9 @@ class TARDISCell(nn.Module):
         self.W_h2c = nn.Parameter(torch.Tensor(hidden_size, hidden_size))
         self.b_c = nn.Parameter(torch.Tensor(hidden_size))
 
-        # memory related parameters
-        self.read_loc_list = None
-        self.all_ones = None
-        self.all_ones_created = False
-        self.num_cells_written_so_far = 0
+        # memory related parameters, the memory bookkeeping lives in the hidden state.
+        # row t is the write mask of the t-th step while the memory is filling up.
+        self.register_buffer("_write_masks", torch.eye(num_mem_cells), persistent=False)
 
         self.W_m2i = nn.Parameter(torch.Tensor(micro_state_size, hidden_size))
         self.W_m2f = nn.Parameter(torch.Tensor(micro_state_size, hidden_size))
@@ -71,18 +65,26 @@ class TARDISCell(nn.Module):
         self.alpha_beta_params = [self.w_a_h, self.w_b_h, self.w_a_x, self.w_b_x, self.w_a_r, self.w_b_r]
         self.reset_parameters()
 
-    def _variable(self, input, gpu=None, volatile=False, requires_grad=True):
-        use_gpu = gpu if gpu is not None else self.use_gpu
-        v = utils.my_variable(input, use_gpu, volatile=volatile, requires_grad=requires_grad)
-        return v
-
     def forward(self, input, last_hidden):
-        batch_size = input.size()[0]
+        """Computes one time step.
 
-        if not self.read_loc_list:
-            self.read_loc_list = [self._variable(torch.zeros((batch_size, self.num_mem_cells))).detach()]
+        Args:
+            input: [batch_size, input_size] input vector.
+            last_hidden: hidden state dictionary from reset_hidden or the previous step.
+                "mem" holds the memory cells, "usage" the running sum of the sampled read
+                locations and "num_written" the number of steps written so far.
+
+        Returns:
+            the next hidden state dictionary.
+        """
+
+        batch_size = input.size()[0]
         if "mem" not in last_hidden:
-            last_hidden["mem"] = self._variable(torch.zeros(batch_size, self.num_mem_cells, self.micro_state_size))
+            last_hidden = dict(last_hidden, **self._init_memory(batch_size))
+
+        # one draw of Gumbel noise for the read location, alpha and beta.
+        noise = sample_gumbel(input.new_empty(batch_size, self.num_mem_cells + 2))
+        location_noise, alpha_noise, beta_noise = noise.split([self.num_mem_cells, 1, 1], 1)
 
         # compute read weights
         last_hidden_micro_state = torch.mm(last_hidden["h"], self.W_m) + self.b_m
@@ -92,13 +94,12 @@ class TARDISCell(nn.Module):
         m_logits = torch.mm(torch.squeeze(torch.bmm(last_hidden["mem"], last_hidden_micro_state), 2), self.W_g_m)
         h_logits = torch.mm(last_hidden["h"], self.W_g_h)
         x_logits = torch.mm(input, self.W_g_x)
-        usage_vector = torch.sum(torch.stack(self.read_loc_list, 1), 1)
-        usage_vector = torch.nn.functional.softmax(usage_vector).view_as(usage_vector)
+        usage_vector = torch.nn.functional.softmax(last_hidden["usage"], dim=1)
         u_logits = torch.mm(usage_vector, self.W_g_u)
         logits = m_logits + h_logits + x_logits + u_logits
 
-        sampled_one_hot_location = gumbel_softmax(logits, use_gpu=self.use_gpu)
-        self.read_loc_list.append(sampled_one_hot_location.detach())
+        sampled_one_hot_location = gumbel_softmax(logits, noise=location_noise)
+        usage = last_hidden["usage"] + sampled_one_hot_location.detach()
         sampled_mirco_state = torch.bmm(torch.unsqueeze(sampled_one_hot_location, 1), last_hidden["mem"])
         sampled_micro_state = torch.squeeze(sampled_mirco_state, 1)
 
@@ -106,10 +107,11 @@ class TARDISCell(nn.Module):
         self.W_f = torch.cat((self.W_x2f, self.W_h2f, self.W_c2f, self.W_m2f), 0)
         self.W_o = torch.cat((self.W_x2o, self.W_h2o, self.W_c2o, self.W_m2o), 0)
 
+        # [batch_size, 1] gates, broadcast over the hidden units.
         alpha = torch.mm(last_hidden["h"], self.w_a_h) + torch.mm(input, self.w_a_x) + torch.mm(sampled_micro_state, self.w_a_r)
-        alpha = gumbel_sigmoid(alpha, 0.3, use_gpu=self.use_gpu).repeat(last_hidden["h"].size())
+        alpha = gumbel_sigmoid(alpha, 0.3, noise=alpha_noise)
         beta = torch.mm(last_hidden["h"], self.w_b_h) + torch.mm(input, self.w_b_x) + torch.mm(sampled_micro_state, self.w_b_r)
-        beta = gumbel_sigmoid(beta, 0.3, use_gpu=self.use_gpu).repeat(last_hidden["h"].size())
+        beta = gumbel_sigmoid(beta, 0.3, noise=beta_noise)
 
         c_input = torch.cat((input, last_hidden["h"], last_hidden["c"], sampled_micro_state), 1)
         i = torch.sigmoid(torch.mm(c_input, self.W_i) + self.b_i)
@@ -124,41 +126,38 @@ class TARDISCell(nn.Module):
 
         h = o * torch.tanh(c)
 
-        # writing into memory
+        # writing into memory: the cells are filled in order, then the read location is
+        # overwritten. The selection runs on the device, without a host sync.
         curr_micro_state = torch.mm(h, self.W_m) + self.b_m
         curr_micro_state = torch.unsqueeze(curr_micro_state, 1)
 
-        def one_hot(num):
-            o = np.zeros((batch_size, self.num_mem_cells, 1))
-            o[:, num] = 1
-            return o
-
-        def inverse_one_hot(mask):
-            if not self.all_ones_created:
-                self.all_ones = self._variable(torch.ones(mask.size()))
-                self.all_ones_created = True
-            return (self.all_ones - mask)
-
-        if self.num_cells_written_so_far < self.num_mem_cells:
-            one_hot_mask = self._variable(torch.Tensor(one_hot(self.num_cells_written_so_far)))
-            inverse_hot_mask = inverse_one_hot(one_hot_mask)
-            self.num_cells_written_so_far += 1
-        else:
-            one_hot_mask = torch.unsqueeze(sampled_one_hot_location, -1)
-            inverse_hot_mask = inverse_one_hot(one_hot_mask)
+        num_written = last_hidden["num_written"]
+        filling = self._write_masks[num_written.clamp(max=self.num_mem_cells - 1)]
+        one_hot_mask = torch.where(num_written < self.num_mem_cells, filling, sampled_one_hot_location)
+        one_hot_mask = torch.unsqueeze(one_hot_mask, -1)
 
-        memory_matrix = curr_micro_state.repeat(1,self.num_mem_cells,1) * one_hot_mask + last_hidden["mem"] * inverse_hot_mask
+        memory_matrix = curr_micro_state * one_hot_mask + last_hidden["mem"] * (1 - one_hot_mask)
 
         hidden = {}
         hidden["h"] = h
         hidden["c"] = c
         hidden["mem"] = memory_matrix
+        hidden["usage"] = usage
+        hidden["num_written"] = num_written + 1
         return hidden
 
-    def reset_hidden(self):
+    def _init_memory(self, batch_size):
+        """Returns the empty memory, usage and write count of the hidden state."""
+
+        return {"mem": self.W_m.new_zeros(batch_size, self.num_mem_cells, self.micro_state_size),
+                "usage": self.W_m.new_zeros(batch_size, self.num_mem_cells),
+                "num_written": torch.zeros((), dtype=torch.long, device=self.W_m.device)}
+
+    def reset_hidden(self, batch_size=1):
         hidden = {}
-        hidden["h"] = self._variable(torch.Tensor(np.zeros((1, self.hidden_size))))
-        hidden["c"] = self._variable(torch.Tensor(np.zeros((1, self.hidden_size))))
+        hidden["h"] = self.W_m.new_zeros(batch_size, self.hidden_size)
+        hidden["c"] = self.W_m.new_zeros(batch_size, self.hidden_size)
+        hidden.update(self._init_memory(batch_size))
         return hidden
 
     def reset_parameters(self):
@@ -6,11 +6,11 @@ from torch.autograd import Variable
 
 
 import myTorch
-from myTorch.utils import my_variable
 
 class A2CAgent(object):
 
-	def __init__(self, a2cnet, optimizer, numpy_rng, ent_coef = 1.0, vf_coef = 1.0,  discount_rate=0.99, grad_clip=None):
+	def __init__(self, a2cnet, optimizer, numpy_rng, ent_coef = 1.0, vf_coef = 1.0,  discount_rate=0.99, grad_clip=None,
+				 inference=False):
 		self._a2cnet = a2cnet
 		self._optimizer = optimizer
 		self._numpy_rng = numpy_rng
@@ -18,12 +18,24 @@ class A2CAgent(object):
 		self._ent_coef = ent_coef
 		self._vf_coef = vf_coef
 		self._grad_clip = grad_clip
+		# inference agents step the policy under torch.inference_mode, e.g. for test rollouts.
+		self._inference = inference
 
 
 	def sample_action(self, obs, dones=[], legal_moves=None, is_training=True, update_agent_state=True):
-		obs = my_variable(torch.from_numpy(obs).type(torch.FloatTensor), use_gpu=self._a2cnet.use_gpu)
+		if self._inference:
+			with torch.inference_mode():
+				return self._sample_action(obs, dones, legal_moves, is_training, update_agent_state)
+		return self._sample_action(obs, dones, legal_moves, is_training, update_agent_state)
+
+	def _sample_action(self, obs, dones, legal_moves, is_training, update_agent_state):
+		obs = torch.from_numpy(obs).type(torch.FloatTensor)
+		if self._a2cnet.use_gpu:
+			obs = obs.cuda()
 		if len(dones) > 0:
-			if self._a2cnet.is_rnn_policy:
+			if self._a2cnet.is_rnn_policy and self._inference:
+				self._a2cnet.reset_done(dones[-1])
+			elif self._a2cnet.is_rnn_policy:
 				self._a2cnet.update_hidden((1 - dones[-1]).unsqueeze(1))
 
 		if self._a2cnet.is_rnn_policy:
@@ -46,7 +58,8 @@ class A2CAgent(object):
 
 	def reset_agent_state(self, batch_size):
 		if self._a2cnet.is_rnn_policy:
-			self._a2cnet.reset_hidden(batch_size)
+			with torch.inference_mode(self._inference):
+				self._a2cnet.reset_hidden(batch_size)
 
 	def train_step(self, minibatch):
 
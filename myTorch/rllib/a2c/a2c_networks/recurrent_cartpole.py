@@ -2,8 +2,8 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from myTorch.utils import my_variable
-from myTorch.memory import RNNCell, GRUCell, LSTMCell, TARDISCell
+from myTorch.memory import RNNCell, GRUCell, LSTMCell
+from myTorch.memory.inference import InferenceEngine
 
 
 class RecurrentCartPole(nn.Module):
@@ -20,15 +20,17 @@ class RecurrentCartPole(nn.Module):
 
 		self._action_dim = action_dim
 		self._use_gpu = use_gpu
+		self._device = torch.device("cuda" if use_gpu else "cpu")
 		self._rnn_input_size = self._obs_dim
 		self._rnn_hidden_size = 30
 		self._rnn_type = rnn_type
 		self._is_rnn_policy = True
 		if self._rnn_type == "LSTM": 
-			self._rnn = LSTMCell(input_size=self._rnn_input_size, hidden_size=self._rnn_hidden_size, use_gpu=use_gpu)
+			self._rnn = LSTMCell(self._device, self._rnn_input_size, self._rnn_hidden_size)
 		elif self._rnn_type == "GRU":
-			self._rnn = GRUCell(input_size=self._rnn_input_size, hidden_size=self._rnn_hidden_size, use_gpu=use_gpu)
+			self._rnn = GRUCell(self._device, self._rnn_input_size, self._rnn_hidden_size)
 		self._hidden = None
+		self._engine = InferenceEngine(self._rnn)
 
 		if self._is_obs_image:
 			self._conv1 = nn.Conv2d(self._obs_dim, 16, kernel_size=5, stride=2)
@@ -52,32 +54,45 @@ class RecurrentCartPole(nn.Module):
 			return self._fc1(x.view(x.size(0), -1))
 
 	def reset_hidden(self, batch_size):
-		self._hidden = {}
-		self._hidden["h"] = my_variable(torch.zeros(batch_size, self._rnn_hidden_size), use_gpu=self._use_gpu)
-		
-		if self._rnn_type == "LSTM":
-			self._hidden["c"] = my_variable(torch.zeros(batch_size, self._rnn_hidden_size), use_gpu=self._use_gpu)
+		# under inference mode the hidden state lives in the preallocated engine buffers.
+		if torch.is_inference_mode_enabled():
+			self._engine.reset_hidden(batch_size)
+			self._hidden = self._engine.hidden
+		else:
+			self._hidden = self._rnn.reset_hidden(batch_size)
 
 	def forward(self, obs, update_hidden_state):
 		if self._hidden is None:
 			self.reset_hidden(obs.shape[0])
 
 		x = self._conv_to_linear(obs) if self._is_obs_image else obs
-		hidden_next = self._rnn(x, self._hidden)
-		if update_hidden_state:
-			self._hidden = hidden_next
+		if torch.is_inference_mode_enabled():
+			hidden_next = self._engine.step(x, update_hidden_state)
+		else:
+			hidden_next = self._rnn(x, self._hidden)
+			if update_hidden_state:
+				self._hidden = hidden_next
 		p = self._fcp(hidden_next["h"])
 		v = self._fcv(hidden_next["h"])
 		return p, v
 
 	def update_hidden(self, mask):
-		for k in self._hidden:
-			self._hidden[k] = mask.expand(-1,self._rnn_hidden_size) * self._hidden[k]
+		if torch.is_inference_mode_enabled():
+			self._engine.mask_hidden(mask)
+		else:
+			for k in self._hidden:
+				self._hidden[k] = mask * self._hidden[k]
+
+	def reset_done(self, dones):
+		# zeroes the finished environments in place in the engine buffers.
+		if torch.is_inference_mode_enabled():
+			self._engine.reset_done(dones)
+		else:
+			self.update_hidden((1 - dones).unsqueeze(1))
 
 	def detach_hidden(self):
 		for k in self._hidden:
-			hidden_value = self._hidden[k].data.cpu().numpy()
-			self._hidden[k] =  my_variable(torch.from_numpy(hidden_value), use_gpu=self._use_gpu)
+			self._hidden[k] = self._hidden[k].detach()
 		
 	@property
 	def action_dim(self):
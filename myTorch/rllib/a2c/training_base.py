@@ -71,7 +71,8 @@ def train_a2c_agent():
 										ent_coef = config.ent_coef,
 										vf_coef = config.vf_coef,
 										discount_rate=config.discount_rate,
-										grad_clip = [config.grad_clip_min, config.grad_clip_max])
+										grad_clip = [config.grad_clip_min, config.grad_clip_max],
+										inference=True)
 
 
 
@@ -1,9 +1,10 @@
 """Permuted Sequential MNIST Task."""
 import numpy as np
 import _pickle as pickle
+import hashlib
 import os
 import math
-from myTorch.utils import MyContainer
+from myTorch.utils import MyContainer, ArtifactCache
 from myTorch.task.mnist.download_mnist import download_mnist
 
 
@@ -34,44 +35,32 @@ class PMNISTData(object):
         data_dir = os.path.join(os.environ["MYTORCH_DATA"], "mnist")
         download_mnist(data_dir)
 
-        self._data = MyContainer()
-
-        self._data.x = {}
-        self._data.y = {}
-
-        train_x = np.load(os.path.join(data_dir, "train_x.npy")).astype("float32") / 255
-        train_y = np.load(os.path.join(data_dir, "train_y.npy")).astype("float32")
-
-        valid_x = np.load(os.path.join(data_dir, "valid_x.npy")).astype("float32") / 255
-        valid_y = np.load(os.path.join(data_dir, "valid_y.npy")).astype("float32")
-
-        test_x = np.load(os.path.join(data_dir, "test_x.npy")).astype("float32") / 255
-        test_y = np.load(os.path.join(data_dir, "test_y.npy")).astype("float32")
-
-
+        seq_perm = self._state.rng.permutation(28 * 28)
 
+        def _build():
+            values = {}
+            for fold in ["train", "valid", "test"]:
+                x = np.load(os.path.join(data_dir, fold + "_x.npy")).astype("float32") / 255
+                x = x.reshape(x.shape[0], x.shape[1] * x.shape[2])
+                values["x_" + fold] = np.expand_dims(x[:, seq_perm], 2)
+                values["y_" + fold] = np.load(os.path.join(data_dir, fold + "_y.npy")).astype("float32")
+            return values
 
-        train_x = train_x.reshape(train_x.shape[0], train_x.shape[1]*train_x.shape[2])
-        valid_x = valid_x.reshape(valid_x.shape[0], valid_x.shape[1]*valid_x.shape[2])
-        test_x = test_x.reshape(test_x.shape[0], test_x.shape[1] * test_x.shape[2])
+        # the permuted folds are cached and memory-mapped, processes with the same
+        # permutation share them.
+        paths = [os.path.join(data_dir, "{}_{}.npy".format(fold, var))
+                 for fold in ["train", "valid", "test"] for var in ["x", "y"]]
+        values = ArtifactCache().get_arrays("pmnist", paths, _build,
+                                            seq_perm=hashlib.sha1(seq_perm.tobytes()).hexdigest())
 
-        seq_perm = self._state.rng.permutation(train_x.shape[1])
-
-
-
-        self._data.x["valid"] = np.expand_dims(valid_x, 2)
-        self._data.y["valid"] = valid_y
-
-        self._data.x["train"] = np.expand_dims(train_x, 2)
-        self._data.y["train"] = train_y
+        self._data = MyContainer()
 
-        self._data.x["test"] = np.expand_dims(test_x, 2)
-        self._data.y["test"] = test_y
+        self._data.x = {}
+        self._data.y = {}
 
         for fold in ["train", "valid", "test"]:
-            for i in range(0, len(self._data.x[fold])):
-                self._data.x[fold][i] = self._data.x[fold][i][seq_perm]
-
+            self._data.x[fold] = values["x_" + fold]
+            self._data.y[fold] = values["y_" + fold]
 
     def reset_iterator(self):
 
@@ -3,7 +3,21 @@ import numpy as np
 import _pickle as pickle
 import os
 import math
-from myTorch.utils import MyContainer
+from myTorch.utils import MyContainer, ArtifactCache
+
+
+class _Sequences(object):
+    """List of variable length sequences, stored concatenated along the first axis."""
+
+    def __init__(self, data, offsets):
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return self._data[self._offsets[i]:self._offsets[i + 1]]
 
 
 class SSMNISTData(object):
@@ -32,6 +46,24 @@ class SSMNISTData(object):
 
     def _load_data(self):
 
+        folder = os.path.join(self._state.data_folder, str(self._state.num_digits))
+
+        def _build():
+            values = {}
+            for fold in ["train", "valid", "test"]:
+                x = pickle.load(open(os.path.join(folder, "x_"+fold+".pkl"), "rb"))
+                values["x_" + fold] = np.concatenate(x)
+                values["offsets_" + fold] = np.cumsum([0] + [len(x_i) for x_i in x])
+                values["y_" + fold] = np.load(os.path.join(folder, "y_"+fold+".npy"))
+                values["seq_len_" + fold] = np.asarray(np.load(os.path.join(folder, "seq_len_"+fold+".npy")),
+                                                       dtype="int32")
+            return values
+
+        # the sequences are cached flat and memory-mapped instead of unpickled per process.
+        paths = [os.path.join(folder, file_name.format(fold)) for fold in ["train", "valid", "test"]
+                 for file_name in ["x_{}.pkl", "y_{}.npy", "seq_len_{}.npy"]]
+        values = ArtifactCache().get_arrays("ssmnist", paths, _build)
+
         self._data = MyContainer()
 
         self._data.x = {}
@@ -39,13 +71,9 @@ class SSMNISTData(object):
         self._data.seq_len = {}
 
         for fold in ["train", "valid", "test"]:
-            x_file = os.path.join(self._state.data_folder, str(self._state.num_digits), "x_"+fold+".pkl")
-            self._data.x[fold] = pickle.load(open(x_file, "rb"))
-            self._data.y[fold] = np.load(os.path.join(self._state.data_folder, str(self._state.num_digits),
-                                                      "y_"+fold+".npy"))
-            self._data.seq_len[fold] = np.load(os.path.join(self._state.data_folder,
-                                                            str(self._state.num_digits), "seq_len_"+fold+".npy"))
-            self._data.seq_len[fold] = np.asarray(self._data.seq_len[fold], dtype="int32")
+            self._data.x[fold] = _Sequences(values["x_" + fold], values["offsets_" + fold])
+            self._data.y[fold] = values["y_" + fold]
+            self._data.seq_len[fold] = values["seq_len_" + fold]
 
     def reset_iterator(self):
 
@@ -86,12 +114,14 @@ class SSMNISTData(object):
         new_x = np.zeros((self._state.batch_size, data_len, 5))
         new_y = np.zeros((self._state.batch_size, data_len))
         mask = np.zeros((self._state.batch_size, data_len))
+        lengths = np.zeros(self._state.batch_size, dtype='int64')
 
         for i in range(0, len(indices)):
             new_x[i][0:seq_len[i]][:, 0:4] = x[i]
             new_x[i][seq_len[i]][4] = 1
             new_y[i][seq_len[i]+1: seq_len[i]+1+self._state.num_digits+1] = y[i]
             mask[i][seq_len[i]+1: seq_len[i]+1+self._state.num_digits+1] = 1
+            lengths[i] = seq_len[i]+1+self._state.num_digits+1
 
         new_x = np.swapaxes(new_x, 0, 1).astype('float32')
         new_y = np.swapaxes(new_y, 0, 1).astype('int64')
@@ -102,6 +132,7 @@ class SSMNISTData(object):
         output['y'] = new_y
         output['mask'] = mask
         output['datalen'] = data_len
+        output['lengths'] = lengths
 
         self._state.batches_done[tag] += 1
 
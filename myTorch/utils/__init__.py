@@ -1,4 +1,5 @@
 from .utils import *
 from .logger import *
 from .experiment import *
-from .model import *
\ No newline at end of file
+from .model import *
+from .cache import *
@@ -0,0 +1,189 @@
+"""Implementation of a content-addressed cache for derived data artifacts."""
+import hashlib
+import logging
+import os
+import _pickle as pickle
+from shutil import rmtree
+
+import numpy as np
+
+from myTorch.utils import create_folder
+
+
+class ArtifactCache(object):
+    """Content-addressed cache of the data artifacts derived from source files.
+
+    An artifact is a directory named after its key, which hashes the artifact name, the
+    build settings and the size and content hash of every source file. Edited sources or
+    settings hence give a new artifact, and every process with the same sources reuses the
+    same one. The content hashes are memoized by (size, mtime), so unchanged files are not
+    read again. Artifacts are built in a temporary directory and renamed into place, and the
+    least recently used ones are evicted when the cache grows over its size budget.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        """Initializes a cache.
+
+        Args:
+            cache_dir: str, absolute path of the cache, $MYTORCH_DATA/cache by default.
+            max_bytes: int, size budget of the cache, $MYTORCH_CACHE_BYTES or 20GB by default.
+        """
+
+        if cache_dir is None:
+            key = "MYTORCH_DATA"
+            assert(key in os.environ), "Environment variable named `{}` not set".format(key)
+            cache_dir = os.path.join(os.environ[key], "cache")
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("MYTORCH_CACHE_BYTES", 20 * 2 ** 30))
+
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        create_folder(self._cache_dir)
+
+    def fingerprint(self, paths):
+        """Returns the (file name, size, content hash) fingerprints of source files.
+
+        Args:
+            paths: list of str, file names with absolute or relative path.
+        """
+
+        index_file = os.path.join(self._cache_dir, "index.p")
+        index = {}
+        if os.path.isfile(index_file):
+            with open(index_file, "rb") as f:
+                index = pickle.load(f)
+
+        fingerprints, updated = [], False
+        for path in paths:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            if index.get(path, (None, None, None))[:2] != (stat.st_size, stat.st_mtime_ns):
+                index[path] = (stat.st_size, stat.st_mtime_ns, _file_hash(path))
+                updated = True
+            fingerprints.append((os.path.basename(path), stat.st_size, index[path][2]))
+
+        if updated:
+            _atomic_pickle(index, index_file)
+        return fingerprints
+
+    def key(self, name, paths, settings):
+        """Returns the key of an artifact.
+
+        Args:
+            name: str, name of the artifact.
+            paths: list of str, source files of the artifact.
+            settings: dict, settings the artifact is built with.
+        """
+
+        description = repr((name, sorted(settings.items()), self.fingerprint(paths)))
+        return "{}-{}".format(name, hashlib.sha1(description.encode()).hexdigest())
+
+    def get(self, name, paths, build, **settings):
+        """Returns the directory of an artifact, building it if needed.
+
+        Args:
+            name: str, name of the artifact.
+            paths: list of str, source files of the artifact.
+            build: function writing the artifact into the directory it gets as argument.
+            settings: settings the artifact is built with, part of the key.
+
+        Returns:
+            str, absolute path of the artifact directory.
+        """
+
+        directory = os.path.join(self._cache_dir, self.key(name, paths, settings))
+        if not os.path.isdir(directory):
+            logging.info("Building {} artifact at {}".format(name, directory))
+            tmp_directory = "{}.tmp{}".format(directory, os.getpid())
+            create_folder(tmp_directory)
+            build(tmp_directory)
+            try:
+                os.rename(tmp_directory, directory)
+            except OSError:
+                # another process built the same artifact first.
+                rmtree(tmp_directory)
+            self._evict(keep=directory)
+        else:
+            os.utime(directory)
+        return directory
+
+    def get_arrays(self, name, paths, build, **settings):
+        """Returns an artifact made of numpy arrays and other objects, building it if needed.
+
+        Args:
+            name: str, name of the artifact.
+            paths: list of str, source files of the artifact.
+            build: function returning a dict of numpy arrays and other picklable objects.
+            settings: settings the artifact is built with, part of the key.
+
+        Returns:
+            dict of the built values, where the numpy arrays are read-only memory maps.
+        """
+
+        directory = self.get(name, paths, lambda directory: save_arrays(build(), directory), **settings)
+        return load_arrays(directory)
+
+    def _evict(self, keep):
+        """Removes the least recently used artifacts until the cache fits in its budget."""
+
+        artifacts = []
+        for entry in os.listdir(self._cache_dir):
+            directory = os.path.join(self._cache_dir, entry)
+            if os.path.isdir(directory) and ".tmp" not in entry:
+                artifacts.append((os.stat(directory).st_mtime, _directory_size(directory), directory))
+
+        total = sum(size for _, size, _ in artifacts)
+        for _, size, directory in sorted(artifacts):
+            if total <= self._max_bytes:
+                break
+            if directory != keep:
+                logging.info("Evicting {} from the artifact cache".format(directory))
+                rmtree(directory, ignore_errors=True)
+                total -= size
+
+
+def save_arrays(values, directory):
+    """Saves a dict of numpy arrays and other picklable objects in a directory.
+
+    The arrays are saved as .npy files, the other objects are pickled together.
+    """
+
+    objects = {}
+    for key, value in values.items():
+        if isinstance(value, np.ndarray):
+            np.save(os.path.join(directory, "{}.npy".format(key)), value)
+        else:
+            objects[key] = value
+    with open(os.path.join(directory, "objects.p"), "wb") as f:
+        pickle.dump(objects, f, 2)
+
+
+def load_arrays(directory):
+    """Loads the values saved with save_arrays, the numpy arrays are memory-mapped."""
+
+    with open(os.path.join(directory, "objects.p"), "rb") as f:
+        values = pickle.load(f)
+    for entry in os.listdir(directory):
+        if entry.endswith(".npy"):
+            values[entry[:-len(".npy")]] = np.load(os.path.join(directory, entry), mmap_mode="r")
+    return values
+
+
+def _file_hash(path, block_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _directory_size(directory):
+    return sum(os.path.getsize(os.path.join(root, file_name))
+               for root, _, file_names in os.walk(directory) for file_name in file_names)
+
+
+def _atomic_pickle(value, file_name):
+    tmp_file_name = "{}.tmp{}".format(file_name, os.getpid())
+    with open(tmp_file_name, "wb") as f:
+        pickle.dump(value, f, 2)
+    os.replace(tmp_file_name, file_name)
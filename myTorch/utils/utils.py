@@ -211,36 +211,42 @@ def get_optimizer(params, config):
         assert("Unsupported optimizer : {}. Valid optimizers : Adadelta, Adagrad, Adam, RMSprop, SGD".format(config.optim_name))
 
 def sample_gumbel(input, eps=1e-10, use_gpu=False):
-    noise = torch.rand(input.size())
+    """Draws Gumbel(0, 1) noise with the shape, dtype and device of input.
+
+    The noise is sampled on the device of input, use_gpu is kept for compatibility.
+    """
+    noise = torch.rand_like(input)
     noise.add_(eps).log_().neg_()
     noise.add_(eps).log_().neg_()
-    return my_variable(noise, use_gpu)
+    return noise
 
 
-def gumbel_softmax_sample(logits, temperature, use_gpu=False):
+def gumbel_softmax_sample(logits, temperature, use_gpu=False, noise=None):
     """ Draw a sample from the Gumbel-Softmax distribution"""
-    y = logits + sample_gumbel(logits, use_gpu=use_gpu)
-    return torch.nn.functional.softmax(y / temperature).view_as(y)
+    y = logits + (sample_gumbel(logits) if noise is None else noise)
+    return torch.nn.functional.softmax(y / temperature, dim=-1)
 
 
-def gumbel_sigmoid(logits, temperature=1.0, use_gpu=False):
-    y = logits + sample_gumbel(logits, use_gpu=use_gpu)
-    return torch.sigmoid(y / temperature).view_as(y)
+def gumbel_sigmoid(logits, temperature=1.0, use_gpu=False, noise=None):
+    y = logits + (sample_gumbel(logits) if noise is None else noise)
+    return torch.sigmoid(y / temperature)
 
 
-def gumbel_softmax(logits, temperature=1.0, hard=True, use_gpu=False):
+def gumbel_softmax(logits, temperature=1.0, hard=True, use_gpu=False, noise=None):
     """Sample from the Gumbel-Softmax distribution and optionally discretize.
     Args:
       logits: [batch_size, n_class] unnormalized log-probs
       temperature: non-negative scalar
       hard: if True, take argmax, but differentiate w.r.t. soft sample y
+      noise: optional [batch_size, n_class] Gumbel noise from sample_gumbel, e.g. drawn
+        together with the noise of other samples
     Returns:
       [batch_size, n_class] sample from the Gumbel-Softmax distribution.
       If hard=True, then the returned sample will be one-hot, otherwise it will
       be a probabilitiy distribution that sums to 1 across classes
     """
-    y = gumbel_softmax_sample(logits, temperature, use_gpu)
-    y_one_hot = my_variable(torch.zeros(y.size()), use_gpu)
+    y = gumbel_softmax_sample(logits, temperature, use_gpu, noise)
+    y_one_hot = torch.zeros_like(y)
     if hard:
         y_one_hot.scatter_(1, torch.max(y,1,keepdim=True)[1], 1)
     return ((y_one_hot - y).detach() + y)